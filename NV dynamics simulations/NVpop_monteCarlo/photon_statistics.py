@@ -0,0 +1,86 @@
+### Photon statistics from time tagged transition streams
+# The Monte Carlo engines can return a time tagged stream of selected transitions (e.g. radiative decays as photons), as
+# per-repetition offsets into an array of tag times (see pop_montecarlo_c.monteCarlo, emission).
+# The histograms here are accumulated chunk by chunk, so that runs can be split over many seeds without ever holding all
+# of the tags in memory, and are set up to compare directly to TCSPC data.
+
+import numpy as np
+
+
+def tag_repetitions(tag_offsets):
+    ''' Repetition index of each tag '''
+    return np.repeat(np.arange(len(tag_offsets) - 1),np.diff(tag_offsets))
+
+
+class count_histogram(object):
+    ''' Histogram of the number of photons per repetition in the window [window_start, window_end) '''
+
+    def __init__(self,window_start=0.0,window_end=np.inf,max_counts=20):
+        self.window_start = window_start
+        self.window_end = window_end
+        self.counts = np.zeros(max_counts+1,dtype=np.int64) # Last bin collects max_counts or more
+        self.repetitions = 0
+
+    def add(self,tag_offsets,tag_times):
+        in_window = (tag_times >= self.window_start) & (tag_times < self.window_end)
+        per_rep = np.bincount(tag_repetitions(tag_offsets)[in_window],minlength=len(tag_offsets) - 1)
+        self.counts += np.bincount(np.minimum(per_rep,len(self.counts) - 1),minlength=len(self.counts))
+        self.repetitions += len(tag_offsets) - 1
+
+    def probabilities(self):
+        return self.counts/float(max(self.repetitions,1))
+
+    def mean(self):
+        return np.dot(np.arange(len(self.counts)),self.probabilities())
+
+
+class g2_histogram(object):
+    ''' Second order correlation g2(tau) of the photons within a repetition, as measured with pulsed (start-stop all pairs)
+    TCSPC. Coincidences between photons of the same repetition are normalised by those expected between independent
+    repetitions (the side peaks), which follow from the mean time profile of the emission. '''
+
+    def __init__(self,bin_width,max_tau):
+        self.bin_width = bin_width
+        self.num_bins = int(np.ceil(max_tau/bin_width))
+        self.coincidences = np.zeros(2*self.num_bins+1,dtype=np.int64) # tau from -max_tau to max_tau
+        self.time_profile = np.zeros(0,dtype=np.int64) # Histogram of all tag times, for the normalisation
+        self.repetitions = 0
+
+    def taus(self):
+        return self.bin_width*np.arange(-self.num_bins,self.num_bins+1)
+
+    def add(self,tag_offsets,tag_times):
+        reps = tag_repetitions(tag_offsets)
+        time_bins = np.floor(np.asarray(tag_times)/self.bin_width).astype(np.int64)
+
+        # Pairs (i, i+lag) of the same repetition. Tags are sorted in time within each repetition, so once no pair is
+        # within max_tau at some lag, none will be at larger lags
+        max_per_rep = int(np.max(np.diff(tag_offsets))) if len(tag_offsets) > 1 else 0
+        for lag in range(1,max_per_rep):
+            same_rep = reps[lag:] == reps[:-lag]
+            delays = (time_bins[lag:] - time_bins[:-lag])[same_rep]
+            delays = delays[delays <= self.num_bins]
+            if len(delays) == 0:
+                break
+            self.coincidences += np.bincount(self.num_bins + delays,minlength=len(self.coincidences))
+            self.coincidences += np.bincount(self.num_bins - delays,minlength=len(self.coincidences))
+
+        profile = np.bincount(time_bins,minlength=len(self.time_profile))
+        profile[:len(self.time_profile)] += self.time_profile
+        self.time_profile = profile
+        self.repetitions += len(tag_offsets) - 1
+
+    def uncorrelated_coincidences(self):
+        ''' Coincidences expected per tau bin if the photons within a repetition were independent (Poissonian) '''
+        mean_profile = self.time_profile/float(max(self.repetitions,1))
+        full = np.correlate(mean_profile,mean_profile,mode='full') # Zero delay at index len(mean_profile) - 1
+        zero = len(mean_profile) - 1
+        expected = np.zeros(len(self.coincidences))
+        for ii,delay in enumerate(range(-self.num_bins,self.num_bins+1)):
+            if abs(delay) <= zero:
+                expected[ii] = full[zero + delay]
+        return self.repetitions*expected
+
+    def g2(self):
+        expected = self.uncorrelated_coincidences()
+        return np.where(expected > 0,self.coincidences/np.where(expected > 0,expected,1.0),np.nan)
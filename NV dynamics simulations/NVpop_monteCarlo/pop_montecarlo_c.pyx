@@ -1,75 +1,356 @@
 import cython
 import numpy as np
 cimport numpy as np
-from libc.stdlib cimport rand, RAND_MAX
+import multiprocessing
+from cython.parallel import prange, threadid
+from libc.math cimport log
+from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport memcpy
+from libc.stdint cimport uint64_t, int64_t
+
+try: # Imported from the package (e.g. by monteCarlo_repumping)
+    from NVpop_monteCarlo.pop_montecarlo_common import _init_states,as_schedule,schedule_grid,_emission_weights,resample_events,gillespie_on_grid,population_errors
+except ImportError: # Imported from within this folder
+    from pop_montecarlo_common import _init_states,as_schedule,schedule_grid,_emission_weights,resample_events,gillespie_on_grid,population_errors
+
+# Random numbers come from one splitmix64 stream per repetition, keyed by (seed, repetition), so runs are reproducible
+# and independent of the number of threads and of how the repetitions are scheduled over them.
+# Runs with the same seed therefore share their random numbers repetition by repetition (common random numbers), which
+# makes differences between parameter points much less noisy than the points themselves.
+# With antithetic=True repetitions come in pairs (2k, 2k+1) that share stream k, the second using 1-u for every draw u.
+
+cdef inline uint64_t splitmix64(uint64_t* state) nogil:
+    state[0] += <uint64_t>0x9E3779B97F4A7C15ULL
+    cdef uint64_t z = state[0]
+    z = (z ^ (z >> 30)) * <uint64_t>0xBF58476D1CE4E5B9ULL
+    z = (z ^ (z >> 27)) * <uint64_t>0x94D049BB133111EBULL
+    return z ^ (z >> 31)
+
+cdef inline uint64_t rep_stream(uint64_t seed, uint64_t rep) nogil:
+    cdef uint64_t state = seed
+    return splitmix64(&state) ^ (rep * <uint64_t>0xD1B54A32D192ED03ULL)
+
+cdef inline double uniform(uint64_t* state, int flip) nogil:
+    ''' Uniform double in [0,1), or its antithetic partner 1-u in (0,1] if flip '''
+    cdef double u = (splitmix64(state) >> 11) * (1.0/9007199254740992.0)
+    if flip:
+        return 1.0 - u
+    return u
+
+def _seed_and_threads(seed,num_threads):
+    if seed is None:
+        seed = np.random.randint(0,2**31-1)
+    if num_threads is None or num_threads <= 0:
+        num_threads = multiprocessing.cpu_count()
+    return seed,num_threads
+
+cdef struct event_buffer:
+    double* times
+    int* states
+    int64_t size
+    int64_t capacity
+
+cdef int push_event(event_buffer* buf,double t,int state) nogil:
+    cdef int64_t new_capacity
+    cdef double* new_times
+    cdef int* new_states
+    if buf.size == buf.capacity:
+        new_capacity = 2*buf.capacity + 64
+        new_times = <double*>realloc(buf.times,new_capacity*sizeof(double))
+        if new_times == NULL:
+            return -1
+        buf.times = new_times
+        new_states = <int*>realloc(buf.states,new_capacity*sizeof(int))
+        if new_states == NULL:
+            return -1
+        buf.states = new_states
+        buf.capacity = new_capacity
+    buf.times[buf.size] = t
+    buf.states[buf.size] = state
+    buf.size += 1
+    return 0
+
+cdef event_buffer* new_buffers(int n):
+    cdef event_buffer* buffers = <event_buffer*>malloc(n*sizeof(event_buffer))
+    cdef int ii
+    for ii in range(n):
+        buffers[ii].times = NULL
+        buffers[ii].states = NULL
+        buffers[ii].size = 0
+        buffers[ii].capacity = 0
+    return buffers
+
+cdef void free_buffers(event_buffer* buffers,int n):
+    cdef int ii
+    for ii in range(n):
+        free(buffers[ii].times)
+        free(buffers[ii].states)
+    free(buffers)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef gather_buffers(event_buffer* buffers,int[:] rep_thread,int64_t[:] rep_start,int64_t[:] rep_count,int repetitions):
+    ''' Concatenate the events of per-thread buffers in repetition order. Returns rep_offsets, times and states '''
+    rep_offsets = np.zeros(repetitions+1,dtype=np.int64)
+    rep_offsets[1:] = np.cumsum(rep_count)
+    times_arr = np.empty(rep_offsets[repetitions])
+    states_arr = np.empty(rep_offsets[repetitions],dtype=np.int32)
+    cdef double[:] times = times_arr
+    cdef int[:] states = states_arr
+    cdef int64_t[:] offsets = rep_offsets
+    cdef int jj
+    for jj in range(repetitions):
+        if rep_count[jj] > 0:
+            memcpy(&times[offsets[jj]],&buffers[rep_thread[jj]].times[rep_start[jj]],rep_count[jj]*sizeof(double))
+            memcpy(&states[offsets[jj]],&buffers[rep_thread[jj]].states[rep_start[jj]],rep_count[jj]*sizeof(int))
+    return rep_offsets,times_arr,states_arr
 
 @cython.boundscheck(False)
+@cython.wraparound(False)
+def monteCarlo(init_state,rateMat,time_duration,double dt,int repetitions,store_trajectories=False,seed=None,num_threads=None,antithetic=False,emission=None):
+    ''' Monte Carlo simulation of the population dynamics for transition rates rateMat[from,to].
+
+    rateMat can also be a schedule of (duration, rateMat) segments (time_duration is then ignored), e.g. pulse trains or
+    interleaved repump and readout, which are all run in one pass. See schedule_grid for the time axis.
+    The populations are accumulated on the fly, so memory is O(points x states) regardless of the number of repetitions.
+    Repetitions are run in parallel over num_threads (default all cores), the results are bit-identical for a given seed.
+    Returns t_array, state_counts (number of repetitions in each state at each time point, points x states),
+    final_states (the state of each repetition at the end) and, if store_trajectories, the full trajectories
+    (repetitions x points, uint8), otherwise None.
+    If emission is given, a [from,to] mask (or per segment masks) of the probability that a transition is tagged, e.g.
+    the radiative decays for photons, a time tagged stream of those transitions is returned as well: (tag_offsets, tag_times),
+    with the tags of repetition jj in tag_times[tag_offsets[jj]:tag_offsets[jj+1]]. Transitions are tagged at the grid
+    time at which the new state is first recorded. '''
+
+    schedule = as_schedule(rateMat,time_duration)
+    seed,num_threads = _seed_and_threads(seed,num_threads)
+    cdef int[:] init_states = _init_states(init_state,repetitions)
+
+    rateMats = np.array([segment_rateMat for _,segment_rateMat in schedule],dtype=float)
+    t_array,step_segment_arr,segment_starts = schedule_grid(schedule,dt)
+
+    cdef int num_segments = len(schedule)
+    cdef int num_states = np.shape(rateMats)[1]
+    cdef int total_points = len(t_array)
+    cdef int store = 1 if store_trajectories else 0
+    cdef uint64_t c_seed = <uint64_t>seed
+    cdef int antithetic_pairs = 1 if antithetic else 0
+    cdef int n_threads = num_threads
+    cdef int[:] step_segment = step_segment_arr
+
+    if store and num_states > 256:
+        raise ValueError("Too many states to store trajectories as uint8!")
+
+    thread_counts_arr = np.zeros([n_threads,total_points,num_states], dtype=np.int64)
+    final_states_arr = np.empty(repetitions, dtype=np.int32)
+    trajectories_arr = np.empty([repetitions if store else 0,total_points], dtype=np.uint8)
+    cdef int64_t[:,:,:] thread_counts = thread_counts_arr
+    cdef int[:] final_states = final_states_arr
+    cdef np.uint8_t[:,:] trajectories = trajectories_arr
+
+    probs_arr = dt*np.sum(rateMats,axis=2)
+    probs_arr[probs_arr == 0.0] = -1.0 # To avoid tedious divide by zero errors
+    cdef double[:,:] probs = probs_arr
+    cdef double[:,:,:] branchingMat = np.cumsum(dt*rateMats,axis=2)/probs_arr[:,:,np.newaxis]
+
+    # Grid index up to which a state that cannot decay in a segment is certain to stay put (spanning consecutive segments)
+    segment_ends = np.append(segment_starts[1:],total_points - 1)
+    absorbing_end_arr = np.empty([num_segments,num_states],dtype=np.intc)
+    for seg in reversed(range(num_segments)):
+        absorbing_end_arr[seg] = segment_ends[seg]
+        if seg < num_segments - 1:
+            absorbing_end_arr[seg] = np.where(probs_arr[seg+1] == -1.0,absorbing_end_arr[seg+1],segment_ends[seg])
+    cdef int[:,:] absorbing_end = absorbing_end_arr
+
+    # Tagged transitions are collected in per-thread buffers, and gathered in repetition order at the end
+    cdef int emit = 0 if emission is None else 1
+    cdef double[:,:,:] weights = _emission_weights(0.0 if emission is None else emission,rateMats)
+    cdef event_buffer* tags = new_buffers(n_threads)
+    rep_thread_arr = np.zeros(repetitions,dtype=np.int32)
+    rep_start_arr = np.zeros(repetitions,dtype=np.int64)
+    rep_count_arr = np.zeros(repetitions,dtype=np.int64)
+    cdef int[:] rep_thread = rep_thread_arr
+    cdef int64_t[:] rep_start = rep_start_arr
+    cdef int64_t[:] rep_count = rep_count_arr
 
-def monteCarlo(np.ndarray[int, ndim=1,negative_indices=False,mode='c'] init_state,np.ndarray[double, ndim=2,negative_indices=False,mode='c'] rateMat,double time_duration,double dt,int repetitions):
-    
-    cdef int init_state_per_rep
-    if np.size(init_state) == 1:
-        init_state_per_rep = 0
-    elif np.size(init_state) == repetitions:
-        init_state_per_rep = 1
-    else:
-        print "Incorrect init_state size!"
-
-    cdef int num_states = np.shape(rateMat)[0]
-    cdef int total_points = np.ceil(time_duration/np.float(dt) + 1).astype(int)
-    cdef int current_state
-    
-    cdef extern from "stdlib.h":
-        double drand48()
-
-    cdef np.ndarray[double, ndim=1,negative_indices=False,mode='c'] t_array = dt * np.arange(total_points).astype(int)
-    cdef np.ndarray[np.int_t, ndim=2,negative_indices=False,mode='c'] pops = np.empty([repetitions,total_points], dtype=np.int)
-    
-    cdef np.ndarray[double, ndim=1,negative_indices=False,mode='c'] cumBranching = np.empty(num_states)
-    cdef np.ndarray[double, ndim=1,negative_indices=False,mode='c'] probs = dt*np.sum(rateMat,axis=1).astype(float)
-    probs[probs == 0.0] = -1.0 # To avoid tedious divide by zero errors
-    cdef np.ndarray[double, ndim=2,negative_indices=False,mode='c'] branchingMat = np.cumsum(dt*rateMat,axis=1)/np.tile(probs,[num_states,1]).T
-
-    cdef np.ndarray[double, ndim=3,negative_indices=False,mode='c'] pops_expanded = np.empty([repetitions,total_points,num_states])
-    
     cdef double prob, branching_rand
+    cdef int jj, ii, kk, y, tid, seg_ii, current_state, flip
+    cdef int failed = 0
+    cdef uint64_t rng
 
-    if np.max(probs) > 0.8:
-        print 'dt not small enough! Probably gonna mess up'
-        print 'dt should be no bigger than ', 0.8/np.max(probs)
+    if np.max(probs_arr) > 0.8:
+        print('dt not small enough! Probably gonna mess up')
+        print('dt should be no bigger than %f' % (0.8*dt/np.max(probs_arr)))
 
-    for jj in range(repetitions):
-        if init_state_per_rep == 1:
-            current_state = init_state[jj]
+    for jj in prange(repetitions, nogil=True, num_threads=n_threads, schedule='dynamic', chunksize=64):
+        tid = threadid()
+        if antithetic_pairs:
+            rng = rep_stream(c_seed,jj//2)
+            flip = jj % 2
         else:
-            current_state = init_state[0]
+            rng = rep_stream(c_seed,jj)
+            flip = 0
+        current_state = init_states[jj]
+        rep_thread[jj] = tid
+        rep_start[jj] = tags[tid].size
+        ii = 0
+        thread_counts[tid,ii,current_state] += 1
+        if store:
+            trajectories[jj,ii] = current_state
 
-        prob = probs[current_state]
-        for x in range(num_states): # Stupid way to slice a matrix.
-            cumBranching[x] = branchingMat[current_state,x]
+        while ii < total_points - 1:
+            seg_ii = step_segment[ii]
+            prob = probs[seg_ii,current_state]
 
-                
-        for ii in range(total_points):
-            
             if prob == -1.0: # Pretty boring if never going to decay from this state
-                pops[jj,ii:] = current_state
-                break
+                for kk in range(ii+1,absorbing_end[seg_ii,current_state]+1):
+                    thread_counts[tid,kk,current_state] += 1
+                    if store:
+                        trajectories[jj,kk] = current_state
+                ii = absorbing_end[seg_ii,current_state]
             else:
-                pops[jj,ii] = current_state
-                if drand48() < prob:
-                    branching_rand = drand48()
+                if uniform(&rng,flip) < prob:
+                    branching_rand = uniform(&rng,flip)
                     for y in range(num_states): # Iterate through states testing for decay
-                        if cumBranching[y] > branching_rand:
+                        if branchingMat[seg_ii,current_state,y] > branching_rand:
+                            if emit and weights[seg_ii,current_state,y] > 0.0:
+                                if weights[seg_ii,current_state,y] >= 1.0 or uniform(&rng,flip) < weights[seg_ii,current_state,y]:
+                                    if push_event(&tags[tid],(ii+1)*dt,y) != 0:
+                                        failed += 1 # Reduction, so that it survives the parallel loop
                             current_state = y
-                            prob = probs[current_state]
-                            for x in range(num_states):
-                                cumBranching[x] = branchingMat[current_state,x]
                             break
-           
-    for jj in range(repetitions):
-        for ii in range(total_points):
-            for ind in range(num_states):
-                pops_expanded[jj,ii,ind] = pops[jj,ii]==ind
+                ii = ii + 1
+                thread_counts[tid,ii,current_state] += 1
+                if store:
+                    trajectories[jj,ii] = current_state
+
+        final_states[jj] = current_state
+        rep_count[jj] = tags[tid].size - rep_start[jj]
+
+    tag_offsets,tag_times,_ = gather_buffers(tags,rep_thread,rep_start,rep_count,repetitions) if (emit and not failed) else (None,None,None)
+    free_buffers(tags,n_threads)
+    if failed:
+        raise MemoryError("Ran out of memory storing the transition tags")
+
+    results = t_array,thread_counts_arr.sum(axis=0),final_states_arr,(trajectories_arr if store else None)
+    return results + ((tag_offsets,tag_times),) if emit else results
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def gillespie_events(init_state,rateMat,time_duration,int repetitions,seed=None,num_threads=None,antithetic=False,emission=None):
+    ''' Exact continuous-time (Gillespie) simulation for the same rateMat[from,to] interface as monteCarlo.
+    rateMat can also be a schedule of (duration, rateMat) segments (time_duration is then ignored). The rates are constant
+    within a segment, so when a waiting time overruns a segment boundary it is simply redrawn from the boundary.
+    Waiting times and branchings are drawn directly, so the run time is proportional to the number of jumps.
+    Returns the jumps as event lists: the events of repetition jj are event_times/event_states[rep_offsets[jj]:rep_offsets[jj+1]],
+    where each event is the time at which that state is entered (the first event of each repetition is its initial state at t = 0).
+    If emission is given (see monteCarlo), the tagged transitions are also returned, as (tag_offsets, tag_times). Unlike the
+    state events these include tagged self transitions. '''
+
+    schedule = as_schedule(rateMat,time_duration)
+    seed,num_threads = _seed_and_threads(seed,num_threads)
+    cdef int[:] init_states = _init_states(init_state,repetitions)
+
+    rateMats = np.array([segment_rateMat for _,segment_rateMat in schedule],dtype=float)
+    cdef int num_segments = len(schedule)
+    cdef int num_states = np.shape(rateMats)[1]
+    total_rates_arr = np.sum(rateMats,axis=2)
+    cdef double[:,:] total_rates = total_rates_arr
+    cdef double[:,:,:] branchingMat = np.cumsum(rateMats,axis=2)/np.where(total_rates_arr == 0.0,1.0,total_rates_arr)[:,:,np.newaxis]
+    cdef double[:] segment_end_times = np.cumsum([duration for duration,_ in schedule]).astype(float)
+    cdef uint64_t c_seed = <uint64_t>seed
+    cdef int antithetic_pairs = 1 if antithetic else 0
+    cdef int n_threads = num_threads
+
+    # Events are collected in per-thread buffers, and gathered in repetition order at the end
+    cdef event_buffer* buffers = new_buffers(n_threads)
+    cdef event_buffer* tags = new_buffers(n_threads)
+    cdef int emit = 0 if emission is None else 1
+    cdef double[:,:,:] weights = _emission_weights(0.0 if emission is None else emission,rateMats)
+
+    rep_thread_arr = np.empty(repetitions,dtype=np.int32)
+    rep_start_arr = np.empty(repetitions,dtype=np.int64)
+    rep_count_arr = np.zeros(repetitions,dtype=np.int64)
+    tag_start_arr = np.empty(repetitions,dtype=np.int64)
+    tag_count_arr = np.zeros(repetitions,dtype=np.int64)
+    cdef int[:] rep_thread = rep_thread_arr
+    cdef int64_t[:] rep_start = rep_start_arr
+    cdef int64_t[:] rep_count = rep_count_arr
+    cdef int64_t[:] tag_start = tag_start_arr
+    cdef int64_t[:] tag_count = tag_count_arr
+
+    cdef int jj, y, seg, tid, current_state, next_state, flip
+    cdef int failed = 0
+    cdef double t, t_next, branching_rand
+    cdef uint64_t rng
+
+    for jj in prange(repetitions, nogil=True, num_threads=n_threads, schedule='dynamic', chunksize=64):
+        tid = threadid()
+        if antithetic_pairs:
+            rng = rep_stream(c_seed,jj//2)
+            flip = jj % 2
+        else:
+            rng = rep_stream(c_seed,jj)
+            flip = 0
+        current_state = init_states[jj]
+        t = 0.0
+        seg = 0
+        rep_thread[jj] = tid
+        rep_start[jj] = buffers[tid].size
+        tag_start[jj] = tags[tid].size
+
+        if push_event(&buffers[tid],t,current_state) != 0:
+            failed += 1 # Reduction, so that it survives the parallel loop
+            seg = num_segments
+
+        while seg < num_segments:
+            if total_rates[seg,current_state] == 0.0: # Not going to decay in this segment
+                t_next = segment_end_times[seg] + 1.0
+            else:
+                t_next = t - log(1.0 - uniform(&rng,flip))/total_rates[seg,current_state]
+
+            if t_next > segment_end_times[seg]: # Rates change at the boundary, so start again from there
+                t = segment_end_times[seg]
+                seg = seg + 1
+            else:
+                t = t_next
+                next_state = current_state
+                branching_rand = uniform(&rng,flip)
+                for y in range(num_states):
+                    if branchingMat[seg,current_state,y] > branching_rand:
+                        next_state = y
+                        break
+                if emit and weights[seg,current_state,next_state] > 0.0:
+                    if weights[seg,current_state,next_state] >= 1.0 or uniform(&rng,flip) < weights[seg,current_state,next_state]:
+                        if push_event(&tags[tid],t,next_state) != 0:
+                            failed += 1
+                            break
+                if next_state != current_state: # Self transitions dont change anything
+                    current_state = next_state
+                    if push_event(&buffers[tid],t,current_state) != 0:
+                        failed += 1
+                        break
+
+        rep_count[jj] = buffers[tid].size - rep_start[jj]
+        tag_count[jj] = tags[tid].size - tag_start[jj]
+
+    if not failed:
+        rep_offsets,event_times_arr,event_states_arr = gather_buffers(buffers,rep_thread,rep_start,rep_count,repetitions)
+        if emit:
+            tag_offsets,tag_times,_ = gather_buffers(tags,rep_thread,tag_start,tag_count,repetitions)
+    free_buffers(buffers,n_threads)
+    free_buffers(tags,n_threads)
+
+    if failed:
+        raise MemoryError("Ran out of memory storing the jump events")
+
+    if emit:
+        return rep_offsets,event_times_arr,event_states_arr,(tag_offsets,tag_times)
+    return rep_offsets,event_times_arr,event_states_arr
 
-    return t_array,pops_expanded,pops
 
+def monteCarlo_gillespie(init_state,rateMat,time_duration,double dt,int repetitions,store_trajectories=False,seed=None,num_threads=None,antithetic=False,emission=None):
+    ''' Drop in replacement for monteCarlo (including schedules and tags) using the exact event-driven engine, exact for any dt.
+    The jumps are simulated up to the last time point and only resampled onto the dt grid for the read out. '''
+    return gillespie_on_grid(gillespie_events,init_state,rateMat,time_duration,dt,repetitions,store_trajectories,seed,num_threads,antithetic,emission)
@@ -0,0 +1,88 @@
+### Pure python helpers shared by the population Monte Carlo engines
+# pop_montecarlo_c and pop_montecarlo_np only differ in how they simulate the jumps. Schedules, time grids, the read out
+# of event lists and the population errors are the same for both and live here, so that the engines cannot drift apart.
+
+import numpy as np
+
+
+def _init_states(init_state,repetitions):
+    init_state = np.asarray(init_state,dtype=np.intc)
+    if np.size(init_state) == 1:
+        return np.repeat(init_state.ravel(),repetitions).astype(np.intc)
+    elif np.size(init_state) == repetitions:
+        return np.ascontiguousarray(init_state,dtype=np.intc)
+    raise ValueError("Incorrect init_state size!")
+
+
+def as_schedule(rateMat,time_duration=None):
+    ''' A schedule is a list of (duration, rateMat) segments. A single rateMat is treated as one segment of time_duration '''
+    if isinstance(rateMat,np.ndarray) and np.ndim(rateMat) == 2:
+        return [(time_duration,rateMat)]
+    return list(rateMat)
+
+
+def schedule_grid(schedule,dt):
+    ''' Time grid for a schedule. Each segment is rounded up to whole steps of dt, so that the segment boundaries fall on
+    grid points. Returns t_array, the segment of each step (step ii goes from t_array[ii] to t_array[ii+1]) and the
+    grid index at which each segment starts. '''
+    segment_steps = np.array([int(np.ceil(duration/dt + 1)) - 1 for duration,_ in schedule],dtype=int)
+    segment_starts = np.concatenate(([0],np.cumsum(segment_steps)))
+    t_array = dt * np.arange(segment_starts[-1] + 1)
+    step_segment = np.repeat(np.arange(len(schedule)),segment_steps).astype(np.intc)
+    return t_array,step_segment,segment_starts[:-1]
+
+
+def _emission_weights(emission,rateMats):
+    ''' Probability that each transition [from,to] is tagged, per schedule segment '''
+    weights = np.zeros(np.shape(rateMats)) + np.asarray(emission,dtype=float)
+    if np.any(weights < 0) or np.any(weights > 1):
+        raise ValueError("Emission weights must be probabilities!")
+    return weights
+
+
+def resample_events(t_array,rep_offsets,event_times,event_states,num_states,store_trajectories=False):
+    ''' Read out jump event lists (see gillespie_events) on the time grid t_array.
+    Returns state_counts (points x states), final_states and, if store_trajectories, the trajectories (repetitions x points, uint8). '''
+    total_points = len(t_array)
+    repetitions = len(rep_offsets) - 1
+
+    # Each event holds its state from its first grid point to the first grid point of the next event
+    starts = np.searchsorted(t_array,event_times,side='left')
+    ends = np.empty_like(starts)
+    ends[:-1] = starts[1:]
+    ends[rep_offsets[1:] - 1] = total_points # Last event of each repetition lasts until the end
+
+    diff = np.zeros([total_points+1,num_states],dtype=np.int64)
+    np.add.at(diff,(starts,event_states),1)
+    np.add.at(diff,(ends,event_states),-1)
+    state_counts = np.cumsum(diff[:-1],axis=0)
+
+    final_states = event_states[rep_offsets[1:] - 1].astype(np.int32)
+
+    trajectories = None
+    if store_trajectories:
+        trajectories = np.repeat(event_states.astype(np.uint8),ends - starts).reshape(repetitions,total_points)
+
+    return state_counts,final_states,trajectories
+
+
+def gillespie_on_grid(gillespie_events,init_state,rateMat,time_duration,dt,repetitions,store_trajectories=False,seed=None,
+        num_threads=None,antithetic=False,emission=None):
+    ''' monteCarlo_gillespie of an engine, given its gillespie_events. The jumps are simulated up to the last time point and
+    only resampled onto the dt grid for the read out. '''
+    schedule = as_schedule(rateMat,time_duration)
+    t_array,step_segment,segment_starts = schedule_grid(schedule,dt)
+    # Segment durations rounded to whole steps, so that the rates switch exactly where they do in monteCarlo
+    grid_durations = np.diff(t_array[np.append(segment_starts,len(t_array)-1)])
+    grid_schedule = [(duration,segment_rateMat) for duration,(_,segment_rateMat) in zip(grid_durations,schedule)]
+    events = gillespie_events(init_state,grid_schedule,None,repetitions,seed=seed,num_threads=num_threads,antithetic=antithetic,emission=emission)
+    rep_offsets,event_times,event_states = events[:3]
+    state_counts,final_states,trajectories = resample_events(t_array,rep_offsets,event_times,event_states,np.shape(schedule[0][1])[0],store_trajectories)
+    return (t_array,state_counts,final_states,trajectories) + tuple(events[3:]) # Tags are exact times
+
+
+def population_errors(state_counts,repetitions):
+    ''' Standard error of the mean populations. Each repetition contributes a one-hot indicator per time point, whose
+    second moment equals its mean, so the counts alone determine the (binomial) variance. '''
+    p = state_counts/float(repetitions)
+    return np.sqrt(p*(1-p)/repetitions)
@@ -0,0 +1,183 @@
+### Pure numpy population Monte Carlo
+# Fallback for pop_montecarlo_c on machines without a working Cython toolchain, with the same functions and signatures.
+# Instead of looping over repetitions, all repetitions are advanced together as a vector: one random number per repetition
+# per step decides both whether it jumps and where to (via searchsorted on the cumulative branching), so for large numbers
+# of repetitions it stays within a small factor of the compiled engine.
+# The random numbers come from numpy's generator, so runs are reproducible for a given seed but not identical to
+# pop_montecarlo_c. num_threads is accepted for compatibility and ignored.
+
+import numpy as np
+
+try: # Imported from the package (e.g. by monteCarlo_repumping)
+    from NVpop_monteCarlo.pop_montecarlo_common import _init_states,as_schedule,schedule_grid,_emission_weights,resample_events,gillespie_on_grid,population_errors
+except ImportError: # Imported from within this folder
+    from pop_montecarlo_common import _init_states,as_schedule,schedule_grid,_emission_weights,resample_events,gillespie_on_grid,population_errors
+
+
+def _rng_and_draw(seed,repetitions,antithetic):
+    ''' Generator and a function drawing one uniform per repetition. With antithetic, repetitions (2k, 2k+1) use u and 1-u '''
+    rng = np.random.RandomState(seed)
+    if not antithetic:
+        return rng,lambda: rng.random_sample(repetitions)
+
+    def draw():
+        u = np.empty(repetitions)
+        half = rng.random_sample((repetitions + 1)//2)
+        u[0::2] = half
+        u[1::2] = 1.0 - half[:repetitions//2]
+        return u
+    return rng,draw
+
+
+def _branching_tables(rateMats):
+    ''' Cumulative branching of each segment, flattened with row s offset by s, so that searchsorted(table, s + u) finds the
+    destination of a jump from state s for a uniform u '''
+    num_states = np.shape(rateMats)[1]
+    totals = np.sum(rateMats,axis=2)
+    cumulative = np.cumsum(rateMats,axis=2)/np.where(totals == 0.0,1.0,totals)[:,:,np.newaxis]
+    cumulative[:,:,-1] = 1.0
+    return (cumulative + np.arange(num_states)[np.newaxis,:,np.newaxis]).reshape(len(rateMats),-1)
+
+
+def _branch(table,states,u,num_states):
+    ''' Destination states of jumps from states for uniforms u (first state whose cumulative branching exceeds u) '''
+    return np.minimum(np.searchsorted(table,states + u,side='right') - states*num_states,num_states - 1).astype(np.intc)
+
+
+def _tags_to_stream(tag_reps,tag_times,repetitions):
+    ''' Per repetition offsets and times from tags collected in time order '''
+    tag_reps = np.concatenate(tag_reps) if len(tag_reps) else np.zeros(0,dtype=int)
+    tag_times = np.concatenate(tag_times) if len(tag_times) else np.zeros(0)
+    order = np.argsort(tag_reps,kind='mergesort') # Stable, so time order is kept within each repetition
+    tag_offsets = np.zeros(repetitions+1,dtype=np.int64)
+    tag_offsets[1:] = np.cumsum(np.bincount(tag_reps,minlength=repetitions))
+    return tag_offsets,tag_times[order]
+
+
+def monteCarlo(init_state,rateMat,time_duration,dt,repetitions,store_trajectories=False,seed=None,num_threads=None,antithetic=False,emission=None):
+    ''' Monte Carlo simulation of the population dynamics for transition rates rateMat[from,to] (or a schedule), with the
+    same arguments and returns as pop_montecarlo_c.monteCarlo '''
+
+    schedule = as_schedule(rateMat,time_duration)
+    states = _init_states(init_state,repetitions)
+    rng,draw = _rng_and_draw(seed,repetitions,antithetic)
+
+    rateMats = np.array([segment_rateMat for _,segment_rateMat in schedule],dtype=float)
+    t_array,step_segment,_ = schedule_grid(schedule,dt)
+    num_states = np.shape(rateMats)[1]
+    total_points = len(t_array)
+
+    if store_trajectories and num_states > 256:
+        raise ValueError("Too many states to store trajectories as uint8!")
+
+    probs = dt*np.sum(rateMats,axis=2)
+    tables = _branching_tables(rateMats)
+    weights = None if emission is None else _emission_weights(emission,rateMats)
+
+    if np.max(probs) > 0.8:
+        print('dt not small enough! Probably gonna mess up')
+        print('dt should be no bigger than %f' % (0.8*dt/np.max(probs)))
+
+    state_counts = np.zeros([total_points,num_states],dtype=np.int64)
+    trajectories = np.empty([repetitions,total_points],dtype=np.uint8) if store_trajectories else None
+    tag_reps,tag_times = [],[]
+
+    state_counts[0] = np.bincount(states,minlength=num_states)
+    if store_trajectories:
+        trajectories[:,0] = states
+
+    for ii in range(total_points - 1):
+        seg = step_segment[ii]
+        u = draw()
+        step_probs = probs[seg][states]
+        jumps = np.nonzero(u < step_probs)[0]
+        if len(jumps):
+            # Conditioned on jumping, u/prob is again uniform, so the same random number picks the branch
+            from_states = states[jumps]
+            to_states = _branch(tables[seg],from_states,u[jumps]/step_probs[jumps],num_states)
+            if weights is not None:
+                w = weights[seg][from_states,to_states]
+                tagged = (w >= 1.0) | (rng.random_sample(len(jumps)) < w)
+                tagged &= w > 0.0
+                tag_reps.append(jumps[tagged])
+                tag_times.append(np.full(np.count_nonzero(tagged),t_array[ii+1]))
+            states[jumps] = to_states
+
+        state_counts[ii+1] = np.bincount(states,minlength=num_states)
+        if store_trajectories:
+            trajectories[:,ii+1] = states
+
+    results = t_array,state_counts,states.astype(np.int32),trajectories
+    if emission is not None:
+        return results + (_tags_to_stream(tag_reps,tag_times,repetitions),)
+    return results
+
+
+def gillespie_events(init_state,rateMat,time_duration,repetitions,seed=None,num_threads=None,antithetic=False,emission=None):
+    ''' Exact continuous-time (Gillespie) simulation, with the same arguments and returns as pop_montecarlo_c.gillespie_events.
+    All repetitions still running make one jump (or segment change) per round. '''
+
+    schedule = as_schedule(rateMat,time_duration)
+    states = _init_states(init_state,repetitions)
+    rng,draw = _rng_and_draw(seed,repetitions,antithetic)
+
+    rateMats = np.array([segment_rateMat for _,segment_rateMat in schedule],dtype=float)
+    num_segments = len(schedule)
+    num_states = np.shape(rateMats)[1]
+    total_rates = np.sum(rateMats,axis=2)
+    tables = _branching_tables(rateMats)
+    segment_end_times = np.cumsum([duration for duration,_ in schedule]).astype(float)
+    weights = None if emission is None else _emission_weights(emission,rateMats)
+
+    t = np.zeros(repetitions)
+    seg = np.zeros(repetitions,dtype=int)
+    active = np.arange(repetitions)
+    event_reps,event_times,event_states = [active.copy()],[t.copy()],[states.copy()]
+    tag_reps,tag_times = [],[]
+
+    while len(active):
+        u_wait,u_branch = draw()[active],draw()[active]
+        rates = total_rates[seg[active],states[active]]
+        with np.errstate(divide='ignore'):
+            t_next = np.where(rates > 0,t[active] - np.log(1.0 - u_wait)/np.where(rates > 0,rates,1.0),np.inf)
+
+        # Waiting times that overrun a segment boundary are redrawn from the boundary, as the rates change there
+        overrun = t_next > segment_end_times[seg[active]]
+        moved = active[overrun]
+        t[moved] = segment_end_times[seg[moved]]
+        seg[moved] += 1
+
+        jumped = active[~overrun]
+        t[jumped] = t_next[~overrun]
+        from_states = states[jumped]
+        to_states = np.zeros(len(jumped),dtype=np.intc)
+        for s in np.unique(seg[jumped]):
+            in_seg = seg[jumped] == s
+            to_states[in_seg] = _branch(tables[s],from_states[in_seg],u_branch[~overrun][in_seg],num_states)
+
+        if weights is not None:
+            w = weights[seg[jumped],from_states,to_states]
+            tagged = ((w >= 1.0) | (rng.random_sample(len(jumped)) < w)) & (w > 0.0)
+            tag_reps.append(jumped[tagged])
+            tag_times.append(t[jumped[tagged]])
+
+        changed = to_states != from_states # Self transitions dont change anything
+        states[jumped[changed]] = to_states[changed]
+        event_reps.append(jumped[changed])
+        event_times.append(t[jumped[changed]])
+        event_states.append(to_states[changed])
+
+        active = active[seg[active] < num_segments]
+
+    rep_offsets,event_times_arr = _tags_to_stream(event_reps,event_times,repetitions)
+    order = np.argsort(np.concatenate(event_reps),kind='mergesort')
+    event_states_arr = np.concatenate(event_states)[order].astype(np.int32)
+
+    if emission is not None:
+        return rep_offsets,event_times_arr,event_states_arr,_tags_to_stream(tag_reps,tag_times,repetitions)
+    return rep_offsets,event_times_arr,event_states_arr
+
+
+def monteCarlo_gillespie(init_state,rateMat,time_duration,dt,repetitions,store_trajectories=False,seed=None,num_threads=None,antithetic=False,emission=None):
+    ''' Drop in replacement for monteCarlo using the exact event-driven engine, see pop_montecarlo_c.monteCarlo_gillespie '''
+    return gillespie_on_grid(gillespie_events,init_state,rateMat,time_duration,dt,repetitions,store_trajectories,seed,num_threads,antithetic,emission)
@@ -0,0 +1,222 @@
+### Deterministic population dynamics
+# Solves the classical master equation dp/dt = p Q for the same rateMat[from,to] interface as pop_montecarlo_c,
+# giving the exact mean populations that the Monte Carlo engines estimate by sampling.
+# Also answers the usual questions about a rate model directly by linear algebra: steady states, first passage time
+# distributions into a set of target states, and expected photon (or any transition) counts.
+
+import math
+import numpy as np
+import scipy.linalg
+import scipy.optimize
+
+try: # Imported from the package (e.g. by monteCarlo_repumping)
+    from NVpop_monteCarlo.pop_montecarlo_common import as_schedule,schedule_grid
+except ImportError: # Imported from within this folder
+    from pop_montecarlo_common import as_schedule,schedule_grid
+
+
+def generator(rateMat):
+    ''' Generator Q of the master equation dp/dt = p Q (p a row vector of populations) for transition rates rateMat[from,to] '''
+    rateMat = np.asarray(rateMat,dtype=float)
+    Q = rateMat.copy()
+    Q[np.diag_indices_from(Q)] -= np.sum(rateMat,axis=1)
+    return Q
+
+
+def transfer_matrix(rateMat,dt):
+    ''' Population transfer matrix over a time dt, so that p(t+dt) = p(t) . transfer_matrix(rateMat,dt) '''
+    return scipy.linalg.expm(dt*generator(rateMat))
+
+
+def init_populations(init_state,num_states):
+    ''' Population vector for an initial state given as a state index or, as for the Monte Carlo engines, a state per repetition '''
+    init_state = np.asarray(init_state,dtype=int).ravel()
+    return np.bincount(init_state,minlength=num_states)/float(len(init_state))
+
+
+def propagate(init_pops,rateMat,time_duration,dt):
+    ''' Propagate the populations init_pops on the same time grid as the Monte Carlo engines.
+    rateMat can also be a schedule of (duration, rateMat) segments (time_duration is then ignored), each rounded up to
+    whole steps of dt (see pop_montecarlo_common.schedule_grid).
+    The transfer matrix for one step is calculated once per segment and reused for every step.
+    Returns t_array and the populations (points x states). '''
+    schedule = as_schedule(rateMat,time_duration)
+    t_array,step_segment,_ = schedule_grid(schedule,dt)
+    steps = [transfer_matrix(segment_rateMat,dt) for _,segment_rateMat in schedule]
+
+    populations = np.empty([len(t_array),len(init_pops)])
+    populations[0] = init_pops
+    for ii in range(1,len(t_array)):
+        populations[ii] = np.dot(populations[ii-1],steps[step_segment[ii-1]])
+
+    return t_array,populations
+
+
+def transfer_matrix_sensitivities(rateMat,dRateMats,dt):
+    ''' Transfer matrix over dt and its derivatives with respect to parameters, for dRateMats[k] = d rateMat/d theta_k.
+    Uses Van Loan's block matrix exponential, expm([[Q, dQ], [0, Q]] dt) = [[E, dE], [0, E]], where dQ = generator(dRateMat)
+    as the generator is linear in the rates. '''
+    Q = generator(rateMat)
+    n = len(Q)
+    block = np.zeros([2*n,2*n])
+    block[:n,:n] = Q
+    block[n:,n:] = Q
+    dEs = []
+    for dRateMat in dRateMats:
+        block[:n,n:] = generator(dRateMat)
+        dEs.append(scipy.linalg.expm(dt*block)[:n,n:])
+    return scipy.linalg.expm(dt*Q),np.array(dEs).reshape(len(dRateMats),n,n)
+
+
+def propagate_sensitivities(init_pops,schedule,dt,dSchedule):
+    ''' As propagate for a schedule, also propagating the derivatives of the populations with respect to parameters.
+    dSchedule[seg][k] is the derivative of the rateMat of segment seg with respect to parameter k (init_pops are fixed).
+    Returns t_array, the populations (points x states) and their sensitivities (parameters x points x states). '''
+    num_params = len(dSchedule[0])
+    schedule = as_schedule(schedule)
+    t_array,step_segment,_ = schedule_grid(schedule,dt)
+    steps = [transfer_matrix_sensitivities(segment_rateMat,dRateMats,dt) for (_,segment_rateMat),dRateMats in zip(schedule,dSchedule)]
+
+    populations = np.empty([len(t_array),len(init_pops)])
+    sensitivities = np.zeros([num_params,len(t_array),len(init_pops)])
+    populations[0] = init_pops
+    for ii in range(1,len(t_array)):
+        step,dSteps = steps[step_segment[ii-1]]
+        populations[ii] = np.dot(populations[ii-1],step)
+        # d(p E) = dp E + p dE
+        sensitivities[:,ii] = np.dot(sensitivities[:,ii-1],step) + np.dot(dSteps.transpose(0,2,1),populations[ii-1])
+
+    return t_array,populations,sensitivities
+
+
+### Steady states, first passage times and counts
+
+def steady_state(rateMat,init_pops=None):
+    ''' Long time limit of the populations. If the chain has more than one closed class of states (e.g. several absorbing
+    states) the limit depends on where it starts, so init_pops is needed '''
+    Q = generator(rateMat)
+    left = scipy.linalg.null_space(Q.T) # Stationary distributions of the closed classes
+    if np.shape(left)[1] == 1:
+        return left[:,0]/np.sum(left[:,0])
+    if init_pops is None:
+        raise ValueError('Steady state is not unique, specify init_pops')
+    right = scipy.linalg.null_space(Q) # Absorption probabilities into the closed classes
+    projector = np.dot(right,np.linalg.solve(np.dot(left.T,right),left.T))
+    return np.dot(init_pops,projector)
+
+
+def emission_rates(rateMat,emission):
+    ''' Per state rate of the counted transitions. emission is either already per state rates, or a [from,to] mask (or
+    weights) of the transitions to count in rateMat, e.g. the radiative decays for photon counts '''
+    emission = np.asarray(emission,dtype=float)
+    if np.ndim(emission) == 2:
+        return np.sum(np.asarray(rateMat,dtype=float)*emission,axis=1)
+    return emission
+
+
+def expected_counts(rateMat,init_pops,time_duration,emission):
+    ''' Expected number of counted transitions (see emission_rates) in [0, time_duration], the integral of p(t).r, using
+    expm([[Q, 1], [0, 0]] T) whose top right block is the integral of expm(Q t) '''
+    Q = generator(rateMat)
+    n = len(Q)
+    block = np.zeros([2*n,2*n])
+    block[:n,:n] = Q
+    block[:n,n:] = np.eye(n)
+    integral = scipy.linalg.expm(time_duration*block)[:n,n:]
+    return np.dot(np.dot(init_pops,integral),emission_rates(rateMat,emission))
+
+
+def steady_state_count_rate(rateMat,emission,init_pops=None):
+    ''' Rate of counted transitions (see emission_rates) in the steady state '''
+    return np.dot(steady_state(rateMat,init_pops),emission_rates(rateMat,emission))
+
+
+def _transient(rateMat,targets,init_pops):
+    ''' Sub generator of the states outside targets, and the initial populations in them '''
+    Q = generator(rateMat)
+    transient = np.setdiff1d(np.arange(len(Q)),targets)
+    return Q[np.ix_(transient,transient)],np.asarray(init_pops,dtype=float)[transient],transient
+
+
+def absorption_probability(rateMat,targets,init_pops):
+    ''' Probability of ever reaching targets '''
+    Q_T,p_T,transient = _transient(rateMat,targets,init_pops)
+    exit_rates = -np.sum(Q_T,axis=1) # Total rate out of the transient states (into targets)
+    # States that cannot reach targets make Q_T singular, solve on the rest only
+    reach = _can_reach(Q_T,exit_rates)
+    absorbed = np.zeros(len(transient))
+    if np.any(reach):
+        absorbed[reach] = np.linalg.solve(-Q_T[np.ix_(reach,reach)],exit_rates[reach])
+    return 1.0 - np.sum(p_T) + np.dot(p_T,absorbed)
+
+
+def _can_reach(Q_T,exit_rates):
+    ''' Transient states from which the targets can be reached '''
+    reach = exit_rates > 0
+    while True:
+        new_reach = reach | np.any((Q_T > 0) & reach[np.newaxis,:],axis=1)
+        if np.all(new_reach == reach):
+            return reach
+        reach = new_reach
+
+
+def first_passage_moments(rateMat,targets,init_pops,orders=2):
+    ''' Moments E[T^k], k = 1..orders, of the time T to first reach targets. Infinite if targets might never be reached '''
+    if absorption_probability(rateMat,targets,init_pops) < 1 - 1e-12:
+        return np.inf*np.ones(orders)
+    Q_T,p_T,transient = _transient(rateMat,targets,init_pops)
+    reach = _can_reach(Q_T,-np.sum(Q_T,axis=1)) # Only these are ever occupied, the others would make Q_T singular
+    Q_T,p_T = Q_T[np.ix_(reach,reach)],p_T[reach]
+
+    # E[T^k] = k! p (-Q_T)^-k 1
+    moments = []
+    vec = np.ones(len(p_T))
+    for k in range(1,orders+1):
+        vec = np.linalg.solve(-Q_T,vec)
+        moments.append(math.factorial(k)*np.dot(p_T,vec))
+    return np.array(moments)
+
+
+def first_passage_cdf(rateMat,targets,init_pops,t_array):
+    ''' Probability of having reached targets by each time in t_array (sorted) '''
+    Q_T,p_T,transient = _transient(rateMat,targets,init_pops)
+    survival = np.empty(len(t_array))
+    p = p_T
+    t_prev = 0.0
+    for ii,t in enumerate(t_array):
+        p = np.dot(p,scipy.linalg.expm((t - t_prev)*Q_T))
+        t_prev = t
+        survival[ii] = np.sum(p)
+    return 1.0 - survival
+
+
+def first_passage_density(rateMat,targets,init_pops,t_array):
+    ''' Probability density of the time to first reach targets at each time in t_array (sorted). Does not include the
+    initial population already in targets '''
+    Q_T,p_T,transient = _transient(rateMat,targets,init_pops)
+    exit_rates = -np.sum(Q_T,axis=1)
+    density = np.empty(len(t_array))
+    p = p_T
+    t_prev = 0.0
+    for ii,t in enumerate(t_array):
+        p = np.dot(p,scipy.linalg.expm((t - t_prev)*Q_T))
+        t_prev = t
+        density[ii] = np.dot(p,exit_rates)
+    return density
+
+
+def first_passage_quantile(rateMat,targets,init_pops,quantile):
+    ''' Time by which targets have been reached with probability quantile (e.g. 0.99) '''
+    if quantile >= absorption_probability(rateMat,targets,init_pops):
+        return np.inf
+    cdf = lambda t: first_passage_cdf(rateMat,targets,init_pops,[t])[0] - quantile
+    if cdf(0.0) >= 0:
+        return 0.0
+
+    # Bracket the quantile, starting from the slowest relaxation time of the transient states
+    Q_T,_,_ = _transient(rateMat,targets,init_pops)
+    reach = _can_reach(Q_T,-np.sum(Q_T,axis=1))
+    t_max = 1.0/np.min(np.abs(np.linalg.eigvals(Q_T[np.ix_(reach,reach)])))
+    while cdf(t_max) < 0:
+        t_max *= 2
+    return scipy.optimize.brentq(cdf,0.0,t_max,xtol=1e-12*t_max)
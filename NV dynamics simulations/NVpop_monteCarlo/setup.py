@@ -1,10 +1,16 @@
-from distutils.core import setup, Extension
+from setuptools import setup, Extension
 from Cython.Build import cythonize
 import numpy
+import sys
+
+# The repetition loops run in parallel with OpenMP
+openmp_flags = ['/openmp'] if sys.platform == 'win32' else ['-fopenmp']
+
+extension = Extension("pop_montecarlo_c", ["pop_montecarlo_c.pyx"],
+    include_dirs=[numpy.get_include()],
+    extra_compile_args=openmp_flags,
+    extra_link_args=openmp_flags if sys.platform != 'win32' else [])
 
-import os
-print os.getcwd()
 setup(
-    ext_modules=cythonize("pop_montecarlo_c.pyx"),
-    include_dirs=[numpy.get_include()]
-)    
\ No newline at end of file
+    ext_modules=cythonize([extension]),
+)
@@ -2,7 +2,7 @@
 # Peter Humphreys 2017
 # This file contains Monte carlo code for simulating the repump dynamics of the NV centre. This includes the different relevant ground and excited states of the NV, as well as the singlet state (which is modelled here as a single level)
 # Note that this code does not include coherent quantum dynamics
-# Uses a general cython code written for fast simulation of population dynamics of a system (pop_montecarlo_c)
+# Uses a general cython code written for fast simulation of population dynamics of a system (pop_montecarlo_c), or its pure numpy equivalent (pop_montecarlo_np) if the cython code has not been built
 
 # The simulated levels are:
 
@@ -14,7 +14,18 @@
 # | E2 | excited state |
 
 ### imports
+from __future__ import print_function
+
+# Make the reload function available for all different python versions.
+try:
+    reload  # Python 2.7
+except NameError:
+    from importlib import reload  # Python 3.4+
+
 import numpy as np
+import re
+import time
+import scipy.optimize
 from matplotlib import pyplot as plt
 # Need to get hold of the NV population Monte Carlo module, which lives in the parent folder of the folder of this file
 import os,sys,inspect
@@ -22,7 +33,15 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir) 
 
-import NVpop_monteCarlo.pop_montecarlo_c as pmc; reload(pmc)
+try:
+    import NVpop_monteCarlo.pop_montecarlo_c as pmc; reload(pmc)
+except ImportError: # Compiled extension not built, fall back on the pure numpy engine
+    import NVpop_monteCarlo.pop_montecarlo_np as pmc; reload(pmc)
+import NVpop_monteCarlo.rate_equations as rate_eq; reload(rate_eq)
+import NVpop_monteCarlo.photon_statistics as photon_stats; reload(photon_stats)
+# The streaming statistics are shared with the NV-carbon code, which lives next to the parent folder
+sys.path.insert(0,os.path.join(parentdir,os.pardir,'NV-carbon coupling code'))
+import streaming_stats; reload(streaming_stats)
 
 class repumpingMonteCarlo():
 
@@ -31,40 +50,351 @@ class repumpingMonteCarlo():
         self.time_duration = 1000
         self.dt = 1.0
         self.repetitions = 1000
+        self.store_trajectories = False # Keep the full (repetitions x points) state trajectories in raw_pops
+        self.seed = None # Set for reproducible runs
+        self.num_threads = None # Defaults to all cores
+        self.antithetic = False # Pair up repetitions with antithetic random numbers (u and 1-u)
 
         self.num_states = 6
         self.init_default_branching()
 
-        self.monteCarlo = pmc.monteCarlo
+        self.monteCarlo = pmc.monteCarlo # Or pmc.monteCarlo_gillespie for the exact event-driven engine (exact for any dt)
+        self.solver = 'monte_carlo' # Or 'master_equation' for exact mean populations (no trajectories)
 
     def run(self,**kw):
+        target_error,max_time = kw.pop('target_error',None),kw.pop('max_time',None)
+        if target_error is None and max_time is None:
+            self.simulate()
+        else: # Batches of self.repetitions until the population errors reach target_error or max_time (s) runs out
+            for result in self.simulate_batches(target_error=target_error,max_time=max_time):
+                pass
+            print('%d repetitions, largest population error %f' % (result['repetitions'],result['max_error']))
+        self.plot_populations(**kw)
+
+    def simulate(self):
 
         if not isinstance(self.init_state, (np.ndarray)): # Can specify initial state using only an index, but pmc wants an array (so that can specify per rep)
             init_state = np.array([self.init_state],dtype=np.intc)
+        else:
+            init_state = self.init_state
 
         self.rateMat = self.repumping_rateMat().copy(order='C')
-        
-        if self.drive_time and self.drive_time < self.time_duration: # If drive time specified
-
-            self.no_drive_RateMat = self.repumping_rateMat(drive = False).copy(order='C')
-
-            # First do bit with drive
-            drive_t_array,drive_populations,drive_raw_pops  = self.monteCarlo(init_state,self.rateMat,self.drive_time,self.dt,self.repetitions)
-            # Then add on bit with no drive (tracking where the state is)!
-            no_drive_t_array,no_drive_populations,no_drive_raw_pops  = self.monteCarlo(drive_raw_pops[:,-1].astype(np.intc).copy(order='C'),self.no_drive_RateMat,(self.time_duration - self.drive_time),self.dt,self.repetitions)
-            
-            #Stick it all together
-            self.t_array = np.concatenate((drive_t_array,drive_t_array[-1]+no_drive_t_array[1:]))
-            self.populations = np.concatenate((drive_populations,no_drive_populations[:,1:,:]),axis=1)
-            self.raw_pops = np.concatenate((drive_raw_pops,no_drive_raw_pops[:,1:]),axis=1)
-
+        self.no_drive_RateMat = self.repumping_rateMat(drive = False).copy(order='C')
+        schedule = self.repumping_schedule()
+
+        if self.solver == 'master_equation': # Exact mean populations, expected counts for self.repetitions
+            self.t_array,self.mean_populations = rate_eq.propagate(rate_eq.init_populations(init_state,self.num_states),schedule,None,self.dt)
+            self.state_counts = self.mean_populations*self.repetitions
+            self.raw_pops = None
+            self.population_errors = np.zeros_like(self.mean_populations)
+        elif self.solver == 'monte_carlo':
+            self.t_array,self.state_counts,final_states,self.raw_pops = self.monteCarlo(init_state,schedule,None,self.dt,self.repetitions,
+                store_trajectories=self.store_trajectories,seed=self.seed,num_threads=self.num_threads,antithetic=self.antithetic)
+            self.mean_populations = self.state_counts/float(self.repetitions)
+            self.population_errors = pmc.population_errors(self.state_counts,self.repetitions)
         else:
-            self.t_array,self.populations,self.raw_pops = self.monteCarlo(init_state,self.rateMat,self.time_duration,self.dt,self.repetitions)
+            raise ValueError('Unknown solver %s' % self.solver)
 
-        self.mean_populations = np.mean(self.populations,axis = 0)
         self.correct_for_singlet_decay()
 
-        self.plot_populations(**kw)
+    def simulate_batches(self,target_error=None,max_time=None,max_batches=None,states=None,min_batches=3,seed=None):
+        ''' Generator running batches of self.repetitions (each with its own seed) until the standard error of the mean
+        populations (from the spread of the batch means, so also valid with antithetic) is at most target_error for every
+        point and the given states (default all), max_time (s) has passed or max_batches are done. Without any of these it
+        runs until the caller stops iterating. The error is only trusted from min_batches batches on.
+        After each batch yields a dict of the batches and repetitions so far, the running mean populations and their errors,
+        the largest error, the elapsed time and whether target_error was reached, and sets the results as simulate does '''
+
+        if self.solver != 'monte_carlo':
+            raise ValueError('Adaptive runs need the monte_carlo solver')
+        if seed is None:
+            seed = self.seed if self.seed is not None else np.random.randint(0,2**31-1)
+        states = slice(None) if states is None else states
+
+        original_seed = self.seed
+        stats = streaming_stats.running_stats()
+        start = time.time()
+        try:
+            while True:
+                self.seed = seed + stats.count
+                self.simulate()
+                stats.add([self.mean_populations])
+
+                errors = stats.std_error()
+                max_error = np.max(errors[:,states])
+                elapsed = time.time() - start
+                converged = target_error is not None and stats.count >= min_batches and max_error <= target_error
+
+                self.mean_populations = stats.mean
+                self.population_errors = errors
+                self.state_counts = stats.mean*self.repetitions*stats.count
+                yield {'batches' : stats.count,
+                       'repetitions' : stats.count*self.repetitions,
+                       't_array' : self.t_array,
+                       'mean_populations' : stats.mean,
+                       'population_errors' : errors,
+                       'max_error' : max_error,
+                       'elapsed' : elapsed,
+                       'converged' : converged}
+
+                if converged or (max_time is not None and elapsed >= max_time) or (max_batches is not None and stats.count >= max_batches):
+                    return
+        finally:
+            self.seed = original_seed
+
+    def parameter_sweep(self,param,values,batches=10,control_variate=False,seed=None):
+        ''' Simulate each value of the parameter param (e.g. 'drive', 'S_lifetime' or 'S_branching[2]') using common random
+        numbers: every value sees the same random numbers repetition by repetition, so the differences between values are far
+        less noisy than the values themselves. The errors come from the spread over batches (each with its own seed).
+        With control_variate, the first value is treated as a baseline whose exact mean (from the master equation) is known,
+        and its Monte Carlo error is used to correct the estimates at all values.
+        Returns a dict of the mean populations (values x points x states), their differences between neighbouring values,
+        and the errors of both, along with the difference errors that independent runs would have given. '''
+
+        if self.solver != 'monte_carlo':
+            raise ValueError('Parameter sweeps need the monte_carlo solver')
+        if batches < 2:
+            raise ValueError('Need at least two batches to estimate errors')
+        if seed is None:
+            seed = self.seed if self.seed is not None else np.random.randint(0,2**31-1)
+
+        original_value,original_seed = self.get_param(param),self.seed
+        estimates = []
+        try:
+            for batch in range(batches):
+                self.seed = seed + batch
+                batch_estimates = []
+                for value in values:
+                    self.set_param(param,value)
+                    self.simulate()
+                    batch_estimates.append(self.mean_populations)
+                estimates.append(batch_estimates)
+
+            if control_variate:
+                self.set_param(param,values[0])
+                self.solver = 'master_equation'
+                self.simulate()
+                baseline_exact = self.mean_populations
+        finally:
+            self.set_param(param,original_value)
+            self.seed = original_seed
+            self.solver = 'monte_carlo'
+
+        estimates = np.array(estimates) # batches x values x points x states
+        raw_errors = np.std(estimates,axis=0,ddof=1)/np.sqrt(batches)
+
+        if control_variate:
+            # Optimal coefficient per value, point and state, estimated from the batches
+            control = estimates[:,0] - baseline_exact
+            control_var = np.var(control,axis=0,ddof=1)
+            cov = np.sum((estimates - np.mean(estimates,axis=0))*(control - np.mean(control,axis=0))[:,np.newaxis],axis=0)/(batches - 1)
+            beta = np.where(control_var > 0,cov/np.where(control_var > 0,control_var,1.0),0.0)
+            estimates = estimates - beta*control[:,np.newaxis]
+
+        differences = estimates[:,1:] - estimates[:,:-1]
+
+        return {'values' : values,
+                't_array' : self.t_array,
+                'mean_populations' : np.mean(estimates,axis=0),
+                'population_errors' : np.std(estimates,axis=0,ddof=1)/np.sqrt(batches),
+                'differences' : np.mean(differences,axis=0),
+                'difference_errors' : np.std(differences,axis=0,ddof=1)/np.sqrt(batches),
+                'independent_difference_errors' : np.sqrt(raw_errors[1:]**2 + raw_errors[:-1]**2)}
+
+    def photon_emission(self,schedule):
+        ''' Probability that each transition [from,to] emits a photon, per schedule segment: the spontaneous share of the
+        E1/E2 decays to the ground states (the rest is stimulated by the drive) '''
+        spontaneous = np.zeros([self.num_states,self.num_states])
+        spontaneous[4,:3] = self.E1_branching[:3]/self.E1_lifetime
+        spontaneous[5,:3] = self.E2_branching[:3]/self.E2_lifetime
+        return np.array([np.where(rateMat > 0,spontaneous/np.where(rateMat > 0,rateMat,1.0),0.0) for _,rateMat in schedule])
+
+    def photon_statistics(self,chunks=10,window=(0.0,np.inf),bin_width=1.0,max_tau=100.0,max_counts=20):
+        ''' Photon counts per repetition in window and g2(tau), from chunks runs of self.repetitions each, streamed into the
+        histograms so that the tags of only one chunk are in memory at a time. Returns the count_histogram and g2_histogram '''
+        self.rateMat = self.repumping_rateMat().copy(order='C')
+        self.no_drive_RateMat = self.repumping_rateMat(drive = False).copy(order='C')
+        schedule = self.repumping_schedule()
+        emission = self.photon_emission(schedule)
+        init_state = self.init_state if isinstance(self.init_state,np.ndarray) else np.array([self.init_state],dtype=np.intc)
+        seed = self.seed if self.seed is not None else np.random.randint(0,2**31-1)
+
+        counts = photon_stats.count_histogram(window[0],window[1],max_counts)
+        g2 = photon_stats.g2_histogram(bin_width,max_tau)
+        for chunk in range(chunks):
+            tags = self.monteCarlo(init_state,schedule,None,self.dt,self.repetitions,seed=seed + chunk,
+                num_threads=self.num_threads,antithetic=self.antithetic,emission=emission)[4]
+            counts.add(*tags)
+            g2.add(*tags)
+        return counts,g2
+
+    def init_populations(self):
+        init_state = self.init_state if isinstance(self.init_state,np.ndarray) else [self.init_state]
+        return rate_eq.init_populations(init_state,self.num_states)
+
+    def repump_time(self,quantile=0.99,target_states=None):
+        ''' Time under continuous drive by which the NV has been pumped into target_states (default Z) with probability quantile '''
+        target_states = [2] if target_states is None else target_states
+        return rate_eq.first_passage_quantile(self.repumping_rateMat(),target_states,self.init_populations(),quantile)
+
+    def steady_state_populations(self,drive=True):
+        ''' Long time limit of the populations with or without drive '''
+        return rate_eq.steady_state(self.repumping_rateMat(drive = drive),self.init_populations())
+
+    def get_param(self,name):
+        ''' Value of a model parameter, either an attribute or an element of an array attribute, e.g. 'S_branching[2]' '''
+        match = re.match(r'(\w+)\[(\d+)\]$',name)
+        if match:
+            return getattr(self,match.group(1))[int(match.group(2))]
+        return getattr(self,name)
+
+    def set_param(self,name,value):
+        ''' Set a model parameter (see get_param). Setting one element of a branching keeps it normalised, by scaling the other
+        elements so that their relative weights are unchanged '''
+        match = re.match(r'(\w+)\[(\d+)\]$',name)
+        if not match:
+            setattr(self,name,value)
+            return
+        attr,ind = match.group(1),int(match.group(2))
+        arr = np.array(getattr(self,attr),dtype=float)
+        if attr.endswith('_branching'):
+            others = np.arange(len(arr)) != ind
+            if np.sum(arr[others]) > 0:
+                arr[others] *= (1.0 - value)/np.sum(arr[others])
+        arr[ind] = value
+        setattr(self,attr,arr)
+
+    def photon_rates(self):
+        ''' Rate of spontaneous photon emission (E1/E2 decay to the ground states) from each state '''
+        rates = np.zeros(self.num_states)
+        rates[4] = np.sum(self.E1_branching[:3])/self.E1_lifetime
+        rates[5] = np.sum(self.E2_branching[:3])/self.E2_lifetime
+        return rates
+
+    def rate_model(self,t_data,observable='populations',states=None,params=None,ties=None):
+        ''' Deterministic forward model on the times t_data, with its derivatives with respect to params.
+        observable is 'populations' (of states, default all) or 'fluorescence', the photon emission rate scaled by
+        fluorescence_scale plus fluorescence_background.
+        ties map a parameter to the name of the parameter it equals, or a function of the model that gives its value; they
+        are applied on top of params, and included in the derivatives.
+        Returns the model (times x states, or times) and derivatives (params x model shape). '''
+        params = [] if params is None else list(params)
+        ties = {} if ties is None else dict(ties)
+
+        def evaluate():
+            for tied,source in ties.items():
+                self.set_param(tied,source(self) if callable(source) else self.get_param(source))
+            self.rateMat = self.repumping_rateMat().copy(order='C')
+            self.no_drive_RateMat = self.repumping_rateMat(drive = False).copy(order='C')
+            return (np.array([rateMat for _,rateMat in self.repumping_schedule()]),self.photon_rates(),
+                self.fluorescence_scale,self.fluorescence_background)
+
+        rateMats,photon_rates,scale,background = evaluate()
+        schedule = self.repumping_schedule()
+
+        # The rates depend on the parameters through the lifetimes and the branching normalisation, so take derivatives
+        # numerically (central differences), the populations then follow exactly from the sensitivity equations
+        derivs = []
+        for param in params:
+            value = self.get_param(param)
+            h = 1e-6*max(abs(value),1e-3)
+            self.set_param(param,value + h)
+            plus = evaluate()
+            self.set_param(param,value - h)
+            minus = evaluate()
+            self.set_param(param,value)
+            derivs.append([(p - m)/(2*h) for p,m in zip(plus,minus)])
+        evaluate()
+
+        init_pops = self.init_populations()
+        dSchedule = [[deriv[0][seg] for deriv in derivs] for seg in range(len(schedule))]
+        t_array,pops,sens = rate_eq.propagate_sensitivities(init_pops,schedule,self.dt,dSchedule)
+
+        interp = lambda y: np.array([np.interp(t_data,t_array,col) for col in np.atleast_2d(y.T)]).T
+        pops = interp(pops)
+        sens = np.array([interp(sen) for sen in sens]).reshape(len(params),len(t_data),self.num_states)
+
+        if observable == 'populations':
+            states = range(self.num_states) if states is None else states
+            return pops[:,states],sens[:,:,states]
+        elif observable == 'fluorescence':
+            emission = np.dot(pops,photon_rates)
+            model = scale*emission + background
+            jac = np.array([scale*(np.dot(sen,photon_rates) + np.dot(pops,deriv[1])) + deriv[2]*emission + deriv[3]
+                for sen,deriv in zip(sens,derivs)]).reshape(len(params),len(t_data))
+            return model,jac
+        raise ValueError('Unknown observable %s' % observable)
+
+    def fit_rate_model(self,t_data,data,params,observable='populations',states=None,sigma=None,bounds=None,ties=None,plot=True):
+        ''' Least squares fit of the model parameters params (see get_param) to measured population or fluorescence traces
+        data on the times t_data (see rate_model for observable, states and ties), with optional bounds {param : (lo, hi)}.
+        sigma are the data uncertainties, if not given they are estimated from the residuals.
+        The fitted values are left set on the model. Returns a dict of the fitted values, their errors and covariance. '''
+
+        bounds = {} if bounds is None else bounds
+        data = np.asarray(data,dtype=float)
+        sigma_known = sigma is not None
+        sigma = np.ones_like(data) if sigma is None else np.asarray(sigma,dtype=float)*np.ones_like(data)
+        lower = np.array([bounds.get(param,(-np.inf,np.inf))[0] for param in params],dtype=float)
+        upper = np.array([bounds.get(param,(-np.inf,np.inf))[1] for param in params],dtype=float)
+        x0 = np.clip([self.get_param(param) for param in params],lower,upper)
+
+        def set_params(x):
+            for param,value in zip(params,x):
+                self.set_param(param,value)
+
+        def residuals(x):
+            set_params(x)
+            model,_ = self.rate_model(t_data,observable,states,ties=ties)
+            return ((model - data)/sigma).ravel()
+
+        def jacobian(x):
+            set_params(x)
+            _,jac = self.rate_model(t_data,observable,states,params,ties)
+            return (jac/sigma).reshape(len(params),-1).T
+
+        original = [self.get_param(param) for param in params]
+        try:
+            result = scipy.optimize.least_squares(residuals,x0,jac=jacobian,bounds=(lower,upper),x_scale='jac')
+        except Exception:
+            set_params(original)
+            raise
+        set_params(result.x)
+        self.rate_model(t_data,observable,states,ties=ties) # Leave the tied parameters consistent
+
+        # Covariance from the Jacobian at the optimum, scaled by the reduced chi squared if the data errors are unknown
+        jac = result.jac
+        cov = np.linalg.pinv(np.dot(jac.T,jac))
+        dof = max(data.size - len(params),1)
+        if not sigma_known:
+            cov *= 2*result.cost/dof
+        fit = {'params' : dict(zip(params,result.x)),
+                'errors' : dict(zip(params,np.sqrt(np.diag(cov)))),
+                'covariance' : cov,
+                'reduced_chi2' : 2*result.cost/dof,
+                'result' : result}
+
+        if plot:
+            model,_ = self.rate_model(t_data,observable,states,ties=ties)
+            plt.figure()
+            plt.xlabel('Time (ns)')
+            plt.ylabel('Population' if observable == 'populations' else 'Fluorescence')
+            plt.plot(t_data,data,'.')
+            plt.gca().set_prop_cycle(None)
+            plt.plot(t_data,model,'-')
+            plt.show()
+            plt.close()
+
+        return fit
+
+    def repumping_schedule(self):
+        ''' (duration, rateMat) segments for the whole run, from drive_schedule or drive_time '''
+        if self.drive_schedule is not None:
+            return [(duration,self.rateMat if drive else self.no_drive_RateMat) for duration,drive in self.drive_schedule]
+        elif self.drive_time and self.drive_time < self.time_duration: # If drive time specified
+            return [(self.drive_time,self.rateMat),(self.time_duration - self.drive_time,self.no_drive_RateMat)]
+        else:
+            return [(self.time_duration,self.rateMat)]
 
     def init_default_branching(self):
 
@@ -72,7 +402,10 @@ class repumpingMonteCarlo():
         self.S_lifetime = 300.0
         self.drive = 0.2
         self.drive_time = False
+        self.drive_schedule = None # Optional list of (duration, drive on) segments, e.g. a pulse train. Overrides drive_time and time_duration
         self.drive_branching = normalized([1,0])
+        self.fluorescence_scale = 1.0 # Detection efficiency for fluorescence fits
+        self.fluorescence_background = 0.0
 
         E1_branching_raw = np.array([1.0,0.0,0.0,0.7,0.0,0.0])
         E2_branching_raw = np.array([0.0,1.0,0.0,0.7,0.0,0.0])
@@ -140,8 +473,8 @@ class repumpingMonteCarlo():
 
         if print_end_pops:
 
-            print 'Final pops before decay from singlet: ', np.around(pops_to_plot[-1],3)
-            print 'Final pops after decay from singlet: ', np.around(pops_after_decay[-1],3)
+            print('Final pops before decay from singlet: ', np.around(pops_to_plot[-1],3))
+            print('Final pops after decay from singlet: ', np.around(pops_after_decay[-1],3))
 
         if invert_Z:
             pops_to_plot[:,2] = 1-pops_to_plot[:,2]
@@ -0,0 +1,168 @@
+### Nuclear spin dephasing during repeated repumping / entanglement attempts
+# Connects the incoherent repumping model (monteCarlo_repumping) to the carbon spins of electron_nuclear_sim.
+# Each carbon precesses at a frequency set by the electron spin projection ms, so the random time the electron spends in
+# each state during an attempt imprints a random phase on the carbon, which dephases it over many attempts.
+# Phases are taken relative to precession with the electron in reference_state (ms = 0 by default). Only the phase is
+# kept, i.e. the tilt of the ms = +-1 precession axes by A_perp is neglected (the usual pure dephasing picture).
+#
+# Single attempts are sampled with the exact event-driven engine (pmc.gillespie_events) from every electron state.
+# As consecutive attempts only depend on each other through the electron state they hand over, the coherence after n
+# attempts follows from the (states x states) transfer matrix of one attempt, weighted by exp(i phase), to the nth power.
+# This is exact for the sampled attempts and costs nothing extra for 10^5 attempts. Individual trajectories of many
+# attempts can also be built by resampling the single attempts (trajectory_phases), e.g. for the phase distribution.
+# The rate model has no coherent electron control, so the electron initialisation of each attempt (e.g. a microwave pulse
+# taking ms = 0 to an equal superposition with ms = -1) is given as a preparation matrix prep[from,to] of probabilities,
+# applied to the electron state at the start of every attempt.
+
+from __future__ import print_function
+
+import numpy as np
+import monteCarlo_repumping as mcr
+
+STATE_MS = [1,-1,0,0,1,-1] # ms setting the carbon precession in each of P, M, Z, S, E1, E2 (the singlet has no spin)
+
+
+def precession_freqs(NV_system,state_ms=STATE_MS):
+    ''' Carbon precession frequencies (states x carbons, rad/s) for the electron in each state of the repumping model.
+    The ms = 0 and ms = sign (the driven electron transition) frequencies are those of NV_system.c_prec_freqs, the other
+    ms = +-1 frequency follows from NV_system.carbon_params '''
+    freqs = np.empty([len(state_ms),len(NV_system.c_prec_freqs)])
+    for i,(omega0,omega1,_) in enumerate(NV_system.c_prec_freqs):
+        omega_B,A_par,A_perp = NV_system.carbon_params[i]
+        for s,ms in enumerate(state_ms):
+            if ms == 0:
+                freqs[s,i] = omega0
+            elif ms == NV_system.sign:
+                freqs[s,i] = omega1
+            else:
+                freqs[s,i] = np.sqrt((omega_B + ms*A_par)**2 + A_perp**2)
+    return freqs
+
+
+def attempt_samples(rmc,freqs,repetitions=10000,reference_state=2,time_unit=1e-9,seed=None):
+    ''' Samples of a single attempt (the repumping_schedule of the repumpingMonteCarlo rmc), repetitions from each state.
+    freqs are the precession frequencies (states x carbons, rad/s, see precession_freqs) and time_unit is the time unit
+    of rmc (ns).
+    Returns the start and end state of each sample and the phase it imprints on each carbon (samples x carbons) '''
+    rmc.rateMat = rmc.repumping_rateMat().copy(order='C')
+    rmc.no_drive_RateMat = rmc.repumping_rateMat(drive = False).copy(order='C')
+    schedule = rmc.repumping_schedule()
+    attempt_duration = float(np.sum([duration for duration,_ in schedule]))
+
+    num_states = len(freqs)
+    start_states = np.repeat(np.arange(num_states),repetitions).astype(np.intc)
+    detunings = time_unit*(np.asarray(freqs,dtype=float) - np.asarray(freqs,dtype=float)[reference_state]) # rad per time unit
+
+    rep_offsets,event_times,event_states = mcr.pmc.gillespie_events(start_states,schedule,None,len(start_states),
+        seed=seed,num_threads=rmc.num_threads)[:3]
+
+    # Time spent in each visited state, until the next event or the end of the attempt
+    dwell_ends = np.empty_like(event_times)
+    dwell_ends[:-1] = event_times[1:]
+    dwell_ends[rep_offsets[1:] - 1] = attempt_duration
+    dwell_times = dwell_ends - event_times
+    event_reps = np.repeat(np.arange(len(start_states)),np.diff(rep_offsets))
+
+    phases = np.empty([len(start_states),np.shape(freqs)[1]])
+    for i in range(np.shape(freqs)[1]):
+        phases[:,i] = np.bincount(event_reps,weights=dwell_times*detunings[event_states,i],minlength=len(start_states))
+
+    end_states = event_states[rep_offsets[1:] - 1]
+    return start_states,end_states,phases
+
+
+def attempt_transfer_matrices(start_states,end_states,phases,num_states,preparation=None):
+    ''' Phase weighted transfer matrices of one attempt (carbons x states x states),
+    M[c,s,s'] = E[exp(i phase_c) ; ends in s' | starts in s], including the preparation if given '''
+    num_carbons = np.shape(phases)[1]
+    flat = (np.arange(num_carbons)[np.newaxis,:]*num_states + start_states[:,np.newaxis])*num_states + end_states[:,np.newaxis]
+    size = num_carbons*num_states**2
+    transfer = (np.bincount(flat.ravel(),weights=np.cos(phases).ravel(),minlength=size)
+                + 1j*np.bincount(flat.ravel(),weights=np.sin(phases).ravel(),minlength=size)).reshape(num_carbons,num_states,num_states)
+    samples = np.bincount(start_states,minlength=num_states)
+    transfer = transfer/np.maximum(samples,1)[np.newaxis,:,np.newaxis]
+    if preparation is not None:
+        transfer = np.einsum('ij,cjk->cik',preparation,transfer)
+    return transfer
+
+
+def coherence_vs_attempts(transfer,init_pops,attempts):
+    ''' Carbon coherence E[exp(i phase)] after each number of attempts in attempts (sorted), (attempts x carbons), as
+    init_pops M^n 1 for the transfer matrices M of attempt_transfer_matrices '''
+    vecs = np.tile(np.asarray(init_pops,dtype=complex),(len(transfer),1))
+    coherence = np.empty([len(attempts),len(transfer)],dtype=complex)
+    n_prev = 0
+    for ii,n in enumerate(attempts):
+        vecs = np.einsum('cs,cst->ct',vecs,np.linalg.matrix_power(transfer,int(n - n_prev)))
+        n_prev = n
+        coherence[ii] = np.sum(vecs,axis=1)
+    return coherence
+
+
+def trajectory_phases(start_states,end_states,phases,init_pops,attempts,trajectories,preparation=None,seed=None):
+    ''' Total carbon phases of independent trajectories of repeated attempts after each number of attempts in attempts
+    (sorted), (attempts x trajectories x carbons). Each attempt is drawn from the samples of attempt_samples that start
+    in the state the previous attempt ended in (after the preparation if given) '''
+    rng = np.random.RandomState(seed)
+    num_states = len(init_pops)
+    order = np.argsort(start_states,kind='mergesort')
+    end_states,phases = end_states[order],phases[order]
+    samples = np.bincount(start_states,minlength=num_states)
+    sample_offsets = np.concatenate(([0],np.cumsum(samples)))[:-1]
+    if preparation is not None: # Cumulative rows offset by the row index, so that searchsorted(table, s + u) samples row s
+        prep_table = (np.cumsum(preparation,axis=1) + np.arange(num_states)[:,np.newaxis]).ravel()
+        prep_table[num_states-1::num_states] = np.arange(1,num_states+1)
+
+    states = rng.choice(num_states,size=trajectories,p=init_pops)
+    total = np.zeros([trajectories,np.shape(phases)[1]])
+    results = np.empty([len(attempts),trajectories,np.shape(phases)[1]])
+    ii = 0
+    for n in range(1,int(np.max(attempts)) + 1):
+        if preparation is not None:
+            states = np.searchsorted(prep_table,states + rng.random_sample(trajectories),side='right') - states*num_states
+        picks = sample_offsets[states] + (rng.random_sample(trajectories)*samples[states]).astype(int)
+        total += phases[picks]
+        states = end_states[picks]
+        while ii < len(attempts) and attempts[ii] == n:
+            results[ii] = total
+            ii += 1
+    return results
+
+
+def repeated_attempt_dephasing(rmc,NV_system,attempts,repetitions=10000,trajectories=None,preparation=None,state_ms=STATE_MS,
+        reference_state=2,time_unit=1e-9,seed=None):
+    ''' Carbon dephasing over repeated attempts of the repumpingMonteCarlo rmc, for the carbons of NV_system, with the
+    electron prepared by preparation[from,to] at the start of each attempt (see above).
+    Returns a dict with the attempts, the coherence (attempts x carbons, complex, its abs is the remaining contrast),
+    the transfer matrices and, if trajectories is given, the trajectory phases and their coherence '''
+    attempts = np.sort(np.atleast_1d(attempts)).astype(int)
+    freqs = precession_freqs(NV_system,state_ms)
+    start_states,end_states,phases = attempt_samples(rmc,freqs,repetitions,reference_state,time_unit,seed)
+    transfer = attempt_transfer_matrices(start_states,end_states,phases,len(freqs),preparation)
+    init_pops = rmc.init_populations()
+
+    results = {'attempts' : attempts,
+               'precession_freqs' : freqs,
+               'transfer_matrices' : transfer,
+               'coherence' : coherence_vs_attempts(transfer,init_pops,attempts)}
+
+    if trajectories:
+        traj_seed = None if seed is None else seed + 1
+        total_phases = trajectory_phases(start_states,end_states,phases,init_pops,attempts,trajectories,preparation,traj_seed)
+        results['trajectory_phases'] = total_phases
+        results['trajectory_coherence'] = np.mean(np.exp(1j*total_phases),axis=1)
+    return results
+
+
+if __name__ == '__main__':
+    # Smoke run: two weakly coupled carbons over up to 1000 attempts, comparing the transfer matrix coherence to resampled
+    # trajectories (they agree up to the sampling noise of the trajectories)
+    import os,sys
+    sys.path.insert(0,os.path.join(mcr.parentdir,os.pardir,'NV-carbon coupling code'))
+    import electron_nuclear_sim as ens
+
+    NV_system = ens.NV_system(carbon_params=[[3e3,2e3],[-1e3,0.5e3]])
+    results = repeated_attempt_dephasing(mcr.repumpingMonteCarlo(),NV_system,[1,10,100,1000],repetitions=5000,trajectories=5000,seed=1)
+    print('Coherence (transfer matrices):\n',np.abs(results['coherence']))
+    print('Coherence (trajectories):\n',np.abs(results['trajectory_coherence']))
+    print('Largest difference: %g' % np.max(np.abs(results['coherence'] - results['trajectory_coherence'])))
@@ -0,0 +1,150 @@
+### Pulsed optical excitation of the NV
+# Estimates the chance that the NV decays during a finite duration optical excitation pulse and is excited a second time,
+# which is an infidelity for spin-photon entanglement generation (see Pulsed optical excitation simulation.ipynb).
+# Only optical excitation (a gaussian pulse, resonant rotation about y) and spontaneous emission are included.
+
+import numpy as np
+
+
+def pulse_rabi_frequencies(t_array,pulse_center,FWHMs,rabi_scalings=1.0):
+    ''' Instantaneous rabi frequency of gaussian pulses (FWHMs x rabi_scalings x points), with the field following the square root
+    of the intensity profile. The power is set so that the pulse excites the NV with probability rabi_scaling (1 for a pi pulse) '''
+    mus = np.atleast_1d(FWHMs)[:,np.newaxis,np.newaxis]/2.35482004503 # Convert to standard deviation
+    rabi_scalings = np.atleast_1d(rabi_scalings)[np.newaxis,:,np.newaxis]
+    pulse_EField_shape = np.sqrt(np.exp(-(t_array - pulse_center)**2/(2*mus**2))/(mus*np.sqrt(2*np.pi)))
+    EFieldFactor = 2*np.arcsin(np.sqrt(rabi_scalings))/(2**(0.75) * (np.pi)**(0.25) * np.sqrt(mus))
+    return pulse_EField_shape*EFieldFactor
+
+
+def pulse_cut_indices(t_array,pulse_center,FWHMs):
+    ''' Index after which the pulse is taken to be over (3 standard deviations after its centre) and all photons are kept '''
+    mus = np.atleast_1d(FWHMs)/2.35482004503
+    return np.argmin(np.abs(t_array[np.newaxis,:] - (pulse_center + 3*mus)[:,np.newaxis]),axis=1)
+
+
+def quantum_jump_simulation(FWHMs,rabi_scalings=1.0,time_duration=50.0,pulse_center=5.0,dt=0.05,NV_lifetime=12.0,repetitions=1000,
+        init_state=[1,0],zero_state=[1,0],seed=None):
+    ''' Quantum jump simulation of the excitation pulse, for all pulse widths FWHMs, rabi_scalings and repetitions at once.
+    Each step applies the pulse rotation, then with probability dt/NV_lifetime the NV decays to zero_state, emitting a photon
+    with probability of the excited state population.
+    Returns a dict with t_array, the mean excited state population and photon emission probability (FWHMs x rabi_scalings x points),
+    and the mean number of photons during and after the pulse, the probability of photons both during and after the pulse
+    and the conditional probability of a photon during the pulse given one after it (FWHMs x rabi_scalings). '''
+
+    rng = np.random.RandomState(seed)
+    total_points = np.ceil(time_duration/float(dt) + 1).astype(int)
+    t_array = dt * np.arange(total_points)
+    decay_prob_per_step = dt/NV_lifetime
+
+    # The step unitaries are rotations about y, exp(-i sy theta) = [[cos(theta/2), -sin(theta/2)], [sin(theta/2), cos(theta/2)]]
+    half_angles = 0.5*dt*pulse_rabi_frequencies(t_array,pulse_center,FWHMs,rabi_scalings)
+    cos_steps,sin_steps = np.cos(half_angles)[...,np.newaxis],np.sin(half_angles)[...,np.newaxis]
+    cut_inds = pulse_cut_indices(t_array,pulse_center,FWHMs)[:,np.newaxis,np.newaxis]
+
+    shape = np.shape(half_angles)[:2] + (repetitions,)
+    ground = np.full(shape,init_state[0],dtype=complex)
+    excited = np.full(shape,init_state[1],dtype=complex)
+
+    excited_pops = np.zeros(np.shape(half_angles))
+    emitted_photons = np.zeros(np.shape(half_angles))
+    photons_during_pulse = np.zeros(shape,dtype=int)
+    photons_after_pulse = np.zeros(shape,dtype=int)
+
+    for ii in range(total_points):
+        ground,excited = (cos_steps[:,:,ii]*ground - sin_steps[:,:,ii]*excited,
+                          sin_steps[:,:,ii]*ground + cos_steps[:,:,ii]*excited)
+        excited_pop = np.abs(excited)**2
+
+        decays = rng.random_sample(shape) < decay_prob_per_step
+        photons = decays & (rng.random_sample(shape) < excited_pop)
+        ground[decays] = zero_state[0]
+        excited[decays] = zero_state[1]
+
+        excited_pops[:,:,ii] = np.mean(excited_pop,axis=-1)
+        emitted_photons[:,:,ii] = np.mean(photons,axis=-1)
+        photons_during_pulse += photons & (ii < cut_inds)
+        photons_after_pulse += photons & (ii >= cut_inds)
+
+    p_photon_after_pulse = np.mean(photons_after_pulse,axis=-1)
+    double_pulse_probs = np.mean((photons_during_pulse > 0) & (photons_after_pulse > 0),axis=-1)
+
+    return {'t_array' : t_array,
+            'excited_pops' : excited_pops,
+            'emitted_photons' : emitted_photons,
+            'p_photon_during_pulse' : np.mean(photons_during_pulse,axis=-1),
+            'p_photon_after_pulse' : p_photon_after_pulse,
+            'double_pulse_probs' : double_pulse_probs,
+            'cond_prob_double_pulse' : double_pulse_probs/p_photon_after_pulse}
+
+
+def _add_photon(photon,axis):
+    ''' Move probability photon (..., 3, 3) from n to n+1 photons along axis, with 2 standing for two or more '''
+    shifted = np.zeros_like(photon)
+    index = lambda n: (Ellipsis,n,slice(None)) if axis == -2 else (Ellipsis,n)
+    shifted[index(1)] = photon[index(0)]
+    shifted[index(2)] = photon[index(1)] + photon[index(2)]
+    return shifted
+
+
+def optical_bloch_simulation(FWHMs,rabi_scalings=1.0,time_duration=50.0,pulse_center=5.0,dt=0.05,NV_lifetime=12.0,
+        init_state=[1,0],zero_state=[1,0]):
+    ''' Deterministic solution of the same model as quantum_jump_simulation, with the same returns (without sampling noise).
+    The density matrix is propagated conditioned on the number of photons emitted during (0, 1, 2 or more) and after
+    (0, 1, 2 or more) the pulse, whose joint distribution is also returned as photon_number_probs (FWHMs x rabi_scalings x 3 x 3). '''
+
+    total_points = np.ceil(time_duration/float(dt) + 1).astype(int)
+    t_array = dt * np.arange(total_points)
+    decay_prob_per_step = dt/NV_lifetime
+
+    half_angles = 0.5*dt*pulse_rabi_frequencies(t_array,pulse_center,FWHMs,rabi_scalings)
+    cos_steps,sin_steps = np.cos(half_angles)[:,:,np.newaxis,np.newaxis],np.sin(half_angles)[:,:,np.newaxis,np.newaxis]
+    cut_inds = pulse_cut_indices(t_array,pulse_center,FWHMs)[:,np.newaxis,np.newaxis,np.newaxis]
+
+    init_state = np.asarray(init_state,dtype=complex)
+    zero_state = np.asarray(zero_state,dtype=complex)
+    zero_proj = np.outer(zero_state,zero_state.conj())
+
+    # Unnormalised density matrices conditioned on the photon numbers (F x R x during x after), as their elements rho00,
+    # rho01 and rho11 (rho10 is the conjugate of rho01)
+    shape = np.shape(half_angles)[:2] + (3,3)
+    rho00,rho01,rho11 = np.zeros(shape,dtype=complex),np.zeros(shape,dtype=complex),np.zeros(shape,dtype=complex)
+    rho00[:,:,0,0] = init_state[0]*np.conj(init_state[0])
+    rho01[:,:,0,0] = init_state[0]*np.conj(init_state[1])
+    rho11[:,:,0,0] = init_state[1]*np.conj(init_state[1])
+
+    excited_pops = np.zeros(np.shape(half_angles))
+    emitted_photons = np.zeros(np.shape(half_angles))
+
+    for ii in range(total_points):
+        # rho -> U rho U^T, for the real rotation U = [[c, -s], [s, c]]
+        c,s = cos_steps[...,ii],sin_steps[...,ii]
+        coherence = 2*c*s*rho01.real
+        rho00,rho01,rho11 = (c**2*rho00 - coherence + s**2*rho11,
+                             c*s*(rho00 - rho11) + c**2*rho01 - s**2*np.conj(rho01),
+                             s**2*rho00 + coherence + c**2*rho11)
+        excited = rho11.real
+        ground = rho00.real
+
+        # A decay resets to zero_state, emitting a photon with the probability of the excited state population
+        photon = decay_prob_per_step*excited
+        reset = decay_prob_per_step*ground + np.where(ii < cut_inds,_add_photon(photon,-2),_add_photon(photon,-1))
+        rho00 = (1 - decay_prob_per_step)*rho00 + reset*zero_proj[0,0]
+        rho01 = (1 - decay_prob_per_step)*rho01 + reset*zero_proj[0,1]
+        rho11 = (1 - decay_prob_per_step)*rho11 + reset*zero_proj[1,1]
+
+        excited_pops[:,:,ii] = np.sum(excited,axis=(2,3))
+        emitted_photons[:,:,ii] = np.sum(photon,axis=(2,3))
+
+    during_steps = np.arange(total_points)[np.newaxis,np.newaxis,:] < cut_inds[:,:,:,0]
+    photon_number_probs = (rho00 + rho11).real
+    p_photon_after_pulse = np.sum(emitted_photons*~during_steps,axis=-1)
+    double_pulse_probs = np.sum(photon_number_probs[:,:,1:,1:],axis=(2,3))
+
+    return {'t_array' : t_array,
+            'excited_pops' : excited_pops,
+            'emitted_photons' : emitted_photons,
+            'p_photon_during_pulse' : np.sum(emitted_photons*during_steps,axis=-1),
+            'p_photon_after_pulse' : p_photon_after_pulse,
+            'double_pulse_probs' : double_pulse_probs,
+            'cond_prob_double_pulse' : double_pulse_probs/p_photon_after_pulse,
+            'photon_number_probs' : photon_number_probs}
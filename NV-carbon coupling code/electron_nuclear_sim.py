@@ -46,10 +46,23 @@ from matplotlib import pyplot as plt
 import matplotlib.cm as cm
 import warnings
 import collections
+import contextlib
 import copy
+import functools
+import itertools
+import multiprocessing.pool
+import operator
+import threading
+import time
+import scipy.linalg
+import scipy.optimize
+import scipy.sparse.linalg
+import scipy.special
 
 import hyperfine_params as hf_params; reload(hf_params)
 hf = hf_params.hyperfine_params
+import propagator_cache; reload(propagator_cache)
+import streaming_stats; reload(streaming_stats)
 
 
 #######################
@@ -175,6 +188,169 @@ def dyn_dec_signal(carbon_params,tau, N, sign = 1):
 
 	return M
 
+def conditional_rotation(theta0, phi0, theta1, phi1):
+	''' Target unitary for an electron-conditional carbon rotation (e x C, 4x4).
+	The carbon is rotated by theta0 around the in-plane axis at angle phi0 if the electron is in 0,
+	and by theta1 around phi1 if the electron is in 1 '''
+	return qutip.tensor(rho0, spin_theta_rotation(phi0, theta0)) + qutip.tensor(rho1, spin_theta_rotation(phi1, theta1))
+
+def process_fidelity(U, V, dims = None, keep = None):
+	''' Process fidelity of unitary U against target V.
+	If dims (the tensor structure of U) and keep (indices of the subsystems that V acts on) are given,
+	the remaining subsystems are treated as maximally mixed spectators, i.e. this returns the entanglement
+	fidelity of the channel rho -> Tr_others[U (rho x I/d_o) U^dag] against V. '''
+	U = U.full() if hasattr(U, 'full') else np.asarray(U)
+	V = V.full() if hasattr(V, 'full') else np.asarray(V)
+
+	if keep is None:
+		d = np.shape(U)[0]
+		return np.abs(np.trace(np.dot(V.conj().T, U)))**2 / d**2
+
+	n = len(dims)
+	keep = list(keep)
+	others = [i for i in range(n) if i not in keep]
+	d_s = int(np.prod([dims[i] for i in keep]))
+	d_o = int(np.prod([dims[i] for i in others]))
+
+	U = U.reshape(list(dims) * 2).transpose(keep + others + [n + i for i in keep] + [n + i for i in others])
+	U = U.reshape(d_s, d_o, d_s, d_o)
+	W = np.einsum('ij,iajb->ab', V.conj(), U)
+	return np.sum(np.abs(W)**2) / (d_s**2 * d_o)
+
+def average_gate_fidelity(F_pro, d):
+	''' Convert a process fidelity to an average gate fidelity for a d dimensional (sub)system '''
+	return (d * F_pro + 1.0) / (d + 1.0)
+
+def rotation_axis_angle(r):
+	''' Rotation axis (unit 3-vector) and angle in [0, pi] of a 2x2 matrix, after projecting it onto SU(2).
+	Returns nans if the matrix is (close to) singular, i.e. the carbon is completely dephased. '''
+	r = np.asarray(r, dtype = complex)
+	det = np.linalg.det(r)
+	if np.abs(det) < 1e-12:
+		return np.full(3, np.nan), np.nan
+	r = r / np.sqrt(det)
+	if np.real(np.trace(r)) < 0:
+		r = -r
+
+	angle = 2 * np.arccos(np.clip(np.real(np.trace(r)) / 2, -1, 1))
+	if np.sin(angle / 2) < 1e-12:
+		return np.array([0.0, 0.0, 1.0]), 0.0
+
+	paulis = [sx.full() * 2, sy.full() * 2, sz.full() * 2]
+	axis = np.array([np.real(1j * np.trace(np.dot(r, p))) for p in paulis]) / (2 * np.sin(angle / 2))
+	return axis / np.linalg.norm(axis), angle
+
+
+def unitary_conditional_rotations(U, num_carbons):
+	''' Per-carbon rotation axes and angles conditional on the electron input state, for a system unitary U (Qobj).
+	For each electron input state the dominant electron output block is used, so unitaries that flip the electron work too.
+	Returns axes with shape (num_carbons, 2, 3) and angles with shape (num_carbons, 2). '''
+	axes = np.zeros([num_carbons, 2, 3])
+	angles = np.zeros([num_carbons, 2])
+
+	dims = U.dims[0]
+	n = len(dims) - 1 # Number of non-electron spins
+	U = U.full().reshape(dims * 2)
+
+	for e_in in range(2):
+		blocks = [np.take(np.take(U, e_out, axis = 0), e_in, axis = n) for e_out in range(2)]
+		block = blocks[int(np.argmax([np.linalg.norm(b) for b in blocks]))]
+
+		for j in range(num_carbons):
+			others = [k for k in range(n) if k != j]
+			d_o = int(np.prod([dims[k + 1] for k in others]))
+			c_block = block.transpose([j] + others + [n + j] + [n + k for k in others]).reshape(2, d_o, 2, d_o)
+			axes[j, e_in], angles[j, e_in] = rotation_axis_angle(np.einsum('iaja->ij', c_block))
+
+	return axes, angles
+
+def rotation_overlap(axis0, angle0, axis1, angle1):
+	''' |Tr(R0^dag R1)|/2 for two SU(2) rotations, i.e. 1 for identical rotations '''
+	return np.abs(np.cos(angle0 / 2) * np.cos(angle1 / 2) + np.sin(angle0 / 2) * np.sin(angle1 / 2) * np.sum(np.asarray(axis0) * np.asarray(axis1), axis = -1))
+
+def gauss_hermite_rule(order):
+	''' Nodes and weights (summing to one) of the order point Gauss-Hermite rule for a standard normal variable '''
+	nodes, weights = np.polynomial.hermite_e.hermegauss(order)
+	return nodes, weights / np.sum(weights)
+
+def quasi_static_nodes(noise, order = 5, sparse = None):
+	''' Quadrature nodes and weights for averaging over independent gaussian quasi-static noise.
+	noise is a dict of parameter name : (mean, sigma), parameters with sigma = 0 are held at their mean.
+	With one noisy parameter (or sparse = False) this is the tensor product of order point Gauss-Hermite rules, exact for
+	polynomials up to degree 2*order - 1 in each parameter. With several, by default a Smolyak sparse grid exact up to
+	total degree order (odd), which needs fewer nodes (e.g. 31 instead of 125 for three parameters at order 5).
+	Returns a list of dicts of parameter values, and the weights (which can be negative for sparse grids). '''
+	varied = [name for name in sorted(noise) if noise[name][1] != 0]
+	d = len(varied)
+	if sparse is None:
+		sparse = d > 1
+
+	if sparse: # Combination of tensor products of odd point rules, levels l = 1..L use 2l-1 points
+		L = (order + 1) // 2
+		combinations = []
+		for levels in itertools.product(range(1, L + 1), repeat = d):
+			k = L + d - 1 - sum(levels)
+			if 0 <= k <= d - 1:
+				combinations.append(((-1)**k * scipy.special.comb(d - 1, k, exact = True), [gauss_hermite_rule(2 * l - 1) for l in levels]))
+	else:
+		combinations = [(1, [gauss_hermite_rule(order)] * d)]
+
+	node_weights = collections.OrderedDict()
+	for coeff, rules in combinations:
+		for point in itertools.product(*[list(zip(*rule)) for rule in rules]):
+			node = tuple(np.round([x for x, w in point], 12) + 0.0) # Merge nodes shared between rules (+0.0 for -0.0)
+			node_weights[node] = node_weights.get(node, 0.0) + coeff * np.prod([w for x, w in point])
+
+	samples, weights = [], []
+	for node, weight in node_weights.items():
+		if abs(weight) > 1e-14:
+			sample = dict((name, mean) for name, (mean, sigma) in noise.items())
+			for name, x in zip(varied, node):
+				sample[name] = noise[name][0] + noise[name][1] * x
+			samples.append(sample)
+			weights.append(weight)
+	return samples, np.array(weights)
+
+def random_noise_samples(noise, N_rand):
+	''' N_rand random draws of independent gaussian quasi-static noise (see quasi_static_nodes), as a list of dicts '''
+	draws = dict((name, np.random.normal(loc = mean, scale = sigma, size = N_rand) if sigma != 0 else np.full(N_rand, mean))
+				 for name, (mean, sigma) in sorted(noise.items()))
+	return [dict((name, draws[name][i]) for name in draws) for i in range(N_rand)]
+
+def weighted_mean_variance(values, weights):
+	''' Mean and variance of values (samples along the first axis) for quadrature (or equal) weights '''
+	values = np.asarray(values)
+	mean = np.tensordot(weights, values, axes = 1)
+	return mean, np.maximum(np.tensordot(weights, values**2, axes = 1) - mean**2, 0)
+
+def noise_snapshot(NV_system, amp = None, detuning = None, B_field = None):
+	''' Snapshot of NV_system (see with_params) with the MW amplitude (noisy_NV_system only), NV detuning and B field of a
+	noise sample. Unchanged values are left out, so that the snapshot shares the propagator caches where it can '''
+	params = {}
+	if amp is not None and amp != NV_system.mean_amp:
+		params['mean_amp'] = amp
+	if detuning is not None and detuning != NV_system.NV_detuning:
+		params['NV_detuning'] = detuning
+	if B_field is not None and B_field != NV_system.B_field:
+		params['B_field'] = B_field
+	return NV_system.with_params(**params)
+
+def thread_map(func,items,num_threads = None):
+	''' [func(item) for item in items], on a pool of num_threads threads if given. Only work that releases the GIL runs
+	concurrently, and qutip's sparse products hold it, so this gives little or no speedup for the simulations here. Systems
+	and gates hold lambdas and cannot be pickled, so a process pool is not an option either '''
+	if num_threads is None or num_threads <= 1:
+		return [func(item) for item in items]
+	pool = multiprocessing.pool.ThreadPool(num_threads)
+	try:
+		results = pool.map(func, items)
+		pool.close()
+	except BaseException:
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+	return results
 
 ###########################
 ### 	 Classes        ###
@@ -207,8 +383,38 @@ class NV_system(object):
 	use_hf_library: bool
 		Wether to use the hyperfine library for the carbon 13 atoms parameters.
 		Default is False
+
+	disk_cache_dir: str
+		Directory for a persistent cache of the calculated propagators, shared between sessions and jobs
+		with identical system parameters. Default is None (no disk cache).
+
+	disk_cache_max_bytes: scalar
+		Size cap of the disk cache, least recently used entries are removed beyond this. Default is 2 GB.
+
+	e_T1, e_T2, C_T1, C_T2: scalar
+		Relaxation (T1) and coherence (T2) times in seconds of the electron and the carbons (a list gives one value per
+		carbon). Default is None (no decoherence). With any of these set, free evolution is a channel acting on density
+		matrices (see free_evolution_channel) and gate sequences are applied gate by gate. Not with inc_nitrogen.
+
+	krylov: bool
+		Never build propagators of the full system, for large registers (16-20 carbons). States are ensembles of kets
+		(see ket_ensemble), the initial mixed carbon register is sampled with krylov_members random states (seeded by
+		krylov_seed), and gates act on the kets directly (see ket_propagator). Default is False.
+
+	single_precision: bool
+		Store the free evolution and pulse propagators in complex64 and multiply sequences in complex64 (see
+		single_precision_operator). Propagators are kept sparse or dense, whichever is smaller, which saves 40 (sparse) to
+		60% (dense) of the propagator cache memory. Products of unitaries are re-unitarised every reunitarise_every
+		(default 64) matrix products. Use basic_gate_sequence.precision_error for a double precision spot check.
+		Default is False. Not with decoherence or krylov.
+
+	Parameter studies should use snapshots (see with_params and single_carbon) rather than the setters. Snapshots are
+	immutable, share operators and caches with this system and can be used from several threads at once.
 	'''
 
+	# with_params keywords that change the Hamiltonian, so that the snapshot needs its own propagator caches
+	snapshot_hamiltonian_params = ['NV_detuning','B_field','carbon_params','e_T1','e_T2','C_T1','C_T2','single_precision']
+
 	def __init__(self,**kw):
 
 		self.B_field = kw.pop('B_field',414.1871869)
@@ -227,17 +433,66 @@ class NV_system(object):
 
 		self.inc_nitrogen = kw.pop('inc_nitrogen',False)
 
+		disk_cache_dir = kw.pop('disk_cache_dir',None)
+		disk_cache_max_bytes = kw.pop('disk_cache_max_bytes',2e9)
+		self.disk_cache = propagator_cache.disk_propagator_cache(disk_cache_dir, disk_cache_max_bytes) if disk_cache_dir else None
+
+		self.e_T1 = kw.pop('e_T1',None)
+		self.e_T2 = kw.pop('e_T2',None)
+		self.C_T1 = kw.pop('C_T1',None)
+		self.C_T2 = kw.pop('C_T2',None)
+
+		self.krylov = kw.pop('krylov',False)
+		self.krylov_members = kw.pop('krylov_members',4)
+		self.krylov_seed = kw.pop('krylov_seed',None)
+		if self.krylov and self.has_decoherence():
+			raise ValueError('Decoherence is not implemented in krylov mode')
+
+		self.single_precision = kw.pop('single_precision',False)
+		self.reunitarise_every = kw.pop('reunitarise_every',64)
+		if self.single_precision and (self.krylov or self.has_decoherence()):
+			raise ValueError('single_precision is not implemented with decoherence or in krylov mode')
+
+		self.frozen = False # Snapshots are frozen
+		self.cache_lock = threading.RLock() # Guards the Hamiltonian and the free evolution cache, shared by snapshots sharing them
+
 		self.add_carbons(**kw)
 		self.recalculate()
 
 		self.cache_system_evn = True
 
 
+	def _check_mutable(self):
+		if self.frozen:
+			raise ValueError('Snapshots are immutable, use with_params to change parameters')
+
 	def set_NV_detuning(self,detuning):
+		self._check_mutable()
 		self.NV_detuning = detuning
 		self.reset_caches()
 		self.recalc_Hamiltonian = True
 
+	def set_decoherence(self,**kw):
+		''' Change any of e_T1, e_T2, C_T1 and C_T2 (None to switch a channel off) '''
+		self._check_mutable()
+		for name in ['e_T1','e_T2','C_T1','C_T2']:
+			if name in kw:
+				setattr(self,name,kw.pop(name))
+		self.reset_caches()
+
+	def has_decoherence(self):
+		return any(T is not None for T in [self.e_T1,self.e_T2,self.C_T1,self.C_T2])
+
+	def set_B_field(self,B_field):
+		''' Change the B field, updating the carbon Larmor frequencies (the hyperfine couplings are unchanged) '''
+		self._check_mutable()
+		self.B_field = B_field
+		# New lists, the old ones may be held by the caller or shared with snapshots
+		self.carbon_params = [[2 * np.pi * self.B_field * self.gamma_c] + list(carbon_param[1:]) for carbon_param in self.carbon_params]
+		self.calc_c_prec_freqs()
+		self.reset_caches()
+		self.recalc_Hamiltonian = True
+
 	def recalculate(self):
 		self.reset_caches()
 		self.recalc_Hamiltonian = True
@@ -248,6 +503,62 @@ class NV_system(object):
 		self.cache_system_evn_taus = []
 		self.cache_system_evn_Unitaries = []
 
+	def _snapshot(self,detach):
+		''' Unfrozen shallow copy with its own parameters, sharing the operators, states and (unless detach) the caches '''
+		snapshot = copy.copy(self)
+		snapshot.frozen = False
+		snapshot.carbon_params = [list(carbon_param) for carbon_param in self.carbon_params]
+		if detach:
+			snapshot.cache_lock = threading.RLock()
+			snapshot.reset_caches()
+			snapshot.recalc_Hamiltonian = True
+		snapshot._bind_e_operators()
+		return snapshot
+
+	def _set_snapshot_params(self,kw):
+		if 'carbon_params' in kw:
+			carbon_params = kw.pop('carbon_params')
+			if len(carbon_params) != self.num_carbons:
+				raise ValueError('Snapshots keep the number of carbons, see single_carbon')
+			self.carbon_params = [[2 * np.pi * self.B_field * self.gamma_c,2 * np.pi * carbon_param[0],2 * np.pi * carbon_param[1]] for carbon_param in carbon_params]
+			self.calc_c_prec_freqs()
+		if 'B_field' in kw:
+			self.set_B_field(kw.pop('B_field'))
+		if 'NV_detuning' in kw:
+			self.set_NV_detuning(kw.pop('NV_detuning'))
+		decoherence = dict((name, kw.pop(name)) for name in ['e_T1','e_T2','C_T1','C_T2'] if name in kw)
+		if decoherence:
+			self.set_decoherence(**decoherence)
+		if 'single_precision' in kw:
+			self.single_precision = kw.pop('single_precision')
+		if 'cache_system_evn' in kw:
+			self.cache_system_evn = kw.pop('cache_system_evn')
+		if kw:
+			raise ValueError('Unknown snapshot parameters %s' % sorted(kw))
+
+	def with_params(self,**kw):
+		''' Immutable snapshot with any of NV_detuning, B_field, carbon_params (as in the constructor, for the same number of
+		carbons), e_T1, e_T2, C_T1, C_T2 and single_precision changed. It shares the operators and states with this system, and the
+		propagator caches too if the Hamiltonian is unchanged. cache_system_evn = False gives a snapshot that neither reads
+		nor adds to the free evolution cache, e.g. for optimisations over continuous taus '''
+		snapshot = self._snapshot(detach = any(name in self.snapshot_hamiltonian_params for name in kw))
+		snapshot._set_snapshot_params(dict(kw))
+		snapshot.frozen = True
+		return snapshot
+
+	def single_carbon(self,j):
+		''' Immutable snapshot with only carbon j (counted from 0). Its operators and caches are its own, as it is smaller '''
+		snapshot = self._snapshot(detach = True)
+		snapshot.carbon_params = [snapshot.carbon_params[j]]
+		snapshot.num_carbons = 1
+		snapshot.c_prec_freqs = np.array(self.c_prec_freqs[j:j+1])
+		for name in ['C_T1','C_T2']:
+			if isinstance(getattr(self,name), (list, tuple, np.ndarray)):
+				setattr(snapshot, name, [getattr(self,name)[j]])
+		snapshot.recalculate()
+		snapshot.frozen = True
+		return snapshot
+
 	def add_carbons(self, **kw):
 
 		if kw.pop('use_msmt_params', False):
@@ -317,7 +628,10 @@ class NV_system(object):
 
 	def define_useful_states(self):
 		''' standard init state for system '''
-		self.NV0_carbons_mixed = qutip.tensor([rho0] + [rhom] * self.num_carbons + [rhom_S1] * self.inc_nitrogen)
+		if self.krylov:
+			self.NV0_carbons_mixed = random_state_ensemble([rho0] + [rhom] * self.num_carbons + [rhom_S1] * self.inc_nitrogen, self.krylov_members, seed = self.krylov_seed)
+		else:
+			self.NV0_carbons_mixed = qutip.tensor([rho0] + [rhom] * self.num_carbons + [rhom_S1] * self.inc_nitrogen)
 
 	def _define_e_operators(self):
 		''' Define commonly used electronic operations '''
@@ -332,7 +646,9 @@ class NV_system(object):
 		self._Ide = self.e_op(Id)
 		self._proj0 = self.e_op(rho0)
 		self._proj1 = self.e_op(rho1)
+		self._bind_e_operators()
 
+	def _bind_e_operators(self):
 		''' Trivial here but useful later '''
 		self.Xe = lambda : self._Xe
 		self.Ye = lambda : self._Ye
@@ -352,42 +668,118 @@ class NV_system(object):
 	def NV_carbon_system_Hamiltonian(self):
 		''' Function to calculate the NV C13 system Hamiltonian '''
 
-		if self.recalc_Hamiltonian == True:
-
-			if self.num_carbons:
-				self.Hsys = np.sum([self.e_C_op(rho0,carbon_param[0]*sz,i+1) \
-							 + self.e_C_op(rho1,((carbon_param[0]+ self.sign*carbon_param[1])*sz + self.sign * carbon_param[2] * sx),i+1) \
-					   for i,carbon_param in enumerate(self.carbon_params)]).tidyup()
-			else:
-				self.Hsys = 0
-
-			if self.inc_nitrogen:
-				self.Hsys += self.e_N_op(2*np.pi*self.A_n*self.sign*szPseudo1_2,sz_S1) + self.N_op(-2 * np.pi * (self.P_n*(sz_S1**2 -  1/3.0) + self.gamma_n*self.B_field*sz_S1))
-
-			self.Hsys += self.e_op(2*np.pi*self.NV_detuning*self.sign*szPseudo1_2) # Note that funniness because NV is actually an S1 system..
-
-			self.Hsys.tidyup()
-
-			self.recalc_Hamiltonian = False
-
-		return self.Hsys
+		with self.cache_lock: # Built in full before it is stored, as snapshots in other threads may share it
+			if self.recalc_Hamiltonian == True:
 
+				if self.num_carbons:
+					Hsys = functools.reduce(operator.add, [self.e_C_op(rho0,carbon_param[0]*sz,i+1) \
+								 + self.e_C_op(rho1,((carbon_param[0]+ self.sign*carbon_param[1])*sz + self.sign * carbon_param[2] * sx),i+1) \
+						   for i,carbon_param in enumerate(self.carbon_params)]).tidyup()
+				else:
+					Hsys = 0
+
+				if self.inc_nitrogen:
+					Hsys += self.e_N_op(2*np.pi*self.A_n*self.sign*szPseudo1_2,sz_S1) + self.N_op(-2 * np.pi * (self.P_n*(sz_S1**2 -  1/3.0) + self.gamma_n*self.B_field*sz_S1))
+
+				Hsys += self.e_op(2*np.pi*self.NV_detuning*self.sign*szPseudo1_2) # Note that funniness because NV is actually an S1 system..
+
+				self.Hsys = Hsys.tidyup()
+
+				self.recalc_Hamiltonian = False
+
+			return self.Hsys
+
+
+	def carbon_block_Hamiltonians(self):
+		''' The Hamiltonian is block diagonal in the electron and, without the nitrogen, a sum over the carbons in each block.
+		Returns the 2x2 Hamiltonian of each carbon in each electron block (carbons x 2 x 2 x 2) and the electron energies '''
+		H = np.empty([self.num_carbons, 2, 2, 2], dtype = complex)
+		for i, carbon_param in enumerate(self.carbon_params):
+			H[i, 0] = carbon_param[0] * sz.full()
+			H[i, 1] = (carbon_param[0] + self.sign * carbon_param[1]) * sz.full() + self.sign * carbon_param[2] * sx.full()
+		e_energies = np.real(np.diag((2 * np.pi * self.NV_detuning * self.sign * szPseudo1_2).full()))
+		return H, e_energies
+
+	def free_evolution_action(self,tau):
+		''' Free evolution over tau as a ket_propagator. Without the nitrogen this is one 2x2 unitary per carbon and electron
+		block, otherwise the action of the sparse Hamiltonian (expm_multiply) '''
+		if self.inc_nitrogen:
+			A = (-1j * tau * self.NV_carbon_system_Hamiltonian()).data
+			return ket_propagator(lambda kets : scipy.sparse.linalg.expm_multiply(A, kets), [A])
+
+		H, e_energies = self.carbon_block_Hamiltonians()
+		Us = [[scipy.linalg.expm(-1j * tau * H[i, a]) for i in range(self.num_carbons)] for a in range(2)]
+		phases = np.exp(-1j * tau * e_energies)
+
+		def apply(kets):
+			n = self.num_carbons
+			kets = np.array(kets, dtype = complex).reshape([2] + [2] * n + [-1])
+			for a in range(2):
+				block = kets[a]
+				for i in range(n):
+					block = np.moveaxis(np.tensordot(Us[a][i], block, axes = (1, i)), 0, i)
+				kets[a] = phases[a] * block
+			return kets.reshape(2**(n + 1), -1)
+		return ket_propagator(apply, Us[0] + Us[1] + [phases])
+
+	def system_key(self):
+		''' Everything that defines the system Hamiltonian, used to key the persistent propagator cache. Pulses add their own
+		parameters to the key, so that free evolution is shared between pulse settings '''
+		return [self.carbon_params, self.B_field, self.NV_detuning, self.sign, self.inc_nitrogen]
+
+	def reference_precision(self):
+		''' Whether this single_precision system is calculating a double precision reference (see double_precision) '''
+		return self.single_precision and getattr(_double_precision, 'active', False)
+
+	def stored(self,op):
+		''' A propagator as it is cached and multiplied, i.e. as a single_precision_operator in single_precision mode '''
+		if self.single_precision and not self.reference_precision():
+			return single_precision_operator(op.data, op.dims, reunitarise_every = self.reunitarise_every)
+		return op
+
+	def disk_cached(self,calc_func,*key_parts):
+		''' Look up a propagator in the persistent disk cache (if enabled), otherwise calculate it with calc_func and store it '''
+		if self.disk_cache is None:
+			return calc_func()
+
+		key = propagator_cache.system_fingerprint(self.system_key(),*key_parts)
+		arr = self.disk_cache.load(key)
+		if arr is not None:
+			return qutip.Qobj(np.asarray(arr), dims = self._Ide.dims)
+
+		op = calc_func()
+		self.disk_cache.store(key, op.full())
+		return op
 
 	def NV_carbon_ev(self,tau):
 		''' Function to calculate a C13 evolution matrix from the system Hamiltonian. Written this way so that could be overwritten'''
 
 		''' By default, will cache evolution for a given tau, so that doesnt have to recalculate! '''
-		if self.cache_system_evn:
-			if tau in self.cache_system_evn_taus:
-				return self.cache_system_evn_Unitaries[self.cache_system_evn_taus.index(tau)]
+		''' With decoherence this is a free_evolution_channel rather than a unitary, cached in the same way '''
+		if self.cache_system_evn and not self.reference_precision():
+			with self.cache_lock:
+				if tau in self.cache_system_evn_taus:
+					return self.cache_system_evn_Unitaries[self.cache_system_evn_taus.index(tau)]
+
+			# Calculated outside the lock, another thread may store the same tau in the meantime
+			if self.has_decoherence():
+				unitary = free_evolution_channel(self,tau)
+			elif self.krylov:
+				unitary = self.free_evolution_action(tau)
 			else:
-				unitary = (-1j*self.NV_carbon_system_Hamiltonian()*tau).expm()
-				self.cache_system_evn_Unitaries.append(unitary)
-				self.cache_system_evn_taus.append(tau)
-				return unitary
-
+				unitary = self.stored(self.disk_cached(lambda : (-1j*self.NV_carbon_system_Hamiltonian()*tau).expm(), 'NV_carbon_ev', tau))
+			with self.cache_lock:
+				if tau not in self.cache_system_evn_taus:
+					self.cache_system_evn_Unitaries.append(unitary)
+					self.cache_system_evn_taus.append(tau)
+			return unitary
+
+		elif self.has_decoherence():
+			return free_evolution_channel(self,tau)
+		elif self.krylov:
+			return self.free_evolution_action(tau)
 		else:
-			return (-1j*self.NV_carbon_system_Hamiltonian()*tau).expm()
+			return self.stored((-1j*self.NV_carbon_system_Hamiltonian()*tau).expm())
 
 class noisy_NV_system(NV_system):
 
@@ -402,28 +794,60 @@ class noisy_NV_system(NV_system):
 		self.mw_detuning = kw.pop('mw_detuning',None) # Used for the above mentioned functionality.
 		self.calc_steps = kw.pop('mw_detuning',300)# Steps to calculate the  gate evolution over
 
+		# Finite pulses are cached by everything that defines them, so mixed amplitudes and arbitrary rotations all hit the cache
+		self.pulse_cache = propagator_cache.pulse_cache(max_entries = kw.pop('pulse_cache_entries',256), max_bytes = kw.pop('pulse_cache_bytes',1e9))
+		# Axis phase and rotation angle of the standard gates
+		self.mw_op_params = {'Xe' : (0.0,np.pi), 'Ye' : (0.5*np.pi,np.pi), 'mXe' : (0.0,-np.pi), 'mYe' : (0.5*np.pi,-np.pi),
+							 'xe' : (0.0,0.5*np.pi), 'ye' : (0.5*np.pi,0.5*np.pi), 'mxe' : (0.0,-0.5*np.pi), 'mye' : (0.5*np.pi,-0.5*np.pi)}
+
 		NV_system.__init__(self,**kw)
 		self.recalculate()
 
+	snapshot_hamiltonian_params = NV_system.snapshot_hamiltonian_params + ['mw_duration']
+
 	def set_mw_duration(self,mw_duration):
+		self._check_mutable()
 		self.mw_duration = mw_duration
 		self.tau_correction_factor = self.mw_duration
 		self.reset_caches()
 
 	def set_mw_amp(self,amp):
-		self.mean_amp = amp
-		self.reset_caches()
+		self._check_mutable()
+		self.mean_amp = amp # The amplitude is part of the pulse cache key, and free evolution doesnt depend on it
 
 	def set_NV_detuning(self,detuning):
+		self._check_mutable()
 		self.NV_detuning = detuning
 		self.recalc_Hamiltonian = True
 		self.reset_caches()
 
+	def _snapshot(self,detach):
+		snapshot = NV_system._snapshot(self,detach)
+		if detach:
+			snapshot.pulse_cache = self._new_pulse_cache()
+		return snapshot
+
+	def _set_snapshot_params(self,kw):
+		''' Also mean_amp and mw_duration '''
+		if 'mean_amp' in kw:
+			self.set_mw_amp(kw.pop('mean_amp'))
+		if 'mw_duration' in kw:
+			self.set_mw_duration(kw.pop('mw_duration'))
+		NV_system._set_snapshot_params(self,kw)
+
+	def set_B_field(self,B_field):
+		NV_system.set_B_field(self,B_field)
+		self.pulse_cache = self._new_pulse_cache() # The pulse cache is not keyed by the B field (and may be shared with snapshots)
+
+	def _new_pulse_cache(self):
+		return propagator_cache.pulse_cache(max_entries = self.pulse_cache.max_entries, max_bytes = self.pulse_cache.max_bytes)
+
 	def recalculate(self):
 		self.recalc_Hamiltonian = True
 		self.define_useful_states()
 		self._define_e_operators()
 		self.reset_caches()
+		self.pulse_cache.clear()
 
 	def amp_val(self):
 		# Could do more complicated things if you want!
@@ -438,7 +862,7 @@ class noisy_NV_system(NV_system):
 		if steps is None:
 			steps = self.calc_steps
 
-		duration = np.float(duration)
+		duration = float(duration)
 
 		if self.pulse_shape == 'square':
 			Hsys = self.NV_carbon_system_Hamiltonian()
@@ -471,69 +895,589 @@ class noisy_NV_system(NV_system):
 				combinedU = self.e_op((1j*2*np.pi*detuning*self.sign*szPseudo1_2 * duration).expm()) * combinedU
 			return combinedU
 
-	def reset_caches(self):
-		for op_string in self.mw_ops:
-			setattr(self, op_string + '_cache_recalc', True)
-
-		self.cache_system_evn_taus = []
-		self.cache_system_evn_Unitaries = []
-
 	def calc_unitary_trans(self,op_string,perfect_pulse=False,amp_val=None):
 
 		if perfect_pulse:
-			return eval('self._' + op_string)
+			return getattr(self, '_' + op_string)
 
-		#Here is some code cleverness to only recalculate the matrices if the mw_amp changes
+		theta, phi = self.mw_op_params[op_string]
+		return self.mw_pulse(theta,phi,amp_val)
 
-		if amp_val is None:
-			if hasattr(self,op_string + '_cache'):
-				if not(eval('self.' + op_string + '_cache_recalc')):
-					return eval('self.' + op_string + '_cache')
-			# If not caching, calculate
+	def mw_pulse(self,theta,phi,amp=None):
+		''' Finite pulse rotating by phi*amp around the axis at angle theta, from the pulse cache (or disk cache) if possible '''
+		if amp is None:
 			amp = self.amp_val()
-		else:
-			amp = amp_val
 
-		gate_op = eval('self._n_' + op_string + '(amp = ' + str(amp)  + ')')
+		key = (theta, phi, amp, self.mw_duration, self.NV_detuning, self.pulse_shape, self.calc_steps, self.norm_pulse, self.compensate_mw_detuning, self.mw_detuning)
+		if self.krylov:
+			return self.pulse_cache.get(key, lambda : self.mw_pulse_action(self.mw_duration,theta,phi*amp))
+		if self.reference_precision():
+			return self.disk_cached(lambda : self.finite_microwave_pulse(self.mw_duration,theta,phi*amp), 'mw_pulse', list(key))
+		return self.pulse_cache.get(key, lambda : self.stored(self.disk_cached(lambda : self.finite_microwave_pulse(self.mw_duration,theta,phi*amp), 'mw_pulse', list(key))))
 
-		if amp_val is None:
-			# Add to cache
-			setattr(self, op_string + '_cache', gate_op)
-			setattr(self, op_string + '_cache_recalc', False)
+	def mw_pulse_action(self,duration,theta,phi,steps=None):
+		''' finite_microwave_pulse as a ket_propagator, acting on kets with expm_multiply (one action per time step for Hermite pulses) '''
+		if steps is None:
+			steps = self.calc_steps
 
-		return gate_op
+		duration = float(duration)
+		Hsys = self.NV_carbon_system_Hamiltonian().data
+		Hint = self.e_op(np.cos(theta)*sx + np.sin(theta)*sy).data
 
-	def _define_e_operators(self):
-		''' Override commonly used electronic gates '''
+		if self.pulse_shape == 'square':
+			A = -1j*(duration*Hsys + phi*Hint)
+			return ket_propagator(lambda kets : scipy.sparse.linalg.expm_multiply(A, kets), [A])
 
-		NV_system._define_e_operators(self)
+		elif self.pulse_shape == 'Hermite':
+			dt = duration/steps
+			t = np.arange(0+dt/2,duration,dt)
+			if self.norm_pulse is None:
+				normfactor = steps/(duration*np.sum(self.gaussian_envelope(t,duration)))
+			else:
+				normfactor = self.norm_pulse
+			As = [-1j*dt*(Hsys + self.gaussian_envelope(ts,duration)*normfactor*phi*Hint) for ts in t]
 
-		self._n_Xe = lambda amp = 1.0 : self.finite_microwave_pulse(self.mw_duration,0.0,np.pi*amp)
-		self._n_Ye = lambda amp = 1.0 : self.finite_microwave_pulse(self.mw_duration,0.5*np.pi,np.pi*amp)
-		self._n_mXe = lambda amp = 1.0 : self.finite_microwave_pulse(self.mw_duration,0.0,-np.pi*amp)
-		self._n_mYe = lambda amp = 1.0 : self.finite_microwave_pulse(self.mw_duration,0.5*np.pi,-np.pi*amp)
-		self._n_xe = lambda amp = 1.0 : self.finite_microwave_pulse(self.mw_duration,0.0,0.5*np.pi*amp)
-		self._n_ye = lambda amp = 1.0 : self.finite_microwave_pulse(self.mw_duration,0.5*np.pi,0.5*np.pi*amp)
-		self._n_mxe = lambda amp = 1.0 : self.finite_microwave_pulse(self.mw_duration,0.0,-0.5*np.pi*amp)
-		self._n_mye = lambda amp = 1.0 : self.finite_microwave_pulse(self.mw_duration,0.5*np.pi,-0.5*np.pi*amp)
+			compensation = None
+			if self.compensate_mw_detuning:
+				detuning = self.NV_detuning if self.mw_detuning is None else self.mw_detuning
+				compensation = self.e_op((1j*2*np.pi*detuning*self.sign*szPseudo1_2 * duration).expm()).data
+
+			def apply(kets):
+				for A in As:
+					kets = scipy.sparse.linalg.expm_multiply(A, kets)
+				return kets if compensation is None else compensation.dot(kets)
+			return ket_propagator(apply, As if compensation is None else As + [compensation])
+
+	def _bind_e_operators(self):
+		''' Override commonly used electronic gates '''
+
+		NV_system._bind_e_operators(self)
 
 		for op_string in self.mw_ops:
-			setattr(self,op_string, lambda perfect_pulse = False, amp_val = None, op_string = op_string: self.calc_unitary_trans(op_string,perfect_pulse=perfect_pulse))  # Force eval of op_string at defn time
+			setattr(self,op_string, lambda perfect_pulse = False, amp_val = None, op_string = op_string: self.calc_unitary_trans(op_string,perfect_pulse=perfect_pulse,amp_val=amp_val))  # Force eval of op_string at defn time
 		self.Ide = lambda : self._Ide
 		self.proj0 = lambda : self._proj0
 		self.proj1 = lambda : self._proj1
-		self.re = lambda theta,phi,amp=self.amp_val(): self.finite_microwave_pulse(self.mw_duration,theta,phi*amp) # Not cached!
+		self.re = lambda theta,phi,amp=None: self.mw_pulse(theta,phi,amp)
+
+
+class batched_operator(object):
+	''' Stack of operators (or density matrices) of the members of a batched_NV_system, as a batch x D x D array, with
+	the Qobj operations used by gate sequences and measurements. Qobjs (shared by all members) broadcast over the batch '''
+
+	def __init__(self,data,dims):
+		self.data = np.asarray(data, dtype = complex)
+		self.dims = dims
+
+	def full(self):
+		return self.data
+
+	def __len__(self):
+		return len(self.data)
+
+	def __mul__(self,other):
+		if np.isscalar(other):
+			return batched_operator(self.data * other, self.dims)
+		return batched_operator(np.matmul(self.data, _batch_array(other)), self.dims)
+
+	def __rmul__(self,other):
+		if np.isscalar(other):
+			return batched_operator(other * self.data, self.dims)
+		return batched_operator(np.matmul(_batch_array(other), self.data), self.dims)
+
+	def __pow__(self,n):
+		return batched_operator(np.linalg.matrix_power(self.data, int(n)), self.dims)
+
+	def dag(self):
+		return batched_operator(np.conj(np.swapaxes(self.data, -1, -2)), self.dims)
+
+	def tr(self):
+		return np.trace(self.data, axis1 = -2, axis2 = -1)
+
+	def unit(self):
+		return batched_operator(self.data / self.tr()[:, np.newaxis, np.newaxis], self.dims)
+
+	def expect(self,op):
+		''' Tr(op rho) for each member (op is a Qobj shared by all members) '''
+		return np.real(np.einsum('ij,bji->b', op.full(), self.data))
+
+def _batch_array(op):
+	return op.data if isinstance(op,batched_operator) else op.full()
+
+def batched_expm_hermitian(H):
+	''' exp(-iH) for a stack of hermitian matrices (batch x D x D), from one batched eigendecomposition '''
+	vals, vecs = np.linalg.eigh(H)
+	return np.matmul(vecs * np.exp(-1j * vals)[..., np.newaxis, :], np.conj(np.swapaxes(vecs, -1, -2)))
+
+def batch_members(system_class = NV_system,**kw):
+	''' Systems of a batch of parameter sets from system_class keywords, where carbon_params can be a list of carbon_params
+	(one per member, all with the same number of carbons) and NV_detuning and B_field lists (one value per member).
+	All other keywords are shared by the members '''
+	per_member = {}
+	if 'carbon_params' in kw and np.ndim(kw['carbon_params']) == 3:
+		per_member['carbon_params'] = [[list(carbon_param) for carbon_param in carbon_params] for carbon_params in kw.pop('carbon_params')]
+	for name in ['NV_detuning','B_field']:
+		if name in kw and np.ndim(kw[name]) == 1:
+			per_member[name] = list(kw.pop(name))
+
+	sizes = set(len(values) for values in per_member.values())
+	if len(sizes) > 1:
+		raise ValueError('All batched parameters need one value per member')
+
+	members = []
+	for b in range(sizes.pop() if sizes else 1):
+		member_kw = dict(kw)
+		member_kw.update((name, values[b]) for name, values in per_member.items())
+		members.append(system_class(**member_kw))
+	return members
+
+def parameter_batch(NV_system,NV_detuning = None,B_field = None):
+	''' batched_NV_system of snapshots of NV_system with the given detunings and/or B fields (one value per member) '''
+	sizes = [len(values) for values in [NV_detuning, B_field] if values is not None]
+	members = []
+	for b in range(sizes[0] if sizes else 1):
+		params = {}
+		if NV_detuning is not None:
+			params['NV_detuning'] = NV_detuning[b]
+		if B_field is not None:
+			params['B_field'] = B_field[b]
+		members.append(NV_system.with_params(**params))
+	return batched_NV_system(members = members)
+
+class batched_NV_system(object):
+	'''
+	A batch of NV systems with the same spins (e.g. a detuning sweep or an ensemble of carbon baths), simulated in one go.
+	Hamiltonians, propagators and states are stacked along a leading batch axis (see batched_operator) and propagated with
+	batched linear algebra, so a gate sequence is applied to all members at once and measurements return one value per
+	member. Gates that are the same for all members (e.g. perfect pulses) are shared.
+
+	Accepted keywords
+	-----------------
+	members: list
+		The member systems (NV_system or noisy_NV_system). If not given, they are made by batch_members from the
+		remaining keywords, with system_class (default NV_system).
+
+	Free evolution of all members comes from one eigendecomposition of the stacked Hamiltonians. Not with decoherence or
+	in krylov mode.
+	'''
+
+	def __init__(self,members = None,system_class = NV_system,**kw):
+		if members is None:
+			members = batch_members(system_class,**kw)
+		self.members = list(members)
+		self.batch_size = len(self.members)
+
+		first = self.members[0]
+		if any(member.num_carbons != first.num_carbons or member.inc_nitrogen != first.inc_nitrogen for member in self.members):
+			raise ValueError('All members of a batch need the same number of carbons (and nitrogen)')
+		if any(member.has_decoherence() or member.krylov for member in self.members):
+			raise ValueError('Batches are not implemented with decoherence or in krylov mode')
+
+		self.pulse_cache = propagator_cache.pulse_cache()
+		self.recalculate()
+
+	def __getattr__(self,name):
+		# Everything the members share (operators, states, pulse settings) comes from the first member
+		if name == 'members':
+			raise AttributeError(name)
+		return getattr(self.members[0],name)
+
+	@property
+	def carbon_params(self):
+		return [member.carbon_params for member in self.members]
+
+	@property
+	def c_prec_freqs(self):
+		return np.array([member.c_prec_freqs for member in self.members])
+
+	def set_NV_detuning(self,detuning):
+		''' A single detuning or one per member '''
+		self.members = [member.with_params(NV_detuning = member_detuning) for member, member_detuning in zip(self.members, np.broadcast_to(detuning, [self.batch_size]))]
+		self.recalculate()
+
+	def set_B_field(self,B_field):
+		''' A single B field or one per member '''
+		self.members = [member.with_params(B_field = member_B_field) for member, member_B_field in zip(self.members, np.broadcast_to(B_field, [self.batch_size]))]
+		self.recalculate()
+
+	def set_mw_amp(self,amp):
+		self.members = [member.with_params(mean_amp = amp) for member in self.members]
+
+	def set_mw_duration(self,mw_duration):
+		self.members = [member.with_params(mw_duration = mw_duration) for member in self.members]
+		self.recalculate()
+
+	def recalculate(self):
+		''' The members are snapshots with their own caches (see with_params), only the batch caches are reset '''
+		self.H_eig = None
+		self.reset_caches()
+		self.pulse_cache.clear()
+		self._define_e_operators()
+
+	def reset_caches(self):
+		self.cache_system_evn_taus = []
+		self.cache_system_evn_Unitaries = []
+
+	def _define_e_operators(self):
+		''' Finite pulses differ between the members, perfect pulses and the other electron operators are shared '''
+		finite_pulses = hasattr(self.members[0],'mw_pulse')
+		for op_string in self.mw_ops:
+			if finite_pulses:
+				setattr(self,op_string, lambda perfect_pulse = False, amp_val = None, op_string = op_string: getattr(self.members[0],op_string)(perfect_pulse = True) if perfect_pulse else self.mw_pulse(*self.mw_op_params[op_string], amp = amp_val))
+			else:
+				setattr(self,op_string, getattr(self.members[0],op_string))
+		if finite_pulses:
+			self.re = lambda theta,phi,amp=None: self.mw_pulse(theta,phi,amp)
+
+	def NV_carbon_system_Hamiltonian(self):
+		''' Stacked system Hamiltonians of the members '''
+		return batched_operator([member.NV_carbon_system_Hamiltonian().full() for member in self.members], self._Ide.dims)
+
+	def NV_carbon_ev(self,tau):
+		''' Free evolution of all members over tau, from the (cached) eigendecomposition of the stacked Hamiltonians '''
+		if tau in self.cache_system_evn_taus:
+			return self.cache_system_evn_Unitaries[self.cache_system_evn_taus.index(tau)]
+
+		if self.H_eig is None:
+			self.H_eig = np.linalg.eigh(self.NV_carbon_system_Hamiltonian().data)
+		vals, vecs = self.H_eig
+		unitary = batched_operator(np.matmul(vecs * np.exp(-1j * tau * vals)[:, np.newaxis, :], np.conj(np.swapaxes(vecs, -1, -2))), self._Ide.dims)
+
+		if self.cache_system_evn:
+			self.cache_system_evn_taus.append(tau)
+			self.cache_system_evn_Unitaries.append(unitary)
+		return unitary
+
+	def mw_pulse(self,theta,phi,amp=None):
+		''' noisy_NV_system.mw_pulse for all members '''
+		if amp is None:
+			amp = self.amp_val()
+
+		# As for a single system, with the detunings of all members
+		key = (theta, phi, amp, self.mw_duration, tuple(member.NV_detuning for member in self.members), self.pulse_shape, self.calc_steps,
+			   self.norm_pulse, self.compensate_mw_detuning, tuple(member.mw_detuning for member in self.members))
+		return self.pulse_cache.get(key, lambda : self.finite_microwave_pulse(self.mw_duration,theta,phi*amp))
+
+	def finite_microwave_pulse(self,duration,theta,phi,steps=None):
+		''' noisy_NV_system.finite_microwave_pulse for all members, with batched exponentials '''
+		if steps is None:
+			steps = self.calc_steps
+
+		duration = float(duration)
+		Hsys = self.NV_carbon_system_Hamiltonian().data
+		Hint = self.e_op(np.cos(theta)*sx + np.sin(theta)*sy).full()
+
+		if self.pulse_shape == 'square':
+			return batched_operator(batched_expm_hermitian(duration*Hsys + phi*Hint), self._Ide.dims)
+
+		elif self.pulse_shape == 'Hermite':
+			dt = duration/steps
+			t = np.arange(0+dt/2,duration,dt)
+			if self.norm_pulse is None:
+				normfactor = steps/(duration*np.sum(self.gaussian_envelope(t,duration)))
+			else:
+				normfactor = self.norm_pulse
 
+			combinedU = batched_operator(batched_expm_hermitian(dt*(Hsys + self.gaussian_envelope(t[0],duration)*normfactor*phi*Hint)), self._Ide.dims)
+			for ts in t[1:]:
+				combinedU = batched_operator(batched_expm_hermitian(dt*(Hsys + self.gaussian_envelope(ts,duration)*normfactor*phi*Hint)), self._Ide.dims) * combinedU
 
+			if self.compensate_mw_detuning:
+				detunings = [member.NV_detuning if member.mw_detuning is None else member.mw_detuning for member in self.members]
+				combinedU = batched_operator([self.e_op((1j*2*np.pi*detuning*member.sign*szPseudo1_2 * duration).expm()).full()
+											  for member, detuning in zip(self.members, detunings)], self._Ide.dims) * combinedU
+			return combinedU
+
+
+
+def _carbon_liouvillian(H_a,H_b,jump_ops):
+	''' Generator of d/dt X = -i(H_a X - X H_b) + sum_L (L X L^dag - {L^dag L, X}/2) on row-major vectorised 2x2 X,
+	using vec(A X B) = (A kron B^T) vec(X) '''
+	I2 = np.eye(2)
+	L = -1j * np.kron(H_a, I2) + 1j * np.kron(I2, H_b.T)
+	for op in jump_ops:
+		LdL = np.dot(op.conj().T, op)
+		L += np.kron(op, op.conj()) - 0.5 * np.kron(LdL, I2) - 0.5 * np.kron(I2, LdL.T)
+	return L
+
+def _relaxation_ops(T1,T2):
+	''' Jump operators for a spin 1/2 relaxing to the fully mixed state at 1/T1 with coherence decay rate
+	max(1/T2, 1/2T1), and the coherence decay rate '''
+	ops = []
+	rate = 0.0
+	if T1 is not None:
+		ops += [np.sqrt(0.5 / T1) * np.array([[0.0, 1.0], [0.0, 0.0]]), np.sqrt(0.5 / T1) * np.array([[0.0, 0.0], [1.0, 0.0]])]
+		rate = 0.5 / T1
+	if T2 is not None and 1.0 / T2 > rate:
+		ops.append(np.sqrt(0.5 * (1.0 / T2 - rate)) * np.diag([1.0, -1.0]))
+		rate = 1.0 / T2
+	return ops, rate
+
+class free_evolution_channel(object):
+	''' Free evolution over tau of an NV_system with decoherence, acting on density matrices (Liouville space).
+	The Hamiltonian is block diagonal in the electron state and within each block a sum over the carbons, and all the
+	decoherence acts on single spins. So on each electron block rho_ab (a, b = 0, 1) of the density matrix, the
+	propagator factorises into one 4x4 superoperator per carbon, times a scalar for the electron coherence, instead of
+	a (4^(n+1))^2 superoperator for n carbons. Electron T1 mixes the blocks rho_00 and rho_11, and is applied for tau/2
+	either side of the rest (Strang splitting, accurate for tau << e_T1). '''
+
+	def __init__(self,NV_system,tau):
+		if NV_system.inc_nitrogen:
+			raise ValueError('Decoherence is not implemented with the nitrogen')
+		self.tau = tau
+		self.num_carbons = NV_system.num_carbons
+
+		C_T1s = NV_system.C_T1 if isinstance(NV_system.C_T1, (list, tuple, np.ndarray)) else [NV_system.C_T1] * self.num_carbons
+		C_T2s = NV_system.C_T2 if isinstance(NV_system.C_T2, (list, tuple, np.ndarray)) else [NV_system.C_T2] * self.num_carbons
+
+		H, e_energies = NV_system.carbon_block_Hamiltonians()
+		self.carbon_superops = np.empty([2, 2, self.num_carbons, 4, 4], dtype = complex)
+		for i in range(self.num_carbons):
+			jump_ops = _relaxation_ops(C_T1s[i], C_T2s[i])[0]
+			for a in range(2):
+				for b in range(2):
+					self.carbon_superops[a, b, i] = scipy.linalg.expm(tau * _carbon_liouvillian(H[i, a], H[i, b], jump_ops))
+
+		e_decay = np.exp(-tau * _relaxation_ops(NV_system.e_T1, NV_system.e_T2)[1])
+		self.e_factors = np.exp(-1j * tau * (e_energies[:, np.newaxis] - e_energies[np.newaxis, :])) * np.array([[1.0, e_decay], [e_decay, 1.0]])
+		self.e_T1_half_mix = 0.0 if NV_system.e_T1 is None else 0.5 * (1 - np.exp(-0.5 * tau / NV_system.e_T1))
+
+	def _e_T1_half_step(self,rho):
+		if self.e_T1_half_mix:
+			p = self.e_T1_half_mix
+			rho[0, :, 0, :], rho[1, :, 1, :] = (1 - p) * rho[0, :, 0, :] + p * rho[1, :, 1, :], (1 - p) * rho[1, :, 1, :] + p * rho[0, :, 0, :]
+		return rho
+
+	def apply(self,rho):
+		''' Evolve the density matrix rho (numpy array, electron first) '''
+		n = self.num_carbons
+		d = 2**n
+		rho = self._e_T1_half_step(np.array(rho, dtype = complex).reshape(2, d, 2, d))
+		for a in range(2):
+			for b in range(2):
+				block = rho[a, :, b, :].reshape([2] * (2 * n))
+				for i in range(n): # Superoperator of carbon i on its row and column index
+					block = np.tensordot(self.carbon_superops[a, b, i].reshape(2, 2, 2, 2), block, axes = ([2, 3], [i, n + i]))
+					block = np.moveaxis(block, [0, 1], [i, n + i])
+				rho[a, :, b, :] = self.e_factors[a, b] * block.reshape(d, d)
+		return self._e_T1_half_step(rho).reshape(2 * d, 2 * d)
+
+def _channel_action(gate,op):
+	''' How apply_sequence_channels applies the unitary (or projector) op of gate: (True, u) if op = u x 1 is electron only
+	(e.g. perfect pulses), so that u acts on the electron blocks, otherwise (False, op as an array). Classified once per gate
+	and operator, which are cached by the system, rather than for every repetition '''
+	cached = getattr(gate,'_channel_action',None)
+	if cached is not None and cached[0] is op:
+		return cached[1]
+	U = op.full()
+	d = len(U) // 2
+	u = U[::d,::d]
+	action = (True, u) if np.array_equal(U,np.kron(u,np.eye(d))) else (False, U)
+	gate._channel_action = (op, action)
+	return action
+
+def apply_sequence_channels(sequence,rho,system = None):
+	''' Apply a gate sequence gate by gate to the density matrix rho (numpy array), for sequences containing
+	free_evolution_channels. Gates (unitaries or projectors) act as rho -> U rho U^dag '''
+	for gate,reps in sequence:
+		if isinstance(gate,collections.deque): # Sequences can contain sequences!
+			for rep in range(int(reps)):
+				rho = apply_sequence_channels(gate,rho,system)
+			continue
+		op = gate.gate_op(system)
+		if isinstance(op,free_evolution_channel):
+			for rep in range(int(reps)):
+				rho = op.apply(rho)
+			continue
+		electron_only, U = _channel_action(gate,op)
+		d = len(rho) // 2
+		for rep in range(int(reps)):
+			if electron_only: # Act on the electron blocks only
+				rho = np.tensordot(np.tensordot(U,rho.reshape(2,d,2,d),axes = (1,0)),U.conj(),axes = (2,1))
+				rho = rho.transpose(0,1,3,2).reshape(2*d,2*d)
+			else:
+				rho = np.dot(np.dot(U,rho),U.conj().T)
+	return rho
+
+class ket_propagator(object):
+	''' A propagator that is never built, only its action apply(kets) on kets (columns of a numpy array). matrices are the
+	(sparse or dense) matrices the action holds on to, for its memory footprint '''
+	def __init__(self,apply,matrices = ()):
+		self.apply = apply
+		self.nbytes = sum(propagator_cache.propagator_nbytes(matrix) for matrix in matrices)
+
+class ket_ensemble(object):
+	''' Density matrix as a weighted ensemble of kets, rho = sum_k weights[k] |kets[:,k]><kets[:,k]| '''
+
+	def __init__(self,kets,weights,dims):
+		self.kets = np.asarray(kets, dtype = complex)
+		self.weights = np.asarray(weights, dtype = float)
+		self.dims = dims
+
+	def expect(self,op):
+		''' Tr(op rho) for a (sparse) Qobj operator '''
+		values = np.sum(self.kets.conj() * op.data.dot(self.kets), axis = 0)
+		return np.real(np.dot(self.weights, values))
+
+	def tr(self):
+		return np.dot(self.weights, np.sum(np.abs(self.kets)**2, axis = 0))
+
+	def unit(self):
+		return ket_ensemble(self.kets, self.weights / self.tr(), self.dims)
+
+def pure_state_ensemble(rho,tol = 1e-12):
+	''' Exact ket_ensemble of a density matrix (Qobj) from its eigendecomposition, so only for moderate sizes '''
+	if rho.isket:
+		return ket_ensemble(rho.full(), [1.0], [rho.dims[0]] * 2)
+	vals, vecs = np.linalg.eigh(rho.full())
+	keep = vals > tol * np.max(vals)
+	return ket_ensemble(vecs[:, keep], vals[keep], rho.dims)
+
+def random_state_ensemble(factors,members,seed = None):
+	''' ket_ensemble for the product state of the density matrices factors (Qobjs, one per spin) from members random
+	states, psi = (sqrt(rho_1) x sqrt(rho_2) x ...) r with random phase vectors r, so that E[psi psi^dag] = rho
+	(typicality). For an n carbon mixed register the statistical error of an expectation value falls as 2^(-n/2) '''
+	rng = np.random.RandomState(seed)
+	dims = [int(f.shape[0]) for f in factors]
+	kets = np.exp(2j * np.pi * rng.random_sample(dims + [members]))
+	for i, f in enumerate(factors):
+		vals, vecs = np.linalg.eigh(f.full())
+		sqrt_f = np.dot(vecs * np.sqrt(np.maximum(vals, 0)), vecs.conj().T)
+		kets = np.moveaxis(np.tensordot(sqrt_f, kets, axes = (1, i)), 0, i)
+	return ket_ensemble(kets.reshape(-1, members), np.ones(members) / members, [dims, dims])
+
+def apply_sequence_kets(sequence,kets,system = None):
+	''' Apply a gate sequence gate by gate to kets (columns of a numpy array), for sequences containing ket_propagators.
+	Other gates act through their sparse matrices '''
+	for gate,reps in sequence:
+		for rep in range(int(reps)):
+			if isinstance(gate,collections.deque): # Sequences can contain sequences!
+				kets = apply_sequence_kets(gate,kets,system)
+				continue
+			op = gate.gate_op(system)
+			if isinstance(op,ket_propagator):
+				kets = op.apply(kets)
+			else:
+				kets = op.data.dot(kets)
+	return kets
+
+def expectation(op,state):
+	''' Tr(op state) for a density matrix Qobj, a ket_ensemble, a single_precision_operator or a batched_operator (one
+	value per member) '''
+	if isinstance(state,(ket_ensemble,single_precision_operator,batched_operator)):
+		return state.expect(op)
+	return np.real((op*state).tr())
+
+_double_precision = threading.local() # See double_precision
+
+@contextlib.contextmanager
+def double_precision():
+	''' Within this context, and in the current thread only, systems in single_precision mode calculate their
+	propagators in double precision and without their caches, as a reference for spot checks (see
+	basic_gate_sequence.precision_error). Nothing is changed on the systems, so they can be shared with other threads '''
+	active = getattr(_double_precision, 'active', False)
+	_double_precision.active = True
+	try:
+		yield
+	finally:
+		_double_precision.active = active
+
+def _compact(data):
+	''' complex64 matrix data as sparse (CSR) or dense, whichever takes less memory '''
+	if scipy.sparse.issparse(data):
+		data = scipy.sparse.csr_matrix(data, dtype = np.complex64)
+		if 12 * data.nnz + 4 * data.shape[0] < 8 * data.shape[0] * data.shape[1]: # Value and column index per entry
+			return data
+		return data.toarray()
+	return np.asarray(data, dtype = np.complex64)
+
+def _matmul(a,b):
+	''' a b for sparse or dense a and b, sparse only if both are '''
+	if scipy.sparse.issparse(b) and not scipy.sparse.issparse(a):
+		return b.T.dot(a.T).T
+	return a.dot(b)
+
+class single_precision_operator(object):
+	''' complex64 operator (or density matrix) of an NV_system in single_precision mode, with the Qobj operations used
+	by gate sequences and measurements. The data is sparse or dense, whichever is smaller, and products stay sparse
+	while the operands are. Products of unitaries count their matrix products since they were last re-unitarised, and
+	every reunitarise_every products are projected back onto the closest unitary (see reunitarise). drift accumulates
+	how far from unitary they had got, an estimate of the accumulated rounding error '''
+
+	def __init__(self,data,dims,unitary = True,reunitarise_every = 64,products = 0,drift = 0.0):
+		self.data = _compact(data)
+		self.dims = dims
+		self.unitary = unitary
+		self.reunitarise_every = reunitarise_every
+		self.products = products
+		self.drift = drift
+
+	def full(self):
+		return self.data.toarray() if scipy.sparse.issparse(self.data) else self.data
+
+	def _product(self,data,other,unitary):
+		result = single_precision_operator(data, self.dims, unitary, self.reunitarise_every,
+										   self.products + getattr(other,'products',0) + 1, self.drift + getattr(other,'drift',0.0))
+		if unitary and result.products >= self.reunitarise_every:
+			result.reunitarise()
+		return result
+
+	def __mul__(self,other):
+		if np.isscalar(other):
+			return single_precision_operator(self.data * other, self.dims, self.unitary and abs(other) == 1, self.reunitarise_every, self.products, self.drift)
+		if isinstance(other,single_precision_operator):
+			return self._product(_matmul(self.data, other.data), other, self.unitary and other.unitary)
+		return self._product(_matmul(self.data, _compact(other.data)), other, self.unitary and other.isunitary) # Qobj
+
+	def __rmul__(self,other):
+		if np.isscalar(other):
+			return self * other
+		return self._product(_matmul(_compact(other.data), self.data), other, self.unitary and other.isunitary)
+
+	def __pow__(self,n):
+		n = int(n)
+		if n == 0:
+			return single_precision_operator(scipy.sparse.identity(self.data.shape[0], format = 'csr'), self.dims, True, self.reunitarise_every)
+		result, base = None, self
+		while n:
+			if n & 1:
+				result = base if result is None else base * result
+			n >>= 1
+			if n:
+				base = base * base
+		return result
+
+	def dag(self):
+		return single_precision_operator(self.data.conj().T, self.dims, self.unitary, self.reunitarise_every, self.products, self.drift)
+
+	def tr(self):
+		return np.sum(self.data.diagonal(), dtype = complex)
+
+	def unit(self):
+		return single_precision_operator(self.data / self.tr(), self.dims, False, self.reunitarise_every, self.products, self.drift)
+
+	def expect(self,op):
+		''' Tr(op rho), accumulated in double precision '''
+		return np.real(np.sum(op.full() * self.full().T, dtype = complex))
+
+	def reunitarise(self):
+		''' One Newton-Schulz step U (3 - U^dag U) / 2 towards the polar decomposition, which leaves an error of second
+		order in the drift and costs two matrix products rather than an SVD '''
+		U = self.full()
+		deviation = np.dot(U.conj().T, U) - np.eye(U.shape[0], dtype = np.complex64)
+		self.drift += 0.5 * float(np.max(np.abs(deviation)))
+		self.data = _compact(U - 0.5 * np.dot(U, deviation))
+		self.products = 0
 
 # Helper function for sequences (does the actual calculation of the sequence output!)
-def calc_sequence_operation(sequence):
+def calc_sequence_operation(sequence,system = None):
+	''' system is the NV system the sequence is evaluated on (see system_gate) '''
 	operation = 1.0
 	for gate in sequence:
 		if isinstance(gate[0],collections.deque): # Sequences can contain sequences!
-			operation = calc_sequence_operation(gate[0]) ** gate[1] * operation
+			operation = calc_sequence_operation(gate[0],system) ** gate[1] * operation
 		else:
-			operation = gate[0].gate_op() ** gate[1] * operation
+			operation = gate[0].gate_op(system) ** gate[1] * operation
 	return operation
 
 class gate(object):
@@ -541,10 +1485,21 @@ class gate(object):
 		self.name = name
 		self.gate_function = gate_function
 		self.gate_properties = kw
-	def gate_op(self):
+	def gate_op(self,system = None):
 		# Written this way so that could in principle mess with the properties after defined!
 		# Maybe nuclear gates should have more of this functionality
 		return self.gate_function(**self.gate_properties)
+	def __getstate__(self):
+		# Copies (see copy_seq) leave out the operator cached by apply_sequence_channels
+		state = dict(self.__dict__)
+		state.pop('_channel_action', None)
+		return state
+
+class system_gate(gate):
+	''' Gate whose function also takes the NV system the sequence is evaluated on, as its first argument. Sequences of
+	these can be evaluated on snapshots of the system they were built on (see basic_gate_sequence.seq_operation) '''
+	def gate_op(self,system = None):
+		return self.gate_function(system,**self.gate_properties)
 
 
 class basic_gate_sequence(object):
@@ -559,28 +1514,34 @@ class basic_gate_sequence(object):
 		self.sequence = collections.deque()
 
 	def add_gate_helper(self,gate_func,name = None, **kw):
+		''' gate_func is a function of the gate properties kw, or the name of an NV system method, which is then called on
+		the system the sequence is evaluated on '''
 		before = kw.pop('before', False)
 		reps = kw.pop('reps', 1)
-		g =  gate(gate_func,name, **kw)
+		if isinstance(gate_func,str):
+			method = gate_func
+			g = system_gate(lambda system, **properties : getattr(system,method)(**properties), name, **kw)
+		else:
+			g =  gate(gate_func,name, **kw)
 		self.add_gate_to_seq(g, before = before, reps = reps)
 
 		return self
 
 	def _define_gates(self):
 		''' This is written this way so that could be overwritten for more complex behaviour'''
-		self.Xe = lambda **kw : self.add_gate_helper(self.NVsys.Xe,name ='Xe',**kw)
-		self.Ye = lambda **kw : self.add_gate_helper(self.NVsys.Ye,name ='Ye',**kw)
-		self.mXe = lambda **kw : self.add_gate_helper(self.NVsys.mXe,name ='mXe',**kw)
-		self.mYe = lambda **kw : self.add_gate_helper(self.NVsys.mYe,name ='mXe',**kw)
-		self.xe = lambda **kw : self.add_gate_helper(self.NVsys.xe,name ='xe',**kw)
-		self.ye = lambda **kw : self.add_gate_helper(self.NVsys.ye,name ='ye',**kw)
-		self.mxe = lambda **kw : self.add_gate_helper(self.NVsys.mxe,name ='mxe',**kw)
-		self.mye = lambda **kw : self.add_gate_helper(self.NVsys.mye,name ='mye',**kw)
+		self.Xe = lambda **kw : self.add_gate_helper('Xe',name ='Xe',**kw)
+		self.Ye = lambda **kw : self.add_gate_helper('Ye',name ='Ye',**kw)
+		self.mXe = lambda **kw : self.add_gate_helper('mXe',name ='mXe',**kw)
+		self.mYe = lambda **kw : self.add_gate_helper('mYe',name ='mXe',**kw)
+		self.xe = lambda **kw : self.add_gate_helper('xe',name ='xe',**kw)
+		self.ye = lambda **kw : self.add_gate_helper('ye',name ='ye',**kw)
+		self.mxe = lambda **kw : self.add_gate_helper('mxe',name ='mxe',**kw)
+		self.mye = lambda **kw : self.add_gate_helper('mye',name ='mye',**kw)
 
-		self.proj0 = lambda **kw : self.add_gate_helper(self.NVsys.proj0,name='proj0',**kw)
-		self.proj1 = lambda **kw : self.add_gate_helper(self.NVsys.proj0,name='proj1',**kw)
+		self.proj0 = lambda **kw : self.add_gate_helper('proj0',name='proj0',**kw)
+		self.proj1 = lambda **kw : self.add_gate_helper('proj0',name='proj1',**kw)
 
-		self.re = lambda **kw: self.add_gate_helper(self.NVsys.re,**kw) # Note that need to pass theta and tau when calling this!
+		self.re = lambda **kw: self.add_gate_helper('re',**kw) # Note that need to pass theta and tau when calling this!
 
 	def add_gate_to_seq(self,gate,reps=1,before=False):
 
@@ -594,10 +1555,40 @@ class basic_gate_sequence(object):
 
 		return self
 
-	def seq_operation(self):
-		return calc_sequence_operation(self.sequence)
+	def seq_operation(self,system = None):
+		''' Sequence unitary on the system it was built on or, for system, on a snapshot of that system '''
+		system = self.NVsys if system is None else system
+		if system.has_decoherence():
+			raise ValueError('A sequence with decoherence is not a unitary, use apply_sequence')
+		if system.krylov:
+			raise ValueError('Sequence unitaries are not built in krylov mode, use apply_sequence')
+		return calc_sequence_operation(self.sequence,system)
+
+	def precision_error(self):
+		''' Spot check of the sequence operation in single_precision mode against double precision. Returns the largest
+		singular value of their difference, and the drift estimate accumulated by the single precision products '''
+		U = self.seq_operation()
+		with double_precision():
+			U_ref = self.seq_operation()
+		return np.linalg.norm(U.full() - U_ref.full(), 2), getattr(U, 'drift', 0.0)
 
 	def apply_sequence(self,state,reps=1,norm = False):
+		if self.NVsys.krylov:
+			if not isinstance(state,ket_ensemble):
+				state = pure_state_ensemble(state)
+			kets = state.kets
+			for rep in range(int(reps)):
+				kets = apply_sequence_kets(self.sequence,kets,self.NVsys)
+			sysout = ket_ensemble(kets, state.weights, state.dims)
+			return sysout.unit() if norm else sysout
+
+		if self.NVsys.has_decoherence():
+			rho = state.full()
+			for rep in range(int(reps)):
+				rho = apply_sequence_channels(self.sequence,rho,self.NVsys)
+			sysout = qutip.Qobj(rho, dims = state.dims)
+			return sysout.unit() if norm else sysout
+
 		operation = self.seq_operation()**reps
 		if not(isinstance(operation,float)):
 			sysout = operation * state * operation.dag()
@@ -623,14 +1614,15 @@ class NV_gate_sequence(basic_gate_sequence):
 		copied_seq.sequence = copy.deepcopy(self.sequence)
 		return copied_seq
 
-	def nuclear_ev_gate(self,in_tau,tau_factor=1.0,double_sided = False):
+	def nuclear_ev_gate(self,in_tau,tau_factor=1.0,double_sided = False,system = None):
 
 		if callable(in_tau):
 			tau = in_tau()
 		else:
 			tau = in_tau
 
-		return self.NVsys.NV_carbon_ev(self.nuclear_gate_tau(tau_factor*tau, double_sided = double_sided))
+		system = self.NVsys if system is None else system
+		return system.NV_carbon_ev(self.nuclear_gate_tau(tau_factor*tau, double_sided = double_sided, system = system))
 
 	def nuclear_gate(self,N,tau,**kw):
 
@@ -639,9 +1631,9 @@ class NV_gate_sequence(basic_gate_sequence):
 			return
 
 		# Note that these are functions, so that evaluated when the gate sequence is evaluated!
-		evNV_C_tau =  gate(lambda : self.nuclear_ev_gate(tau, double_sided = True),'tau')
-		evNV_C_tau_single =  gate(lambda : self.nuclear_ev_gate(tau),'tau_single')
-		evNV_C_2tau =  gate(lambda : self.nuclear_ev_gate(tau, tau_factor=2.0, double_sided = True),'2_tau')
+		evNV_C_tau =  system_gate(lambda system : self.nuclear_ev_gate(tau, double_sided = True, system = system),'tau')
+		evNV_C_tau_single =  system_gate(lambda system : self.nuclear_ev_gate(tau, system = system),'tau_single')
+		evNV_C_2tau =  system_gate(lambda system : self.nuclear_ev_gate(tau, tau_factor=2.0, double_sided = True, system = system),'2_tau')
 
 		scheme = kw.pop('scheme',self.decouple_scheme)
 
@@ -661,7 +1653,7 @@ class NV_gate_sequence(basic_gate_sequence):
 			seq_repeat.add_gate_to_seq(evNV_C_2tau)
 			seq_repeat.Xe()
 			seq_repeat.add_gate_to_seq(evNV_C_tau_single)
-			seq.add_gate_to_seq(seq_repeat,reps=(N/2-1))
+			seq.add_gate_to_seq(seq_repeat,reps=(N//2-1))
 
 			seq.add_gate_to_seq(evNV_C_tau_single)
 			seq.Ye()
@@ -698,7 +1690,7 @@ class NV_gate_sequence(basic_gate_sequence):
 			seq_repeatb.add_gate_to_seq(evNV_C_tau_single)
 
 			seq_repeat.add_gate_to_seq(seq_repeata,reps=2).add_gate_to_seq(seq_repeatb,reps=2)
-			seq.add_gate_to_seq(seq_repeat,reps = (N/8-1))
+			seq.add_gate_to_seq(seq_repeat,reps = (N//8-1))
 
 			seq.add_gate_to_seq(evNV_C_tau)
 			seq.Ye()
@@ -736,10 +1728,11 @@ class NV_gate_sequence(basic_gate_sequence):
 		self.add_gate_to_seq(seq,**kw)
 		return self
 
-	def nuclear_gate_tau(self,tau,double_sided = False):
+	def nuclear_gate_tau(self,tau,double_sided = False,system = None):
 
 		'''Helper function to get tau for gate seq'''
-		tau_correction_factor = self.NVsys.tau_correction_factor if hasattr(self.NVsys,'tau_correction_factor') else 0
+		system = self.NVsys if system is None else system
+		tau_correction_factor = system.tau_correction_factor if hasattr(system,'tau_correction_factor') else 0
 
 		scale_fact = 0.5 if not(double_sided) else 1.0
 
@@ -750,7 +1743,7 @@ class NV_gate_sequence(basic_gate_sequence):
 
 	def wait_gate(self,tau,**kw):
 		''' Do nothing! '''
-		self.add_gate_to_seq(gate(lambda : self.nuclear_ev_gate(tau),'wait_gate'),**kw)
+		self.add_gate_to_seq(system_gate(lambda system : self.nuclear_ev_gate(tau, system = system),'wait_gate'),**kw)
 		return self
 	def nuclear_phase_gate(self,carbon_nr, phase, state = 'sup',**kw):
 
@@ -773,6 +1766,43 @@ class NV_gate_sequence(basic_gate_sequence):
 		self.nuclear_gate(N ,tau)
 		self.mxe()
 
+	def unitary_samples(self,amps = None):
+		''' Compiled sequence unitary, or a list of them for a batch of MW amplitude samples (one unitary per sample, each
+		on a snapshot of the system). The unitary of an empty sequence is the identity '''
+		systems = [self.NVsys] if amps is None else [self.NVsys.with_params(mean_amp = amp) for amp in amps]
+		Us = [self.seq_operation(system) for system in systems]
+		return [system._Ide if isinstance(U,float) else U for system, U in zip(systems, Us)]
+
+	def gate_fidelity(self,target,c_nums = None,amps = None):
+		''' Process and average gate fidelity of the sequence unitary against a target unitary.
+		If c_nums is None the target acts on the full system, otherwise it acts on the electron plus the listed carbons
+		(in that order) and all other spins are treated as maximally mixed spectators.
+		Returns (F_pro, F_avg), as arrays over the samples if amps is given. '''
+
+		Us = self.unitary_samples(amps)
+		keep = None if c_nums is None else [0] + list(c_nums)
+		d = np.shape(target)[0]
+
+		F_pro = np.array([process_fidelity(U, target, dims = U.dims[0], keep = keep) for U in Us])
+		F_avg = average_gate_fidelity(F_pro, d)
+
+		if amps is None:
+			return F_pro[0], F_avg[0]
+		return F_pro, F_avg
+
+	def conditional_rotations(self,amps = None):
+		''' Per-carbon conditional rotations of the sequence unitary (see unitary_conditional_rotations).
+		If amps is given, axes and angles get a leading axis over the amplitude samples. '''
+
+		Us = self.unitary_samples(amps)
+		rotations = [unitary_conditional_rotations(U, self.NVsys.num_carbons) for U in Us]
+		axes = np.array([r[0] for r in rotations])
+		angles = np.array([r[1] for r in rotations])
+
+		if amps is None:
+			return axes[0], angles[0]
+		return axes, angles
+
 
 
 class NV_experiment(object):
@@ -802,13 +1832,30 @@ class NV_experiment(object):
 		self.output_state = gate_sequence.apply_sequence(self.output_state, **kw)
 		return self
 
+	def quasi_static_samples(self,measurement,samples):
+		''' measurement(experiment) for each sample of the system parameters (dicts of any of amp, detuning and B_field),
+		on a new experiment with this initial state on a snapshot of the system (see noise_snapshot). measurement should
+		build its gate sequences with experiment.gate_sequence(), so that they see the sample '''
+		values = []
+		for sample in samples:
+			nv_expm = NV_experiment(noise_snapshot(self.NVsys, **sample))
+			nv_expm.reset_init_state(self.specified_initial_state)
+			values.append(measurement(nv_expm))
+		return np.array(values)
+
+	def quasi_static_average(self,measurement,noise,order = 5,sparse = None):
+		''' Weighted mean and variance of measurement(self) over gaussian quasi-static noise on the system parameters,
+		noise = {name : (mean, sigma)} for any of amp, detuning and B_field, from quadrature nodes (see quasi_static_nodes) '''
+		samples, weights = quasi_static_nodes(noise, order = order, sparse = sparse)
+		return weighted_mean_variance(self.quasi_static_samples(measurement, samples), weights)
+
 	def measure_e(self,e_state = 0):
 		if e_state == 0:
 			e_state = self.NVsys.e_op(rho0)
 		elif e_state == 1:
 			e_state = self.NVsys.e_op(rho1)
 
-		return np.real((e_state*self.output_state).tr())
+		return expectation(e_state,self.output_state)
 
 	def measure_c(self,c_num=1,c_state = 0):
 		''' Not directly accessible, but sometimes useful'''
@@ -819,7 +1866,7 @@ class NV_experiment(object):
 
 		proj = self.NVsys.c_op(c_state,c_num)
 
-		return np.real((proj*self.output_state).tr())
+		return expectation(proj,self.output_state)
 
 	def measure_N(self,N_state = 0):
 		''' Not directly accessible, but sometimes useful'''
@@ -832,7 +1879,7 @@ class NV_experiment(object):
 
 		proj = self.NVsys.N_op(N_state)
 
-		return np.real((proj*self.output_state).tr())
+		return expectation(proj,self.output_state)
 
 
 #########################################
@@ -844,43 +1891,74 @@ class NV_experiment(object):
 ''' Here are different experiments that we commonly run on the system'''
 
 
-def C13_fingerprint(NV_system,N = 32, tau_range =  np.arange(1e-6,7e-6,1e-7), calc_indiv = True, quick_calc =False):
-	''' Simple experiment sweeping tau for a fixed N and measuring whether e still in the same state '''
+def fingerprint_resonances(carbon_params, tau_range, N, sign = 1, tau_resolution = 2e-9, threshold = 0.02):
+	''' Predict fingerprint dip positions within tau_range from the analytic dyn_dec_signal model '''
+	taus = np.arange(np.min(tau_range), np.max(tau_range), tau_resolution)
+	signal = 0.5*(1+np.prod(dyn_dec_signal(carbon_params, taus, N, sign = sign), axis = 0))
+	minima = np.nonzero((signal[1:-1] <= signal[:-2]) & (signal[1:-1] < signal[2:]))[0] + 1
+	return taus[minima[(1 - signal[minima]) > threshold]]
+
+def adaptive_tau_sampling(signal_func, tau_range, tau_resolution = 2e-9, seed_taus = None, dev_threshold = 0.02, curv_threshold = 0.01):
+	''' Evaluate signal_func on the coarse grid tau_range (plus seed_taus), then recursively bisect every interval
+	wider than 2*tau_resolution where the signal deviates from 1 by more than dev_threshold, or where the
+	signal deviates from a linear interpolation of its neighbours by more than curv_threshold.
+	Returns the (non-uniform, sorted) tau samples and the signals. '''
+	signals = {}
+	new_taus = np.unique(np.concatenate([np.asarray(tau_range,dtype=float), np.asarray([] if seed_taus is None else seed_taus,dtype=float)]))
+
+	while len(new_taus):
+		for tau in new_taus:
+			signals[tau] = signal_func(tau)
+
+		taus = np.array(sorted(signals))
+		vals = np.array([signals[tau] for tau in taus]).reshape(len(taus),-1)
+
+		refine = np.max(np.abs(1 - vals), axis = 1) > dev_threshold
+		refine = refine[:-1] | refine[1:] # Intervals with a deviating end point
+
+		# Deviation of each interior point from the linear interpolation of its neighbours
+		frac = ((taus[1:-1] - taus[:-2])/(taus[2:] - taus[:-2]))[:,np.newaxis]
+		curved = np.max(np.abs(vals[1:-1] - (1-frac)*vals[:-2] - frac*vals[2:]), axis = 1) > curv_threshold
+		refine[:-1] |= curved
+		refine[1:] |= curved
+
+		refine &= np.diff(taus) > 2*tau_resolution
+		new_taus = 0.5*(taus[:-1] + taus[1:])[refine]
+
+	return taus, np.squeeze(vals)
+
+def C13_fingerprint(NV_system,N = 32, tau_range =  np.arange(1e-6,7e-6,1e-7), calc_indiv = True, quick_calc =False, adaptive = False, num_threads = None, **kw):
+	''' Simple experiment sweeping tau for a fixed N and measuring whether e still in the same state
+	With adaptive = True, tau_range is only the coarse starting grid, which is refined around the fingerprint dips
+	(see adaptive_tau_sampling) and optionally seeded with the analytically predicted dips (seed_resonances = True).
+	Each carbon is then refined separately if calc_indiv, and a list of (taus, signal) per carbon is returned.
+	For a batched_NV_system (e.g. an ensemble of carbon baths) use calc_indiv = False, the signal then has one column per member.
+	With calc_indiv, the carbons are simulated as snapshots (see NV_system.single_carbon), on num_threads threads if given
+	(see thread_map). '''
+	if adaptive:
+		return _adaptive_C13_fingerprint(NV_system, N, tau_range, calc_indiv, num_threads = num_threads, **kw)
+
 	if not(quick_calc):
 		if calc_indiv:
 
-			exp0 = np.zeros((np.shape(tau_range)[0],NV_system.num_carbons))
-
-			carbon_params = NV_system.carbon_params
-			c_prec_freqs = NV_system.c_prec_freqs
-
-
-			nv_expm = NV_experiment(NV_system)
-			gate_seq = nv_expm.gate_sequence()
-			gate_seq.xe(), gate_seq.nuclear_gate(N ,lambda : tau), gate_seq.mxe() # can define tau later! Cool huh
-
-
-			for j, carbon_param in enumerate(carbon_params):
-
-				NV_system.carbon_params = [carbon_param]
-				NV_system.num_carbons = 1
-				NV_system.c_prec_freqs = [c_prec_freqs[j]]
-				NV_system.recalculate()
+			def carbon_signal(j):
+				nv_expm = NV_experiment(NV_system.single_carbon(j))
+				gate_seq = nv_expm.gate_sequence()
+				gate_seq.xe(), gate_seq.nuclear_gate(N ,lambda : tau), gate_seq.mxe() # can define tau later! Cool huh
 
+				signal = np.zeros(np.shape(tau_range)[0])
 				for i,tau in enumerate(tau_range):
 
 					nv_expm.reset_output_state()
 					nv_expm.apply_gates(gate_seq)
-					exp0[i,j] = nv_expm.measure_e()
-			# Reset to old values
-			NV_system.carbon_params = carbon_params
-			NV_system.num_carbons = len(carbon_params)
-			NV_system.c_prec_freqs = c_prec_freqs
-			NV_system.recalculate()
+					signal[i] = nv_expm.measure_e()
+				return signal
+
+			exp0 = np.array(thread_map(carbon_signal, range(NV_system.num_carbons), num_threads)).T
 
 		else:
 
-			exp0 = np.zeros((np.shape(tau_range)[0]))
+			exp0 = []
 			nv_expm = NV_experiment(NV_system)
 			gate_seq = nv_expm.gate_sequence()
 			gate_seq.xe(), gate_seq.nuclear_gate(N ,lambda : tau), gate_seq.mxe()
@@ -889,9 +1967,9 @@ def C13_fingerprint(NV_system,N = 32, tau_range =  np.arange(1e-6,7e-6,1e-7), ca
 			for i,tau in enumerate(tau_range):
 
 				nv_expm.reset_output_state()
-				gate_seq = nv_expm.gate_sequence()
 				nv_expm.apply_gates(gate_seq)
-				exp0[i] = nv_expm.measure_e()
+				exp0.append(nv_expm.measure_e())
+			exp0 = np.array(exp0) # taus x members for a batched_NV_system
 
 
 	else:
@@ -906,23 +1984,56 @@ def C13_fingerprint(NV_system,N = 32, tau_range =  np.arange(1e-6,7e-6,1e-7), ca
 	plt.show()
 	plt.close()
 
+	return tau_range, exp0
 
+def _adaptive_C13_fingerprint(NV_system, N, tau_range, calc_indiv, num_threads = None, **kw):
 
+	seed_resonances = kw.pop('seed_resonances',True)
+	tau_resolution = kw.pop('tau_resolution',2e-9)
 
-def sweep_MW_amp(noisy_NV_system,N = 11, amp_range =  np.arange(0.1,2,0.05), tau = 7.5e-6,**kw):
+	def refine(system):
+		tau_val = [tau_range[0]]
+		nv_expm = NV_experiment(system)
+		gate_seq = nv_expm.gate_sequence()
+		gate_seq.xe(), gate_seq.nuclear_gate(N ,lambda : tau_val[0]), gate_seq.mxe()
 
-	nv_expm = NV_experiment(noisy_NV_system)
-	gate_seq = nv_expm.gate_sequence()
-	gate_seq.nuclear_gate(N ,tau, scheme = 'simple')
+		def signal(tau):
+			tau_val[0] = tau
+			nv_expm.reset_output_state()
+			nv_expm.apply_gates(gate_seq)
+			return nv_expm.measure_e()
 
-	results = np.zeros(np.shape(amp_range))
+		seed_taus = fingerprint_resonances(system.carbon_params, tau_range, N, sign = system.sign, tau_resolution = tau_resolution) if seed_resonances else []
+		return adaptive_tau_sampling(signal, tau_range, tau_resolution = tau_resolution, seed_taus = seed_taus, **kw)
+
+	systems = [NV_system.single_carbon(j) for j in range(NV_system.num_carbons)] if calc_indiv else [NV_system]
+	results = thread_map(refine, systems, num_threads)
+
+	width = 12
+	height = 4
+	plt.figure(figsize=(width, height))
+	for taus, exp0 in results:
+		plt.plot(taus*1e6,exp0,'.-')
+	plt.title('Signal for N=%s (%d evaluations)'%(N, np.sum([len(taus) for taus, exp0 in results]))); plt.xlabel('Tau')
+	plt.ylim([-0.1,1.1])
+	plt.show()
+	plt.close()
+
+	return results if calc_indiv else results[0]
 
-	for i,amp in enumerate(amp_range):
 
-		noisy_NV_system.set_mw_amp(amp)
-		nv_expm.apply_gates(gate_seq)
-		results[i] = nv_expm.measure_e()
-		nv_expm.reset_output_state()
+
+
+def sweep_MW_amp(noisy_NV_system,N = 11, amp_range =  np.arange(0.1,2,0.05), tau = 7.5e-6, num_threads = None, **kw):
+	''' Each amplitude is a snapshot of noisy_NV_system (see NV_system.with_params), on num_threads threads if given (see thread_map) '''
+
+	def signal(amp):
+		nv_expm = NV_experiment(noisy_NV_system.with_params(mean_amp = amp))
+		gate_seq = nv_expm.gate_sequence()
+		gate_seq.nuclear_gate(N ,tau, scheme = 'simple')
+		return nv_expm.apply_gates(gate_seq).measure_e()
+
+	results = np.array(thread_map(signal, amp_range, num_threads))
 
 
 	plt.figure()
@@ -932,26 +2043,20 @@ def sweep_MW_amp(noisy_NV_system,N = 11, amp_range =  np.arange(0.1,2,0.05), tau
 	plt.show()
 	plt.close()
 
-	noisy_NV_system.set_mw_amp(1)
-
 	ind = np.argmin(results)
 	print('Min sig. ', results[ind], ' at ', amp_range[ind])
 
 
-def sweep_MW_duration(noisy_NV_system,N = 11, duration_range =  np.arange(50,200,10)*1e-9, tau = 7.5e-6,**kw):
-
-	nv_expm = NV_experiment(noisy_NV_system)
-	gate_seq = nv_expm.gate_sequence()
-	gate_seq.nuclear_gate(N ,tau, scheme = 'simple')
+def sweep_MW_duration(noisy_NV_system,N = 11, duration_range =  np.arange(50,200,10)*1e-9, tau = 7.5e-6, num_threads = None, **kw):
+	''' Each duration is a snapshot of noisy_NV_system (see NV_system.with_params), on num_threads threads if given (see thread_map) '''
 
-	results = np.zeros(np.shape(duration_range))
-
-	for i,duration in enumerate(duration_range):
+	def signal(duration):
+		nv_expm = NV_experiment(noisy_NV_system.with_params(mw_duration = duration))
+		gate_seq = nv_expm.gate_sequence()
+		gate_seq.nuclear_gate(N ,tau, scheme = 'simple')
+		return nv_expm.apply_gates(gate_seq).measure_e()
 
-		noisy_NV_system.set_mw_duration(duration)
-		nv_expm.apply_gates(gate_seq)
-		results[i] = nv_expm.measure_e()
-		nv_expm.reset_output_state()
+	results = np.array(thread_map(signal, duration_range, num_threads))
 
 
 	plt.figure()
@@ -962,29 +2067,74 @@ def sweep_MW_duration(noisy_NV_system,N = 11, duration_range =  np.arange(50,200
 	plt.close()
 
 
-def MonteCarlo_MWFid(noisy_NV_system,N = 11, tau = 7.5e-6,N_rand = 100,mean = 1.0,sigma=0.01):
-	'''Simulate doing microwave pulses with a certain standard deviation on the pulse amplitude from trial to trial '''
+def _mw_fid_measurement(N,tau):
+	''' Measurement of MonteCarlo_MWFid. The sequence is built on the experiment's system, so that it sees the noise sample '''
+	def measurement(nv_expm):
+		gate_seq = nv_expm.gate_sequence()
+		gate_seq.nuclear_gate(N ,tau, scheme = 'simple')
+		return nv_expm.apply_gates(gate_seq).measure_e()
+	return measurement
+
+def MonteCarlo_MWFid(noisy_NV_system,N = 11, tau = 7.5e-6,N_rand = 100,mean = 1.0,sigma=0.01,detuning_sigma = 0.0,B_sigma = 0.0,quadrature_order = None,
+		target_error = None,max_time = None,batch_size = 20):
+	'''Simulate doing microwave pulses with a certain standard deviation on the pulse amplitude from trial to trial.
+	detuning_sigma (Hz) and B_sigma (G) add quasi-static noise on the NV detuning and B field around their current values.
+	With quadrature_order the noise is averaged on quadrature nodes (see quasi_static_nodes) instead of N_rand random draws,
+	and the mean and variance are returned instead of the samples.
+	With target_error (standard error) or max_time (s), samples are drawn in batches until either is reached, with N_rand as
+	the maximum number of samples (see MonteCarlo_MWFid_batches) '''
+
+	if target_error is not None or max_time is not None:
+		for result in MonteCarlo_MWFid_batches(noisy_NV_system, N = N, tau = tau, mean = mean, sigma = sigma, detuning_sigma = detuning_sigma,
+				B_sigma = B_sigma, batch_size = batch_size, target_error = target_error, max_time = max_time, max_samples = N_rand, keep_samples = True):
+			pass
+		print("Infidelity is %f \pm %f (%d samples, %.1f s)" % (result['mean'], result['std_error'], result['count'], result['elapsed']))
+		return result['samples']
 
 	nv_expm = NV_experiment(noisy_NV_system)
-	gate_seq = nv_expm.gate_sequence()
-	gate_seq.nuclear_gate(N ,tau, scheme = 'simple')
-
-	rands = np.random.normal(loc = mean,scale=sigma, size=N_rand)
-	infids = np.zeros(N_rand)
+	noise = {'amp' : (mean,sigma), 'detuning' : (noisy_NV_system.NV_detuning,detuning_sigma), 'B_field' : (noisy_NV_system.B_field,B_sigma)}
+	measurement = _mw_fid_measurement(N, tau)
 
-	for i, rand_amp in enumerate(rands):
-
-		noisy_NV_system.set_mw_amp(rand_amp)
-		nv_expm.reset_output_state()
-		nv_expm.apply_gates(gate_seq)
-		infids[i] = nv_expm.measure_e()
+	if quadrature_order is not None:
+		infid, infid_var = nv_expm.quasi_static_average(measurement, noise, order = quadrature_order)
+		print("Infidelity is %f, std. dev. over the noise %f" % (infid, np.sqrt(infid_var)))
+		return infid, infid_var
 
+	infids = nv_expm.quasi_static_samples(measurement, random_noise_samples(noise, N_rand))
 
 	print("Infidelity is %f \pm %f" % (np.mean(infids), np.std(infids)/np.sqrt(N_rand)))
 
 	return infids
 
 
+def MonteCarlo_MWFid_batches(noisy_NV_system,N = 11, tau = 7.5e-6,mean = 1.0,sigma=0.01,detuning_sigma = 0.0,B_sigma = 0.0,batch_size = 20,
+		target_error = None,max_time = None,max_samples = None,keep_samples = False):
+	''' Generator running the random samples of MonteCarlo_MWFid in batches of batch_size, yielding the running results after
+	each batch: a dict of the number of samples so far, their mean and standard error, the elapsed time (s), whether
+	target_error was reached and, if keep_samples, the samples. Stops once the standard error reaches target_error,
+	max_time has passed or max_samples are done; without any of these it runs until the caller stops iterating '''
+
+	nv_expm = NV_experiment(noisy_NV_system)
+	noise = {'amp' : (mean,sigma), 'detuning' : (noisy_NV_system.NV_detuning,detuning_sigma), 'B_field' : (noisy_NV_system.B_field,B_sigma)}
+	measurement = _mw_fid_measurement(N, tau)
+
+	stats = streaming_stats.running_stats(keep_samples = keep_samples)
+	start = time.time()
+	while True:
+		batch = batch_size if max_samples is None else min(batch_size, max_samples - stats.count)
+		stats.add(nv_expm.quasi_static_samples(measurement, random_noise_samples(noise, batch)))
+
+		elapsed = time.time() - start
+		converged = target_error is not None and stats.std_error() <= target_error
+		result = {'count' : stats.count, 'mean' : stats.mean, 'std_error' : stats.std_error(), 'elapsed' : elapsed, 'converged' : converged}
+		if keep_samples:
+			result['samples'] = np.array(stats.samples)
+		yield result
+
+		if converged or (max_time is not None and elapsed >= max_time) or (max_samples is not None and stats.count >= max_samples):
+			return
+
+
 def dynamical_decouple(NV_system,N_range = range(0,3000,32), tau = None,**kw):
 
 	if tau is None:
@@ -1013,10 +2163,8 @@ def dynamical_decouple(NV_system,N_range = range(0,3000,32), tau = None,**kw):
 	plt.show()
 	plt.close()
 
-def mw_pulse_fid_scan_freq(noisy_NV_system,freq_range =  np.arange(-10e6,10.5e6,5e5),pulse="Xe"):
-	''' Prepare e in different bases, apply a pulse, and measure if state is in basis that supposed to be in '''
-	results = np.zeros([np.shape(freq_range)[0],3])
-
+def _mw_pulse_fid(noisy_NV_system,pulse):
+	''' Signals of mw_pulse_fid_scan_freq and mw_pulse_fid_scan_amp for one system (one per member of a batch) '''
 	nv_expm = NV_experiment(noisy_NV_system)
 	if pulse == "Xe":
 		mw_seqs = [nv_expm.gate_sequence().ye(perfect_pulse=True).Xe().ye(perfect_pulse=True),
@@ -1027,14 +2175,24 @@ def mw_pulse_fid_scan_freq(noisy_NV_system,freq_range =  np.arange(-10e6,10.5e6,
 				   nv_expm.gate_sequence().mxe(perfect_pulse=True).xe().Xe(perfect_pulse=True),
 				   nv_expm.gate_sequence().xe().xe(perfect_pulse=True)]
 
-	for i,freq in enumerate(freq_range):
-		noisy_NV_system.set_NV_detuning(freq)
-		noisy_NV_system.recalculate()
+	results = []
+	for mw_seq in mw_seqs:
+		nv_expm.reset_output_state()
+		nv_expm.apply_gates(mw_seq)
+		results.append(nv_expm.measure_e())
+	return np.array(results).T
 
-		for j,mw_seq in enumerate(mw_seqs):
-			nv_expm.reset_output_state()
-			nv_expm.apply_gates(mw_seq)
-			results[i,j] = nv_expm.measure_e()
+def mw_pulse_fid_scan_freq(noisy_NV_system,freq_range =  np.arange(-10e6,10.5e6,5e5),pulse="Xe",batched = False):
+	''' Prepare e in different bases, apply a pulse, and measure if state is in basis that supposed to be in
+	With batched, all detunings are simulated at once (see parameter_batch) '''
+	results = np.zeros([np.shape(freq_range)[0],3])
+
+	if batched:
+		results = _mw_pulse_fid(parameter_batch(noisy_NV_system, NV_detuning = freq_range), pulse)
+
+	else:
+		for i,freq in enumerate(freq_range):
+			results[i] = _mw_pulse_fid(noisy_NV_system.with_params(NV_detuning = freq), pulse)
 
 
 	plt.figure()
@@ -1048,23 +2206,8 @@ def mw_pulse_fid_scan_amp(noisy_NV_system,amp_range =  np.arange(0.8,1.2,0.02),p
 	''' Prepare e in different bases, apply a pulse, and measure if state is in basis that supposed to be in '''
 	results = np.zeros([np.shape(amp_range)[0],3])
 
-	nv_expm = NV_experiment(noisy_NV_system)
-	if pulse == "Xe":
-		mw_seqs = [nv_expm.gate_sequence().ye(perfect_pulse=True).Xe().ye(perfect_pulse=True),
-				   nv_expm.gate_sequence().mxe(perfect_pulse=True).Xe().xe(perfect_pulse=True),
-				   nv_expm.gate_sequence().Xe()]
-	elif pulse == "xe":
-		mw_seqs = [nv_expm.gate_sequence().ye(perfect_pulse=True).xe().ye(perfect_pulse=True),
-				   nv_expm.gate_sequence().mxe(perfect_pulse=True).xe().Xe(perfect_pulse=True),
-				   nv_expm.gate_sequence().xe().xe(perfect_pulse=True)]
-
 	for i,amp in enumerate(amp_range):
-		noisy_NV_system.set_mw_amp(amp)
-
-		for j,mw_seq in enumerate(mw_seqs):
-			nv_expm.reset_output_state()
-			nv_expm.apply_gates(mw_seq)
-			results[i,j] = nv_expm.measure_e()
+		results[i] = _mw_pulse_fid(noisy_NV_system.with_params(mean_amp = amp), pulse)
 
 
 	plt.figure()
@@ -1124,21 +2267,19 @@ def hahn_echo(NV_system,delay_range =  np.arange(0e-9,10e-6,10e-9)):
 	ind = np.argmin(results)
 	print('Min sig. ', results[ind], ' at ', delay_range[ind]*1e6)
 
-def dark_esr(noisy_NV_system,freq_range =  np.arange(-5e6,5e6,1e5)):
+def dark_esr(noisy_NV_system,freq_range =  np.arange(-5e6,5e6,1e5),batched = False):
+	''' With batched, all detunings are simulated at once (see parameter_batch) '''
 
-	results = np.zeros(np.shape(freq_range))
-	nv_expm = NV_experiment(noisy_NV_system)
-	desr_seq = nv_expm.gate_sequence()
-	desr_seq.re(theta = 0,phi=1.0)
+	def signal(system):
+		nv_expm = NV_experiment(system)
+		desr_seq = nv_expm.gate_sequence()
+		desr_seq.re(theta = 0,phi=1.0)
+		return nv_expm.apply_gates(desr_seq).measure_e()
 
-	for i,freq in enumerate(freq_range):
-
-		noisy_NV_system.set_NV_detuning(freq)
-		noisy_NV_system.recalculate()
-
-		nv_expm.apply_gates(desr_seq)
-		results[i] = nv_expm.measure_e()
-		nv_expm.reset_output_state()
+	if batched:
+		results = signal(parameter_batch(noisy_NV_system, NV_detuning = freq_range))
+	else:
+		results = np.array([signal(noisy_NV_system.with_params(NV_detuning = freq)) for freq in freq_range])
 
 	plt.figure()
 	plt.plot(freq_range*1e-6,results)
@@ -1203,51 +2344,128 @@ def prepare_X_and_measure_XY(NV_system,N = 32, tau_range =  np.arange(1e-6,7e-6,
 	print('Max fid. ', Fid[ind], ' at ', tau_range[ind]*1e6)
 
 
-def MonteCarlo_MWAmp_CGate_fid(noisy_NV_system,N = 32, tau = 6.582e-6,N_rand = 100,mean = 0.995,sigma=0.01,meas = 'eXY'):
-	'''Simulate doing a carbon gate with finite microwave durations and a certain standard deviation on the pulse amplitude from trial to trial '''
+def carbon_gate_quality(U, c_num, num_carbons):
+	''' Score a system unitary as an electron-conditional pi/2 gate on carbon c_num.
+	The target axis (in the xy-plane) is taken from the rotation for electron state 0, the target is then
+	+-pi/2 around that axis conditional on the electron. Returns the average gate fidelity on (e, c_num) and the
+	crosstalk on each carbon, 1 - |Tr(R0^dag R1)|/2, i.e. how conditional the rotation of that carbon is. '''
+	axes, angles = unitary_conditional_rotations(U, num_carbons)
+
+	phi = np.arctan2(axes[c_num-1,0,1], axes[c_num-1,0,0])
+	target = conditional_rotation(0.5*np.pi, phi, 0.5*np.pi, phi + np.pi)
+	fid = average_gate_fidelity(process_fidelity(U, target, dims = U.dims[0], keep = [0, c_num]), 4)
+
+	crosstalk = 1 - rotation_overlap(axes[:,0], angles[:,0], axes[:,1], angles[:,1])
+	return fid, crosstalk
+
+def optimize_carbon_gate(noisy_NV_system, c_num = 1, N_range = range(8,72,8), tau_range = np.arange(1e-6,10e-6,2e-9), num_candidates = 5, **kw):
+	''' Coarse-to-fine search for the (N, tau) of an electron-conditional pi/2 gate on carbon c_num.
+	All (N, tau) are first screened with the analytic dyn_dec_signal model (target carbon fully entangled, others untouched),
+	then the best local optima are refined with the full finite-pulse simulation by a bounded optimisation of tau.
+	Returns the refined gates ranked by fidelity, with the crosstalk on the other carbons. '''
+
+	scheme = kw.pop('scheme','XY4')
+	tau_window = kw.pop('tau_window',2*(tau_range[1]-tau_range[0])) # Half width of the tau refinement interval
+	xatol = kw.pop('xatol',1e-10)
+
+	# Coarse analytic screening
+	others = [j for j in range(noisy_NV_system.num_carbons) if j != c_num-1]
+	candidates = []
+	for N in N_range:
+		M = dyn_dec_signal(noisy_NV_system.carbon_params, tau_range, N, sign = noisy_NV_system.sign)
+		score = (1 - np.abs(M[c_num-1])) * np.prod(0.5*(1 + M[others]), axis = 0)
+		peaks = np.nonzero((score[1:-1] >= score[:-2]) & (score[1:-1] > score[2:]))[0] + 1
+		candidates += [(score[i], N, tau_range[i]) for i in peaks]
+	candidates = sorted(candidates, key = lambda c : c[0], reverse = True)[:num_candidates]
+
+	# Fine optimisation with the full simulation. The refined taus are continuous, so they are evaluated without the
+	# free evolution cache (which would only grow), on a snapshot sharing everything else
+	nv_expm = NV_experiment(noisy_NV_system.with_params(cache_system_evn = False))
+	min_tau = noisy_NV_system.tau_correction_factor if hasattr(noisy_NV_system,'tau_correction_factor') else 0
+
+	gates = []
+	for score, N, tau0 in candidates:
+		tau_val = [tau0]
+		gate_seq = nv_expm.gate_sequence()
+		gate_seq.nuclear_gate(N, lambda : tau_val[0], scheme = scheme)
 
-	rands = np.random.normal(loc = mean,scale=sigma, size=N_rand)
-	infids = np.zeros(N_rand)
+		def infidelity(tau):
+			tau_val[0] = tau
+			return 1 - carbon_gate_quality(gate_seq.seq_operation(), c_num, noisy_NV_system.num_carbons)[0]
 
-	nv_expm = NV_experiment(noisy_NV_system)
+		bounds = (max(tau0 - tau_window, 2*min_tau), tau0 + tau_window)
+		opt = scipy.optimize.minimize_scalar(infidelity, bounds = bounds, method = 'bounded', options = {'xatol' : xatol})
 
-	mbi_seq = nv_expm.gate_sequence()
-	mbi_seq.mbi_sequence(N,tau)
+		tau_val[0] = opt.x
+		fid, crosstalk = carbon_gate_quality(gate_seq.seq_operation(), c_num, noisy_NV_system.num_carbons)
+		crosstalk[c_num-1] = np.nan
+		gates.append({'N' : N, 'tau' : opt.x, 'fidelity' : fid, 'crosstalk' : crosstalk, 'analytic_score' : score})
 
-	init_seq = mbi_seq.copy_seq()
-	init_seq.proj0()
+	gates = sorted(gates, key = lambda g : g['fidelity'], reverse = True)
 
-	mbi_seq_plus_90 = mbi_seq.copy_seq()
-	mbi_seq_plus_90.nuclear_phase_gate(1,90,state=0,before=True)
+	print('  N    tau (us)    Fid.      Max crosstalk')
+	for g in gates:
+		print('%3d  %10.5f  %8.5f  %8.5f' % (g['N'], g['tau']*1e6, g['fidelity'], np.nanmax(g['crosstalk']) if others else 0.0))
 
-	for i, rand_amp in enumerate(rands):
+	return gates
 
-		noisy_NV_system.set_mw_amp(rand_amp)
 
-		nv_expm.apply_gates(init_seq, norm = True)
-		nv_expm.reset_init_state(state = nv_expm.output_state)
+def MonteCarlo_MWAmp_CGate_fid(noisy_NV_system,N = 32, tau = 6.582e-6,N_rand = 100,mean = 0.995,sigma=0.01,meas = 'eXY',detuning_sigma = 0.0,B_sigma = 0.0,quadrature_order = None,c_num = 1):
+	'''Simulate doing a carbon gate with finite microwave durations and a certain standard deviation on the pulse amplitude from trial to trial
+	meas = 'unitary' scores the nuclear gate unitary of each sample as an electron-conditional pi/2 gate on carbon c_num
+	(average gate fidelity against the ideal conditional rotation, see carbon_gate_quality), meas = 'nXY' measures carbon c_num
+	detuning_sigma, B_sigma and quadrature_order as for MonteCarlo_MWFid '''
 
-		if meas == 'eXY':
-			nv_expm.apply_gates(mbi_seq)
-			X = nv_expm.measure_e()
-			nv_expm.reset_output_state()
+	nv_expm = NV_experiment(noisy_NV_system)
+	noise = {'amp' : (mean,sigma), 'detuning' : (noisy_NV_system.NV_detuning,detuning_sigma), 'B_field' : (noisy_NV_system.B_field,B_sigma)}
 
-			nv_expm.apply_gates(mbi_seq_plus_90)
-			Y = nv_expm.measure_e()
-			nv_expm.reset_output_state()
+	# The sequences are built on the experiment's system in each measurement, so that they see the noise sample
+	if meas == 'unitary':
+		def measurement(nv_expm):
+			gate_seq = nv_expm.gate_sequence()
+			gate_seq.nuclear_gate(N,tau)
+			return carbon_gate_quality(gate_seq.seq_operation(), c_num, nv_expm.NVsys.num_carbons)[0]
 
-		elif meas == 'nXY':
+	else:
+		def measurement(nv_expm):
 
-			X = nv_expm.measure_c(c_state = rhox,c_num=c_num)
-			Y = nv_expm.measure_c(c_state = rhoy,c_num=c_num)
+			mbi_seq = nv_expm.gate_sequence()
+			mbi_seq.mbi_sequence(N,tau)
 
-		nv_expm.reset_init_state()
+			init_seq = mbi_seq.copy_seq()
+			init_seq.proj0()
 
+			mbi_seq_plus_90 = mbi_seq.copy_seq()
+			mbi_seq_plus_90.nuclear_phase_gate(1,90,state=0,before=True)
 
-		infids[i] = (np.sqrt((X-0.5)**2 + (Y-0.5)**2)+0.5)
+			nv_expm.apply_gates(init_seq, norm = True)
+			nv_expm.reset_init_state(state = nv_expm.output_state)
 
-	print("Fidelity is %f \pm %f" % (np.mean(infids), np.std(infids)))
+			if meas == 'eXY':
+				nv_expm.apply_gates(mbi_seq)
+				X = nv_expm.measure_e()
+				nv_expm.reset_output_state()
 
-	return infids
+				nv_expm.apply_gates(mbi_seq_plus_90)
+				Y = nv_expm.measure_e()
+				nv_expm.reset_output_state()
+
+			elif meas == 'nXY':
+
+				X = nv_expm.measure_c(c_state = rhox,c_num=c_num)
+				Y = nv_expm.measure_c(c_state = rhoy,c_num=c_num)
+
+			nv_expm.reset_init_state()
+
+			return (np.sqrt((X-0.5)**2 + (Y-0.5)**2)+0.5)
+
+	if quadrature_order is not None:
+		fid, fid_var = nv_expm.quasi_static_average(measurement, noise, order = quadrature_order)
+		print("Fidelity is %f, std. dev. over the noise %f" % (fid, np.sqrt(fid_var)))
+		return fid, fid_var
+
+	fids = nv_expm.quasi_static_samples(measurement, random_noise_samples(noise, N_rand))
 
+	print("Fidelity is %f \pm %f" % (np.mean(fids), np.std(fids)))
 
+	return fids
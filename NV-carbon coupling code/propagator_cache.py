@@ -0,0 +1,151 @@
+# Caches for propagators.
+# pulse_cache is a bounded in-memory LRU cache, keyed by the parameters that define a pulse.
+# disk_propagator_cache is a persistent on-disk cache, so that restarted jobs and new notebook sessions do not have to
+# recalculate the pulse and free evolution unitaries for a device they have already simulated.
+# Its entries are keyed by a hash of everything that defines the propagator (see system_fingerprint),
+# stored as .npy files, and evicted least recently used first once the cache exceeds max_bytes.
+
+import os
+import collections
+import hashlib
+import threading
+import numpy as np
+
+
+def system_fingerprint(*parts):
+	''' Hash of the parameters that define a propagator. Parts can be strings, numbers, arrays, nested lists or None '''
+	h = hashlib.sha1()
+	for part in parts:
+		if part is None:
+			h.update(b'None')
+		elif isinstance(part, str):
+			h.update(part.encode('utf-8'))
+		elif isinstance(part, (list, tuple)):
+			h.update(system_fingerprint(*part).encode('utf-8'))
+		else:
+			h.update(np.ascontiguousarray(np.asarray(part, dtype = complex)).tobytes())
+		h.update(b'|')
+	return h.hexdigest()
+
+
+def propagator_nbytes(op):
+	''' Memory footprint of a propagator: a numpy or scipy sparse array, anything holding one as its data (qutip Qobj,
+	single_precision_operator), or anything that reports its own nbytes (ket_propagator) '''
+	if isinstance(op, np.ndarray):
+		return op.nbytes
+	if hasattr(op, 'indptr'): # Sparse
+		return op.data.nbytes + op.indices.nbytes + op.indptr.nbytes
+	if hasattr(op, 'data'):
+		return propagator_nbytes(op.data)
+	if hasattr(op, 'nbytes'):
+		return op.nbytes
+	return np.asarray(op).nbytes
+
+
+class pulse_cache(object):
+	''' In-memory LRU cache, bounded in number of entries and in bytes, that keeps hit statistics. Safe to share between
+	threads, a missing entry is calculated outside the lock (so possibly more than once) '''
+
+	def __init__(self, max_entries = 256, max_bytes = 1e9):
+		self.max_entries = max_entries
+		self.max_bytes = max_bytes
+		self.entries = collections.OrderedDict()
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+
+	def get(self, key, calc_func):
+		''' Return the cached value for key, calculating (and storing) it with calc_func on a miss '''
+		with self.lock:
+			if key in self.entries:
+				self.hits += 1
+				op = self.entries.pop(key) # Re-insert to mark as most recently used
+				self.entries[key] = op
+				return op
+			self.misses += 1
+
+		op = calc_func()
+		with self.lock:
+			if key in self.entries:
+				self.nbytes -= propagator_nbytes(self.entries.pop(key))
+			self.entries[key] = op
+			self.nbytes += propagator_nbytes(op)
+
+			while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.nbytes > self.max_bytes):
+				self.nbytes -= propagator_nbytes(self.entries.popitem(last = False)[1])
+		return op
+
+	def clear(self):
+		with self.lock:
+			self.entries = collections.OrderedDict()
+			self.nbytes = 0
+
+	def stats(self):
+		calls = self.hits + self.misses
+		return {'hits' : self.hits, 'misses' : self.misses, 'hit_rate' : self.hits / float(calls) if calls else 0.0,
+				'entries' : len(self.entries), 'bytes' : self.nbytes}
+
+
+class disk_propagator_cache(object):
+
+	def __init__(self, cache_dir, max_bytes = 2e9):
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+
+	def _path(self, key):
+		return os.path.join(self.cache_dir, key + '.npy')
+
+	def load(self, key):
+		''' Return the stored array or None if not cached '''
+		path = self._path(key)
+		if not os.path.exists(path):
+			return None
+		try:
+			arr = np.load(path)
+		except (IOError, ValueError): # Partially written or corrupted, just recalculate
+			return None
+		os.utime(path, None) # Modification time doubles as the last access time for the LRU cleanup
+		return arr
+
+	def store(self, key, arr):
+		path = self._path(key)
+		tmp_path = path + '.%d.%d.tmp' % (os.getpid(), threading.current_thread().ident) # Write then rename, so concurrent jobs never load half a file
+		with open(tmp_path, 'wb') as f:
+			np.save(f, np.asarray(arr))
+		try:
+			os.rename(tmp_path, path)
+		except OSError: # Another job got there first
+			os.remove(tmp_path)
+		self.cleanup()
+
+	def size(self):
+		return sum(os.path.getsize(os.path.join(self.cache_dir, f)) for f in os.listdir(self.cache_dir) if f.endswith('.npy'))
+
+	def cleanup(self):
+		''' Remove least recently used entries until the cache is below max_bytes '''
+		entries = []
+		for f in os.listdir(self.cache_dir):
+			if f.endswith('.npy'):
+				path = os.path.join(self.cache_dir, f)
+				try:
+					entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+				except OSError: # Removed by another job
+					pass
+
+		total = sum(entry[1] for entry in entries)
+		for mtime, size, path in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			total -= size
+
+	def clear(self):
+		for f in os.listdir(self.cache_dir):
+			if f.endswith('.npy'):
+				os.remove(os.path.join(self.cache_dir, f))
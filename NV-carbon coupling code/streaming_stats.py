@@ -0,0 +1,36 @@
+# Streaming statistics for adaptive Monte Carlo runs.
+# Shared by electron_nuclear_sim (MonteCarlo_MWFid_batches) and the repumping Monte Carlo (simulate_batches), which runs
+# batches until the standard error of the running mean reaches a target.
+
+import numpy as np
+
+
+class running_stats(object):
+	''' Streaming (Welford) mean and variance of samples added in batches, each batch merged with Chan's update.
+	Only the count, mean and sum of squared deviations are kept, plus the samples themselves if keep_samples '''
+
+	def __init__(self, keep_samples = False):
+		self.count = 0
+		self.mean = 0.0
+		self.M2 = 0.0 # Sum of squared deviations from the mean
+		self.samples = [] if keep_samples else None
+
+	def add(self, samples):
+		samples = np.asarray(samples, dtype = float)
+		n = len(samples)
+		if n == 0:
+			return
+		batch_mean = np.mean(samples, axis = 0)
+		delta = batch_mean - self.mean
+		total = self.count + n
+		self.M2 = self.M2 + np.sum((samples - batch_mean)**2, axis = 0) + delta**2 * self.count * n / float(total)
+		self.mean = self.mean + delta * n / float(total)
+		self.count = total
+		if self.samples is not None:
+			self.samples.extend(samples)
+
+	def variance(self):
+		return self.M2 / (self.count - 1) if self.count > 1 else np.inf * np.ones_like(self.mean)
+
+	def std_error(self):
+		return np.sqrt(self.variance() / max(self.count, 1))